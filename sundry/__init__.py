@@ -1,15 +1,26 @@
 from .__version__ import __application_name__, __title__, __version__, __author__
 from .is_main import is_main
 from .dataclass_chain import dataclass_chain
-from .robust_os import remove_readonly, rmdir, mkdirs
+from .robust_os import remove_readonly, rmdir, mkdirs, link_or_copy
 from .hash import get_string_md5, get_string_sha256, get_string_sha512, get_file_md5, get_file_sha256, get_file_sha512
+from .to_dynamodb import dict_to_dynamodb
+from .file_lock import FileLock
+from .dynamodb_shards import DynamoDBShardedCache, write_dynamodb_shards
+from .dynamodb_lookup import DynamoDBLookupTable
+from .cache_manager import CacheManager, CacheUsage
 from .aws import aws_dynamodb_scan_table, aws_dynamodb_scan_table_cached, aws_get_client, aws_get_resource, aws_get_dynamodb_table_names
+from .aws import aws_set_max_pool_connections, aws_clear_clients, AWSRetryPolicy, aws_get_retry_policy, aws_set_retry_policy
+from .aws import AWSDynamoDBScanPage, aws_dynamodb_scan_pages, aws_dynamodb_iter_scan, aws_dynamodb_get_table_metadata, aws_dynamodb_get_key_attributes
+from .aws import aws_dynamodb_lookup_table, AWSDynamoDBWriteStats, aws_dynamodb_put_items, aws_dynamodb_get_items
 from .aws import AWSS3DownloadStatus, aws_s3_download_cached, aws_s3_download, aws_s3_read_string, aws_s3_read_lines, aws_s3_write_string, aws_s3_write_lines, aws_s3_upload
-from .aws import aws_s3_get_size_mtime_hash, aws_s3_object_exists
+from .aws import aws_s3_get_size_mtime_hash, aws_s3_get_size_mtime_hash_batch, aws_s3_object_exists, aws_s3_download_ranged, aws_s3_read_bytes
+from .aws import aws_s3_list_objects, aws_s3_objects_exist, aws_s3_delete_batch, aws_s3_iter_lines, aws_s3_tail_lines, aws_s3_iter_bytes, aws_s3_write_stream
+from .aws import AWSS3BulkDownloadStatus, aws_s3_download_cached_bulk, aws_s3_cache_manager, aws_s3_set_cache_limits
+from .aws import AWSS3ReadCacheStats, aws_s3_set_read_cache, aws_s3_read_cache_stats, aws_s3_clear_read_cache
+from .aws import aws_s3_get_file_etag, AWSS3SyncStatus, aws_s3_sync_upload
 from .get_func_info import get_func_name, get_line_number, get_file_name, get_file_path
 from .type_conversion import to_bool
 from .date_time import local_time_string, utc_time_string
 from .uidb32.uidb32 import gen_uuid_b32, uuid_hex_to_b32, uuid_to_b32, b32_to_uuid, uidb32
 from .serializable import make_serializable, convert_serializable_special_cases
-from .to_dynamodb import dict_to_dynamodb
 from .dict_is_close import dict_is_close, DictIsClose, ValueDivergence, ValueDivergences
@@ -2,38 +2,260 @@ import time
 import logging
 import os
 import pickle
+import mmap
+import json
+import hashlib
 from pathlib import Path
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from math import isclose
-import shutil
+import threading
+import queue
+from datetime import datetime, timezone
+import random
+import itertools
+import codecs
+import copy
+import tempfile
+import zlib
+import bz2
+import lzma
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 import boto3
-from s3transfer import S3Transfer
+from botocore.config import Config
+from s3transfer import S3Transfer, TransferConfig
 from s3transfer.exceptions import S3UploadFailedError
-from botocore.exceptions import ClientError, EndpointConnectionError
+from s3transfer.utils import ChunksizeAdjuster
+from botocore.exceptions import ClientError, EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, ResponseStreamingError
 from boto3.exceptions import RetriesExceededError
+from boto3.dynamodb.conditions import ConditionExpressionBuilder, Attr
 from appdirs import user_cache_dir
 
-from sundry import __application_name__, __author__, __title__, mkdirs, get_file_md5, get_string_sha512
+from sundry import __application_name__, __author__, __title__, mkdirs, link_or_copy, get_file_md5, get_string_sha256, get_string_sha512
+from sundry import DynamoDBShardedCache, write_dynamodb_shards, DynamoDBLookupTable, dict_to_dynamodb, CacheManager, FileLock
+from sundry.cache_manager import cache_entry_lock_path
+from sundry.dynamodb_shards import dynamodb_shards_index_file_name
 
 log = logging.getLogger(__title__)
 
 
-def _aws_get_session(profile_name: str):
+aws_max_pool_connections = 10  # botocore's default HTTP connection pool size per client
+
+# Sessions, clients and resources are expensive to create (credential resolution, endpoint and service model loading), so they are
+# created once and reused.  Clients are thread safe and shared across threads.  Resources are not thread safe so they are kept per thread.
+_aws_lock = threading.RLock()
+_aws_sessions = {}
+_aws_clients = {}
+_aws_resources = {}
+
+
+def _aws_get_session(profile_name: str, region_name: (str, None) = None):
     # use keys in AWS config
     # https://docs.aws.amazon.com/cli/latest/userguide/cli-config-files.html
-    session = boto3.session.Session(profile_name=profile_name)
+    key = (profile_name, region_name)
+    with _aws_lock:
+        session = _aws_sessions.get(key)
+        if session is None:
+            session = boto3.session.Session(profile_name=profile_name, region_name=region_name)
+            _aws_sessions[key] = session
     return session
 
 
-def aws_get_resource(resource_name: str, profile_name: str):
-    session = _aws_get_session(profile_name)
-    return session.resource(resource_name)
+def _aws_get_config(max_pool_connections: (int, None), botocore_retries: bool) -> Config:
+    if max_pool_connections is None:
+        max_pool_connections = aws_max_pool_connections
+    if botocore_retries:
+        config = Config(max_pool_connections=max_pool_connections)
+    else:
+        # for the helpers in this module, which retry with the shared AWSRetryPolicy (otherwise the attempts multiply)
+        config = Config(max_pool_connections=max_pool_connections, retries={"total_max_attempts": 1, "mode": "standard"})
+    return config
+
+
+def _aws_get_resource(resource_name: str, profile_name: str, region_name: (str, None) = None, max_pool_connections: (int, None) = None, botocore_retries: bool = False):
+    config = _aws_get_config(max_pool_connections, botocore_retries)
+    key = (profile_name, resource_name, region_name, config.max_pool_connections, botocore_retries, threading.get_ident())
+    with _aws_lock:
+        resource = _aws_resources.get(key)
+        if resource is None:
+            resource = _aws_get_session(profile_name, region_name).resource(resource_name, config=config)
+            _aws_resources[key] = resource
+    return resource
+
+
+def aws_get_resource(resource_name: str, profile_name: str, region_name: (str, None) = None, max_pool_connections: (int, None) = None):
+    """
+    get a (pooled) boto3 resource
+    :param resource_name: AWS service name (e.g. "s3" or "dynamodb")
+    :param profile_name: AWS IAM profile name
+    :param region_name: AWS region (None for the profile's default region)
+    :param max_pool_connections: HTTP connection pool size (None for aws_max_pool_connections)
+    :return: boto3 resource (with botocore's default retries), reused for this thread until aws_clear_clients() is called
+    """
+    return _aws_get_resource(resource_name, profile_name, region_name, max_pool_connections, True)
+
+
+def _aws_get_client(resource_name: str, profile_name: str, region_name: (str, None) = None, max_pool_connections: (int, None) = None, botocore_retries: bool = False):
+    config = _aws_get_config(max_pool_connections, botocore_retries)
+    key = (profile_name, resource_name, region_name, config.max_pool_connections, botocore_retries)
+    with _aws_lock:
+        client = _aws_clients.get(key)
+        if client is None:
+            client = _aws_get_session(profile_name, region_name).client(resource_name, config=config)
+            _aws_clients[key] = client
+    return client
+
+
+def aws_get_client(resource_name: str, profile_name: str, region_name: (str, None) = None, max_pool_connections: (int, None) = None):
+    """
+    get a (pooled) boto3 client
+    :param resource_name: AWS service name (e.g. "s3" or "dynamodb")
+    :param profile_name: AWS IAM profile name
+    :param region_name: AWS region (None for the profile's default region)
+    :param max_pool_connections: HTTP connection pool size (None for aws_max_pool_connections)
+    :return: boto3 client (with botocore's default retries), shared across threads until aws_clear_clients() is called
+    """
+    return _aws_get_client(resource_name, profile_name, region_name, max_pool_connections, True)
+
+
+def aws_set_max_pool_connections(max_pool_connections: int):
+    """
+    set the default HTTP connection pool size for subsequently created clients and resources (e.g. to match a thread pool size)
+    :param max_pool_connections: connection pool size
+    """
+    global aws_max_pool_connections
+    aws_max_pool_connections = max_pool_connections
+
+
+def aws_clear_clients(close: bool = True):
+    """
+    remove all pooled sessions, clients and resources (e.g. after credentials change)
+    :param close: True to also close the clients' connections
+    """
+    with _aws_lock:
+        if close:
+            for client in list(_aws_clients.values()) + [resource.meta.client for resource in _aws_resources.values()]:
+                client.close()
+        _aws_sessions.clear()
+        _aws_clients.clear()
+        _aws_resources.clear()
 
 
-def aws_get_client(resource_name: str, profile_name: str):
-    session = _aws_get_session(profile_name)
-    return session.client(resource_name)
+def _aws_after_fork_in_child():
+    # Connection pools must not be shared with a forked child process.  Another thread of the parent may have held a lock when the process forked, and that
+    # thread doesn't exist in the child, so the locks are replaced rather than taken.
+    global _aws_lock, _aws_s3_read_cache_lock
+    _aws_lock = threading.RLock()
+    _aws_s3_read_cache_lock = threading.Lock()
+    _aws_s3_read_cache.clear()
+    _aws_sessions.clear()
+    _aws_clients.clear()
+    _aws_resources.clear()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_aws_after_fork_in_child)
+
+
+@dataclass
+class AWSRetryPolicy:
+    """
+    retry policy with exponential backoff and full jitter, used by all the AWS helpers (see aws_set_retry_policy)
+    """
+
+    max_attempts: int = 10  # total attempts, including the first
+    base_delay: float = 0.1  # seconds
+    max_delay: float = 20.0  # seconds
+    deadline: (float, None) = 300.0  # maximum total seconds for a call including its retries (None for no deadline)
+    retryable_exceptions: tuple = (EndpointConnectionError, ConnectionClosedError, ReadTimeoutError, ResponseStreamingError, S3UploadFailedError, RetriesExceededError)
+    retryable_error_codes: tuple = (
+        "Throttling",
+        "ThrottlingException",
+        "SlowDown",
+        "RequestLimitExceeded",
+        "ProvisionedThroughputExceededException",
+        "RequestTimeout",
+        "InternalError",
+        "ServiceUnavailable",
+    )
+
+    # counters
+    retries_attempted: int = 0
+    gave_up: int = 0
+
+    _lock: threading.Lock = field(default_factory=threading.Lock, repr=False, compare=False)
+
+    def is_retryable(self, e: Exception) -> bool:
+        if isinstance(e, ClientError):
+            error_code = e.response.get("Error", {}).get("Code")
+            http_status_code = e.response.get("ResponseMetadata", {}).get("HTTPStatusCode", 0)
+            retryable = error_code in self.retryable_error_codes or http_status_code >= 500
+        else:
+            retryable = isinstance(e, self.retryable_exceptions)
+        return retryable
+
+    def backoff(self, attempt: int, start: float, max_attempts: (int, None) = None) -> bool:
+        """
+        wait before retrying
+        :param attempt: number of attempts made so far
+        :param start: time.monotonic() of the first attempt
+        :param max_attempts: overrides max_attempts
+        :return: True to retry, False to give up (no more attempts, or the deadline would be exceeded)
+        """
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        delay = random.uniform(0.0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))  # full jitter
+        retry = attempt < max_attempts and (self.deadline is None or time.monotonic() + delay - start < self.deadline)
+        with self._lock:
+            if retry:
+                self.retries_attempted += 1
+            else:
+                self.gave_up += 1
+        if retry:
+            time.sleep(delay)
+        return retry
+
+    def call(self, function, max_attempts: (int, None) = None):
+        """
+        call a function, retrying when it raises a retryable exception
+        :param function: function that takes no arguments (e.g. a lambda)
+        :param max_attempts: overrides max_attempts
+        :return: the function's return value (the last exception is raised if all attempts fail)
+        """
+        start = time.monotonic()
+        attempt = 0
+        while True:
+            try:
+                return function()
+            except Exception as e:
+                attempt += 1
+                if not self.is_retryable(e):
+                    raise
+                if not self.backoff(attempt, start, max_attempts):
+                    log.warning(f"giving up after {attempt} attempts : {e}")
+                    raise
+                log.info(f"retrying after attempt {attempt} : {e}")
+
+
+_aws_retry_policy = AWSRetryPolicy()
+
+
+def aws_get_retry_policy() -> AWSRetryPolicy:
+    """
+    get the retry policy the AWS helpers use (e.g. to read its retries_attempted and gave_up counters)
+    :return: AWSRetryPolicy instance
+    """
+    return _aws_retry_policy
+
+
+def aws_set_retry_policy(retry_policy: AWSRetryPolicy):
+    """
+    set the retry policy the AWS helpers use
+    :param retry_policy: AWSRetryPolicy instance
+    """
+    global _aws_retry_policy
+    _aws_retry_policy = retry_policy
 
 
 def aws_get_dynamodb_table_names(profile_name: str) -> list:
@@ -42,16 +264,16 @@ def aws_get_dynamodb_table_names(profile_name: str) -> list:
     :param profile_name:  AWS IAM profile name
     :return: a list of DynamoDB table names
     """
-    dynamodb_client = aws_get_client("dynamodb", profile_name)
+    dynamodb_client = _aws_get_client("dynamodb", profile_name)
 
     table_names = []
     more_to_evaluate = True
     last_evaluated_table_name = None
     while more_to_evaluate:
         if last_evaluated_table_name is None:
-            response = dynamodb_client.list_tables()
+            response = _aws_retry_policy.call(lambda: dynamodb_client.list_tables())
         else:
-            response = dynamodb_client.list_tables(ExclusiveStartTableName=last_evaluated_table_name)
+            response = _aws_retry_policy.call(lambda: dynamodb_client.list_tables(ExclusiveStartTableName=last_evaluated_table_name))
         partial_table_names = response.get("TableNames")
         last_evaluated_table_name = response.get("LastEvaluatedTableName")
         if partial_table_names is not None and len(partial_table_names) > 0:
@@ -63,38 +285,150 @@ def aws_get_dynamodb_table_names(profile_name: str) -> list:
     return table_names
 
 
-def aws_dynamodb_scan_table(table_name: str, profile_name: str) -> (list, None):
+def _aws_dynamodb_scan_kwargs(projection: (list, None), filter_expression) -> dict:
+    scan_kwargs = {}
+    if projection is not None and len(projection) > 0:
+        # use placeholders so attribute names that are DynamoDB reserved words (e.g. "name") can be projected
+        attribute_names = {f"#p{index}": attribute_name for index, attribute_name in enumerate(projection)}
+        scan_kwargs["ProjectionExpression"] = ", ".join(attribute_names)
+        scan_kwargs["ExpressionAttributeNames"] = attribute_names
+    if filter_expression is not None:
+        scan_kwargs["FilterExpression"] = filter_expression
+    return scan_kwargs
+
+
+@dataclass
+class AWSDynamoDBScanPage:
+    items: list
+    last_evaluated_key: (dict, None) = None  # checkpoint token - pass in as exclusive_start_key to resume after this page (None when the scan is complete)
+
+
+def aws_dynamodb_scan_pages(
+    table_name: str,
+    profile_name: str,
+    exclusive_start_key: (dict, None) = None,
+    checkpoint_path: (str, Path, None) = None,
+    segment: (int, None) = None,
+    total_segments: (int, None) = None,
+    max_pool_connections: (int, None) = None,
+    projection: (list, None) = None,
+    filter_expression=None,
+):
     """
-    returns entire lookup table
+    generator that yields a table's contents a page at a time, as the pages arrive from DynamoDB
     :param table_name: DynamoDB table name
     :param profile_name: AWS IAM profile name
-    :return: table contents
+    :param exclusive_start_key: checkpoint token (a page's last_evaluated_key) to resume a scan from (None to start at the beginning)
+    :param checkpoint_path: optional file to save the checkpoint token to after each page has been processed.  If it exists the scan resumes from it.
+                            It is removed when the scan completes.
+    :param segment: segment for a parallel scan
+    :param total_segments: total segments for a parallel scan (None for the entire table)
+    :param max_pool_connections: HTTP connection pool size
+    :param projection: attribute names to read (None for all attributes)
+    :param filter_expression: boto3 condition (e.g. boto3.dynamodb.conditions.Attr("status").eq("active")) that DynamoDB filters items with
+    :return: AWSDynamoDBScanPage instances
     """
 
-    items = []
-    dynamodb = aws_get_resource("dynamodb", profile_name)
+    if checkpoint_path is not None and exclusive_start_key is None and os.path.exists(checkpoint_path):
+        with open(checkpoint_path, "rb") as f:
+            exclusive_start_key = pickle.load(f)
+        log.info(f"{table_name} : resuming scan from {checkpoint_path}")
+
+    dynamodb = _aws_get_resource("dynamodb", profile_name, max_pool_connections=max_pool_connections)
     table = dynamodb.Table(table_name)
 
+    scan_kwargs = _aws_dynamodb_scan_kwargs(projection, filter_expression)
+    if total_segments is not None:
+        scan_kwargs["Segment"] = segment
+        scan_kwargs["TotalSegments"] = total_segments
+
     more_to_evaluate = True
-    exclusive_start_key = None
     while more_to_evaluate:
-        try:
-            if exclusive_start_key is None:
-                response = table.scan()
-            else:
-                response = table.scan(ExclusiveStartKey=exclusive_start_key)
-        except EndpointConnectionError as e:
-            log.warning(e)
-            response = None
-            more_to_evaluate = False
-            items = None
+        if exclusive_start_key is None:
+            response = _aws_retry_policy.call(lambda: table.scan(**scan_kwargs))
+        else:
+            response = _aws_retry_policy.call(lambda: table.scan(ExclusiveStartKey=exclusive_start_key, **scan_kwargs))
+        exclusive_start_key = response.get("LastEvaluatedKey")
+        more_to_evaluate = exclusive_start_key is not None
+
+        yield AWSDynamoDBScanPage(response["Items"], exclusive_start_key)
+
+        # the caller has processed the page so it's safe to move the checkpoint past it
+        if checkpoint_path is not None:
+            if more_to_evaluate:
+                _write_atomic(checkpoint_path, lambda f: pickle.dump(exclusive_start_key, f))
+            elif os.path.exists(checkpoint_path):
+                os.remove(checkpoint_path)
+
+
+def aws_dynamodb_iter_scan(
+    table_name: str, profile_name: str, exclusive_start_key: (dict, None) = None, checkpoint_path: (str, Path, None) = None, projection: (list, None) = None, filter_expression=None
+):
+    """
+    generator that yields a table's items as they arrive from DynamoDB, so the entire table does not have to fit in memory
+    :param table_name: DynamoDB table name
+    :param profile_name: AWS IAM profile name
+    :param exclusive_start_key: checkpoint token to resume a scan from (see aws_dynamodb_scan_pages)
+    :param checkpoint_path: optional checkpoint file (see aws_dynamodb_scan_pages)
+    :param projection: attribute names to read (None for all attributes)
+    :param filter_expression: boto3 condition that DynamoDB filters items with
+    :return: items
+    """
+    for page in aws_dynamodb_scan_pages(table_name, profile_name, exclusive_start_key, checkpoint_path, projection=projection, filter_expression=filter_expression):
+        yield from page.items
+
+
+def _aws_dynamodb_scan_segment(
+    table_name: str, profile_name: str, segment: (int, None), total_segments: (int, None), max_pool_connections: (int, None), projection: (list, None), filter_expression
+) -> (list, None):
+    """
+    scan one segment of a table (or the entire table if total_segments is None)
+    :return: segment contents or None if the table could not be accessed
+    """
+
+    items = []
+    try:
+        for page in aws_dynamodb_scan_pages(
+            table_name, profile_name, segment=segment, total_segments=total_segments, max_pool_connections=max_pool_connections, projection=projection, filter_expression=filter_expression
+        ):
+            items.extend(page.items)
+    except EndpointConnectionError as e:
+        log.warning(f"{table_name} : {segment=} : {e}")
+        items = None
+
+    return items
 
-        if response is not None:
-            items.extend(response["Items"])
-            if "LastEvaluatedKey" not in response:
-                more_to_evaluate = False
-            else:
-                exclusive_start_key = response["LastEvaluatedKey"]
+
+def aws_dynamodb_scan_table(
+    table_name: str, profile_name: str, total_segments: (int, None) = None, max_workers: (int, None) = None, projection: (list, None) = None, filter_expression=None
+) -> (list, None):
+    """
+    returns entire lookup table
+    :param table_name: DynamoDB table name
+    :param profile_name: AWS IAM profile name
+    :param total_segments: number of segments for a parallel scan (None or 1 for a serial scan)
+    :param max_workers: number of threads for a parallel scan (None for one thread per segment)
+    :param projection: attribute names to read (None for all attributes)
+    :param filter_expression: boto3 condition (e.g. boto3.dynamodb.conditions.Attr("status").eq("active")) that DynamoDB filters items with
+    :return: table contents (for a parallel scan the items are in segment order)
+    """
+
+    if total_segments is None or total_segments <= 1:
+        items = _aws_dynamodb_scan_segment(table_name, profile_name, None, None, None, projection, filter_expression)
+    else:
+        if max_workers is None:
+            max_workers = total_segments
+        max_pool_connections = max(max_workers, aws_max_pool_connections)
+
+        def scan_segment(segment: int):
+            return _aws_dynamodb_scan_segment(table_name, profile_name, segment, total_segments, max_pool_connections, projection, filter_expression)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            segments_items = list(executor.map(scan_segment, range(total_segments)))
+        if any(segment_items is None for segment_items in segments_items):
+            items = None
+        else:
+            items = [item for segment_items in segments_items for item in segment_items]
 
     if items is not None:
         log.info(f"read {len(items)} items from {table_name}")
@@ -109,53 +443,545 @@ def _is_valid_db_pickled_file(file_path: str, cache_life: (float, int, None)):
     return is_valid
 
 
-def aws_dynamodb_scan_table_cached(table_name: str, profile_name: str, cache_dir: str = "cache", invalidate_cache: bool = False, cache_life: (float, None) = None) -> list:
+def aws_dynamodb_get_table_metadata(table_name: str, profile_name: str) -> (dict, None):
+    """
+    get a table's metadata from DescribeTable, which is much quicker than a scan.  Note that DynamoDB only updates ItemCount and TableSizeBytes approximately every
+    six hours.
+    :param table_name: DynamoDB table name
+    :param profile_name: AWS IAM profile name
+    :return: dict of ItemCount, TableSizeBytes, CreationDateTime, LatestStreamArn and LatestStreamLabel (None if the table could not be accessed)
+    """
+    dynamodb_client = _aws_get_client("dynamodb", profile_name)
+    try:
+        table_description = _aws_retry_policy.call(lambda: dynamodb_client.describe_table(TableName=table_name))["Table"]
+        table_metadata = {k: table_description.get(k) for k in ["ItemCount", "TableSizeBytes", "LatestStreamArn", "LatestStreamLabel"]}
+        table_metadata["CreationDateTime"] = str(table_description.get("CreationDateTime"))  # detects a table that was deleted and re-created
+    except (ClientError, EndpointConnectionError) as e:
+        log.warning(f"{table_name} : {e}")
+        table_metadata = None
+    return table_metadata
+
+
+def aws_dynamodb_get_key_attributes(table_name: str, profile_name: str) -> (list, None):
+    """
+    get the names of a table's primary key attribute(s)
+    :param table_name: DynamoDB table name
+    :param profile_name: AWS IAM profile name
+    :return: list of the partition (hash) key name followed by the sort (range) key name, if any (None if the table could not be accessed)
+    """
+    dynamodb_client = _aws_get_client("dynamodb", profile_name)
+    try:
+        key_schema = _aws_retry_policy.call(lambda: dynamodb_client.describe_table(TableName=table_name))["Table"]["KeySchema"]
+        key_attributes = [k["AttributeName"] for k in sorted(key_schema, key=lambda k: k["KeyType"] != "HASH")]
+    except (ClientError, EndpointConnectionError) as e:
+        log.warning(f"{table_name} : {e}")
+        key_attributes = None
+    return key_attributes
+
+
+def _aws_dynamodb_cache_metadata_file_path(cache_file_path: str) -> str:
+    # next to (not in) a "shards" cache directory, so it's kept when the cache is rewritten
+    if os.path.basename(cache_file_path) == dynamodb_shards_index_file_name:
+        cache_file_path = os.path.dirname(cache_file_path)
+    return f"{os.path.splitext(cache_file_path)[0]}_metadata.json"
+
+
+def _aws_dynamodb_read_cache_metadata(cache_file_path: str) -> (dict, None):
+    metadata_file_path = _aws_dynamodb_cache_metadata_file_path(cache_file_path)
+    cache_metadata = None
+    if os.path.exists(metadata_file_path):
+        try:
+            with open(metadata_file_path) as f:
+                cache_metadata = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(f"{metadata_file_path} : {e}")
+    return cache_metadata
+
+
+def _aws_dynamodb_cache_lock_path(cache_file_path: str) -> str:
+    # next to (not in) a "shards" cache directory, so it is named the same way as for a pickle cache
+    if os.path.basename(cache_file_path) == dynamodb_shards_index_file_name:
+        cache_file_path = os.path.dirname(cache_file_path)
+    return f"{os.path.splitext(cache_file_path)[0]}.lock"
+
+
+def _write_atomic(file_path: (str, Path), write_function, mode: str = "wb"):
+    # write to a temp file and then rename it so readers never see a partially written file (the temp file is unique so writers that don't hold a lock can't
+    # write into each other's temp file)
+    temp_fd, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), prefix=f"{os.path.basename(file_path)}.", suffix=".temp")
+    try:
+        with os.fdopen(temp_fd, mode) as f:
+            write_function(f)
+        os.replace(temp_file_path, file_path)
+    except BaseException:
+        try:
+            os.remove(temp_file_path)
+        except OSError:
+            pass
+        raise
+
+
+def _aws_dynamodb_cache_file_path(cache_dir: str, table_name: str, projection: (list, None), filter_expression) -> str:
+    if (projection is None or len(projection) == 0) and filter_expression is None:
+        cache_file_name = f"{table_name}.pickle"
+    else:
+        # different projections and filters of the same table are cached separately
+        if filter_expression is None:
+            filter_string = ""
+        else:
+            built_expression = ConditionExpressionBuilder().build_expression(filter_expression)
+            names = sorted(built_expression.attribute_name_placeholders.items())
+            values = sorted(built_expression.attribute_value_placeholders.items())
+            filter_string = f"{built_expression.condition_expression}{names}{values}"
+        projection_string = "" if projection is None else ",".join(sorted(projection))
+        cache_file_name = f"{table_name}_{get_string_sha256(projection_string + '|' + filter_string)[:16]}.pickle"
+    return os.path.join(cache_dir, cache_file_name)
+
+
+def _aws_dynamodb_read_cache(cache_file_path: str, cache_format: str) -> (list, DynamoDBShardedCache):
+    if cache_format == "shards":
+        cached_data = DynamoDBShardedCache(os.path.dirname(cache_file_path))
+    else:
+        with open(cache_file_path, "rb") as f:
+            cached_data = pickle.load(f)
+    return cached_data
+
+
+def _aws_dynamodb_delta_refresh(
+    table_name: str,
+    profile_name: str,
+    cached_items: list,
+    key_attributes: list,
+    updated_at_attribute: str,
+    total_segments: (int, None),
+    max_workers: (int, None),
+    projection: (list, None),
+    filter_expression,
+) -> (list, None):
+    """
+    update cached items with only the items that have been written since the cache's high-water mark
+    :return: the updated items (None if the table could not be accessed)
+    """
+    high_water_mark = max((item[updated_at_attribute] for item in cached_items if item.get(updated_at_attribute) is not None), default=None)
+    if high_water_mark is None:
+        log.info(f"{table_name} : no {updated_at_attribute} in cache - getting {table_name} from DB")
+        items = aws_dynamodb_scan_table(table_name, profile_name, total_segments, max_workers, projection, filter_expression)
+    else:
+        # greater than or equal in case other items were written at the same time as the high-water mark
+        delta_filter = Attr(updated_at_attribute).gte(high_water_mark)
+        log.info(f"getting {table_name} items with {updated_at_attribute} >= {high_water_mark} from DB")
+        if filter_expression is None:
+            changed_keys = None
+            changed_items = aws_dynamodb_scan_table(table_name, profile_name, total_segments, max_workers, projection, delta_filter)
+        else:
+            # An item that changed so it no longer matches the filter isn't returned by a filtered scan, so the keys of all the changed items are read first.
+            # Changed items that aren't in the filtered scan are then removed from the cache.
+            changed_keys = aws_dynamodb_scan_table(table_name, profile_name, total_segments, max_workers, key_attributes, delta_filter)
+            changed_items = None if changed_keys is None else aws_dynamodb_scan_table(table_name, profile_name, total_segments, max_workers, projection, filter_expression & delta_filter)
+        if changed_items is None:
+            items = None
+        else:
+            changed_items_by_key = {tuple(item.get(k) for k in key_attributes): item for item in changed_items}
+            removed_keys = set() if changed_keys is None else {tuple(item.get(k) for k in key_attributes) for item in changed_keys} - set(changed_items_by_key)
+            items = []
+            for item in cached_items:
+                key = tuple(item.get(k) for k in key_attributes)
+                if key in changed_items_by_key:
+                    items.append(changed_items_by_key.pop(key))
+                elif key not in removed_keys:
+                    items.append(item)
+            items.extend(changed_items_by_key.values())  # new items
+            log.info(f"{table_name} : merged {len(changed_items)} changed items into {len(cached_items)} cached items ({len(removed_keys)} no longer match the filter)")
+    return items
+
+
+def _aws_dynamodb_fill_cache(
+    table_name: str,
+    profile_name: str,
+    cache_file_path: str,
+    table_metadata: (dict, None),
+    total_segments: (int, None),
+    max_workers: (int, None),
+    projection: (list, None),
+    filter_expression,
+    updated_at_attribute: (str, None),
+    key_attributes: (list, None),
+    cache_format: str,
+    compression: (str, None),
+) -> (list, DynamoDBShardedCache, None):
+    """
+    scan (or incrementally refresh) a table and write the scan cache
+    :return: table data, or None if the table could not be accessed
+    """
+    output_data = None
+    try:
+        if updated_at_attribute is not None and key_attributes is not None and _is_valid_db_pickled_file(cache_file_path, None):
+            cached_data = _aws_dynamodb_read_cache(cache_file_path, cache_format)
+            if cache_format == "shards":
+                with cached_data:
+                    cached_data = list(cached_data)
+            table_data = _aws_dynamodb_delta_refresh(table_name, profile_name, cached_data, key_attributes, updated_at_attribute, total_segments, max_workers, projection, filter_expression)
+        else:
+            log.info(f"getting {table_name} from DB")
+            table_data = aws_dynamodb_scan_table(table_name, profile_name, total_segments, max_workers, projection, filter_expression)
+    except RetriesExceededError:
+        table_data = None
+
+    if table_data is not None and len(table_data) > 0:
+        # update data cache
+        if cache_format == "shards":
+            output_data = write_dynamodb_shards(os.path.dirname(cache_file_path), table_data, key_attributes, compression=compression)
+        else:
+            output_data = table_data
+            _write_atomic(cache_file_path, lambda f: pickle.dump(output_data, f))
+        if table_metadata is not None:
+            _write_atomic(_aws_dynamodb_cache_metadata_file_path(cache_file_path), lambda f: json.dump(table_metadata, f, indent=4), "w")
+
+    return output_data
+
+
+def aws_dynamodb_scan_table_cached(
+    table_name: str,
+    profile_name: str,
+    cache_dir: str = "cache",
+    invalidate_cache: bool = False,
+    cache_life: (float, None) = None,
+    total_segments: (int, None) = None,
+    max_workers: (int, None) = None,
+    projection: (list, None) = None,
+    filter_expression=None,
+    validate_cache: bool = False,
+    updated_at_attribute: (str, None) = None,
+    cache_format: str = "pickle",
+    compression: (str, None) = None,
+) -> (list, DynamoDBShardedCache):
     """
 
     Read data table(s) from AWS with caching.  This *requires* that the table not change during execution nor
-    from run to run without setting invalidate_cache.
+    from run to run without setting invalidate_cache (or using validate_cache).
+    Processes (and threads) that find the cache missing or stale at the same time share one scan - the first one scans and writes the cache while the others
+    wait for it (see FileLock) and then read the cache.
 
     :param table_name: DynamoDB table name
     :param profile_name: AWS IAM profile name
     :param cache_dir: cache dir
     :param invalidate_cache: True to initially invalidate the cache (forcing a table scan)
     :param cache_life: Life of cache in seconds (None=forever)
-    :return: a list with the (possibly cached) table data
+    :param total_segments: number of segments for a parallel scan (None for a serial scan)
+    :param max_workers: number of threads for a parallel scan (None for one thread per segment)
+    :param projection: attribute names to read (None for all attributes)
+    :param filter_expression: boto3 condition that DynamoDB filters items with
+    :param validate_cache: True to compare the table's metadata (see aws_dynamodb_get_table_metadata) with the metadata saved with the cache.  The table is
+                           only scanned if the metadata has changed, and an unchanged table renews the cache's life.
+    :param updated_at_attribute: name of an attribute that is set to when the item was last written (e.g. an ISO time string or a timestamp).  If given, a stale
+                                 cache is refreshed incrementally by scanning only for items written since the newest item in the cache and merging them in by
+                                 primary key.  Deleted items are not detected so use invalidate_cache occasionally if items are deleted.
+    :param cache_format: "pickle" for a single pickle file, or "shards" for a sharded cache that is loaded lazily (see DynamoDBShardedCache)
+    :param compression: compression for the "shards" cache format (None, "zlib" or "lzma")
+    :return: a list with the (possibly cached) table data, or a DynamoDBShardedCache for the "shards" cache format
     """
 
-    # todo: check the table size in AWS (since this is quick) and if it's different than what's in the cache, invalidate the cache first
+    key_attributes = None
+    if updated_at_attribute is not None or cache_format == "shards":
+        key_attributes = aws_dynamodb_get_key_attributes(table_name, profile_name)
+        if projection is not None and len(projection) > 0:
+            # sharding needs the key attributes of every item, and incremental refresh also needs the "updated at" attribute
+            required_attributes = list(key_attributes or [])
+            if updated_at_attribute is not None:
+                required_attributes.append(updated_at_attribute)
+            projection = list(projection) + [a for a in required_attributes if a not in projection]
 
     mkdirs(cache_dir)
-    cache_file_path = os.path.join(cache_dir, f"{table_name}.pickle")
+    cache_file_path = _aws_dynamodb_cache_file_path(cache_dir, table_name, projection, filter_expression)
+    if cache_format == "shards":
+        cache_file_path = os.path.join(f"{os.path.splitext(cache_file_path)[0]}.shards", dynamodb_shards_index_file_name)
     log.debug(f"cache_file_path : {os.path.abspath(cache_file_path)}")
     if invalidate_cache and os.path.exists(cache_file_path):
         os.remove(cache_file_path)
 
+    table_metadata = None
+    table_changed = False
+    if validate_cache:
+        # get the metadata before any scan so a table that changes during the scan is re-scanned next time
+        table_metadata = aws_dynamodb_get_table_metadata(table_name, profile_name)
+        if table_metadata is not None and os.path.exists(cache_file_path):
+            if table_metadata == _aws_dynamodb_read_cache_metadata(cache_file_path):
+                os.utime(cache_file_path)  # table is unchanged, so renew the cache life
+            else:
+                log.info(f"{table_name} : table metadata has changed - {cache_file_path} is stale")
+                table_changed = True
+
     output_data = None
-    if _is_valid_db_pickled_file(cache_file_path, cache_life):
-        with open(cache_file_path, "rb") as f:
-            log.info(f"{table_name} : reading {cache_file_path}")
-            output_data = pickle.load(f)
-            log.debug(f"done reading {cache_file_path}")
+    if not table_changed and _is_valid_db_pickled_file(cache_file_path, cache_life):
+        log.info(f"{table_name} : reading {cache_file_path}")
+        output_data = _aws_dynamodb_read_cache(cache_file_path, cache_format)
+        log.debug(f"done reading {cache_file_path}")
+    elif cache_format == "shards" and key_attributes is None:
+        pass  # can't shard without the primary key (the table is probably not accessible)
+    else:
+        # single flight - one process scans and writes the cache while any others wait for it and then read what it wrote
+        with FileLock(_aws_dynamodb_cache_lock_path(cache_file_path)):
+            if table_metadata is not None and os.path.exists(cache_file_path):
+                table_changed = table_metadata != _aws_dynamodb_read_cache_metadata(cache_file_path)
+            if not table_changed and _is_valid_db_pickled_file(cache_file_path, cache_life):
+                log.info(f"{table_name} : reading {cache_file_path} (written by another process)")
+                output_data = _aws_dynamodb_read_cache(cache_file_path, cache_format)
+            else:
+                output_data = _aws_dynamodb_fill_cache(
+                    table_name,
+                    profile_name,
+                    cache_file_path,
+                    table_metadata,
+                    total_segments,
+                    max_workers,
+                    projection,
+                    filter_expression,
+                    updated_at_attribute,
+                    key_attributes,
+                    cache_format,
+                    compression,
+                )
+
+    if output_data is None:
+        log.error(f'table "{table_name}" not accessible')
+
+    return output_data
+
+
+def aws_dynamodb_lookup_table(table_name: str, profile_name: str, index_attributes: (list, None) = None, **kwargs) -> (DynamoDBLookupTable, None):
+    """
+    get a table's contents (with caching) as a lookup table that is indexed by primary key and optionally other attributes
+    :param table_name: DynamoDB table name
+    :param profile_name: AWS IAM profile name
+    :param index_attributes: attribute names to create secondary indexes for
+    :param kwargs: passed on to aws_dynamodb_scan_table_cached()
+    :return: a DynamoDBLookupTable instance (None if the table could not be accessed)
+    """
+    lookup_table = None
+    key_attributes = aws_dynamodb_get_key_attributes(table_name, profile_name)
+    if key_attributes is not None:
+        table_data = aws_dynamodb_scan_table_cached(table_name, profile_name, **kwargs)
+        if isinstance(table_data, DynamoDBShardedCache):
+            with table_data:  # the items are copied into the lookup table, so the cache (and its reader lease) can be closed
+                lookup_table = DynamoDBLookupTable(table_data, key_attributes, index_attributes)
+        elif table_data is not None:
+            lookup_table = DynamoDBLookupTable(table_data, key_attributes, index_attributes)
+    return lookup_table
+
 
-    if not _is_valid_db_pickled_file(cache_file_path, cache_life):
-        log.info(f"getting {table_name} from DB")
+@dataclass
+class AWSDynamoDBWriteStats:
+    items_written: int = 0
+    batches_written: int = 0
+    retries: int = 0  # number of times unprocessed items were re-sent
+    items_not_written: int = 0  # items still unprocessed after all retries, or in batches that failed
+    batches_failed: int = 0  # batches that could not be written (e.g. a validation error or an inaccessible table)
+    duplicate_items: int = 0  # items replaced by a later item with the same key in the same batch
+    duration: float = 0.0  # seconds
+
+    def items_per_second(self) -> float:
+        return self.items_written / self.duration if self.duration > 0.0 else 0.0
+
+
+dynamodb_batch_write_size = 25  # BatchWriteItem maximum
+dynamodb_batch_get_size = 100  # BatchGetItem maximum
+
+
+def _aws_dynamodb_write_batch(table_name: str, profile_name: str, batch: list, retries: int, max_pool_connections: int) -> (int, int):
+    """
+    write a batch of items, retrying unprocessed items (see AWSRetryPolicy)
+    :return: number of retries, number of items not written
+    """
+    dynamodb = _aws_get_resource("dynamodb", profile_name, max_pool_connections=max_pool_connections)
+    request_items = {table_name: [{"PutRequest": {"Item": item}} for item in batch]}
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        unprocessed_items = _aws_retry_policy.call(lambda: dynamodb.batch_write_item(RequestItems=request_items)).get("UnprocessedItems", {})
+        attempt += 1
+        if len(unprocessed_items) == 0 or not _aws_retry_policy.backoff(attempt, start, retries + 1):
+            break
+        request_items = unprocessed_items
+    items_not_written = len(unprocessed_items.get(table_name, []))
+    if items_not_written > 0:
+        log.warning(f"{table_name} : {items_not_written} items not written after {attempt - 1} retries")
+    return attempt - 1, items_not_written
+
+
+def aws_dynamodb_put_items(table_name: str, items, profile_name: str, max_workers: int = 8, max_in_flight: (int, None) = None, retries: int = 10) -> AWSDynamoDBWriteStats:
+    """
+    write many items to a table using BatchWriteItem, with several batches written at once
+    :param table_name: DynamoDB table name
+    :param items: iterable of dicts (converted with dict_to_dynamodb).  If an item has the same key as an earlier item in the same batch, the later one is written.
+    :param profile_name: AWS IAM profile name
+    :param max_workers: number of threads
+    :param max_in_flight: maximum number of batches that are queued or being written, which bounds memory use (None for twice max_workers)
+    :param retries: number of times to retry unprocessed items
+    :return: AWSDynamoDBWriteStats instance
+    """
 
+    stats = AWSDynamoDBWriteStats()
+    start = time.time()
+    if max_in_flight is None:
+        max_in_flight = 2 * max_workers
+    max_pool_connections = max(max_workers, aws_max_pool_connections)
+
+    # BatchWriteItem does not allow the same key more than once in a batch, so the last item with a given key wins (like batch_writer's overwrite_by_pkeys)
+    key_attributes = aws_dynamodb_get_key_attributes(table_name, profile_name)
+
+    def batch_done(future):
         try:
-            table_data = aws_dynamodb_scan_table(table_name, profile_name)
-        except RetriesExceededError:
-            table_data = None
+            batch_retries, batch_items_not_written = future.result()
+            stats.retries += batch_retries
+            stats.batches_written += 1
+        except _aws_retry_policy.retryable_exceptions + (ClientError,) as e:
+            log.error(f"{table_name} : batch of {futures[future]} items not written : {e}")
+            batch_items_not_written = futures[future]
+            stats.batches_failed += 1
+        stats.items_not_written += batch_items_not_written
+        stats.items_written += futures[future] - batch_items_not_written
+
+    futures = {}  # future: number of items in the batch
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        batch = {}  # key: item
+        for item in itertools.chain(items, [None]):
+            if item is not None:
+                dynamodb_item = dict_to_dynamodb(item)
+                key = len(batch) if key_attributes is None else tuple(dynamodb_item.get(k) for k in key_attributes)
+                if key in batch:
+                    stats.duplicate_items += 1
+                batch[key] = dynamodb_item
+            if len(batch) >= dynamodb_batch_write_size or (item is None and len(batch) > 0):
+                if len(futures) >= max_in_flight:
+                    done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        batch_done(future)
+                        del futures[future]
+                futures[executor.submit(_aws_dynamodb_write_batch, table_name, profile_name, list(batch.values()), retries, max_pool_connections)] = len(batch)
+                batch = {}
+        for future in futures:
+            batch_done(future)
+
+    stats.duration = time.time() - start
+    log.info(
+        f"{table_name} : wrote {stats.items_written} items in {stats.duration:.3f} seconds ({stats.items_per_second():.1f} items/s, {stats.retries} retries, {stats.batches_failed} batches failed)"
+    )
+    return stats
+
+
+def _aws_dynamodb_get_batch(table_name: str, profile_name: str, keys: list, projection: (list, None), retries: int, max_pool_connections: int) -> list:
+    """
+    get a batch of items, retrying unprocessed keys (see AWSRetryPolicy)
+    :return: list of items
+    """
+    dynamodb = _aws_get_resource("dynamodb", profile_name, max_pool_connections=max_pool_connections)
+    request_items = {table_name: {"Keys": keys, **_aws_dynamodb_scan_kwargs(projection, None)}}
+    items = []
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        response = _aws_retry_policy.call(lambda: dynamodb.batch_get_item(RequestItems=request_items))
+        items.extend(response.get("Responses", {}).get(table_name, []))
+        unprocessed_keys = response.get("UnprocessedKeys", {})
+        attempt += 1
+        if len(unprocessed_keys) == 0 or not _aws_retry_policy.backoff(attempt, start, retries + 1):
+            break
+        request_items = unprocessed_keys
+    if len(unprocessed_keys) > 0:
+        log.warning(f"{table_name} : {len(unprocessed_keys[table_name]['Keys'])} keys not read after {attempt - 1} retries")
+    return items
 
-        if table_data is not None and len(table_data) > 0:
-            output_data = table_data
-            # update data cache
-            with open(cache_file_path, "wb") as f:
-                pickle.dump(output_data, f)
 
-    if output_data is None:
-        log.error(f'table "{table_name}" not accessible')
+def aws_dynamodb_get_items(
+    table_name: str,
+    keys: list,
+    profile_name: str,
+    projection: (list, None) = None,
+    max_workers: int = 8,
+    retries: int = 10,
+    cache_dir: (str, None) = None,
+    cache_life: (float, None) = None,
+    write_through: bool = False,
+) -> list:
+    """
+    get many items by primary key using BatchGetItem, with several batches read at once
+    :param table_name: DynamoDB table name
+    :param keys: list of dicts of key attribute(s)
+    :param profile_name: AWS IAM profile name
+    :param projection: attribute names to read (None for all attributes).  Must include the key attributes if the cache is used.
+    :param max_workers: number of threads
+    :param retries: number of times to retry unprocessed keys
+    :param cache_dir: if given, items are first looked up in the table's scan cache (see aws_dynamodb_scan_table_cached) so only cache misses are read from DynamoDB
+    :param cache_life: life of the scan cache in seconds (None=forever)
+    :param write_through: True to add the items read from DynamoDB to the scan cache
+    :return: list of the items that were found (in no particular order)
+    """
 
-    return output_data
+    # BatchGetItem does not allow duplicate keys
+    keys = list({tuple(sorted(key.items())): key for key in keys}.values())
+
+    items = []
+    cache_file_path = None
+    cached_data = None
+    if cache_dir is not None and len(keys) > 0:
+        key_attributes = list(keys[0].keys())
+        cache_file_path = _aws_dynamodb_cache_file_path(cache_dir, table_name, projection, None)
+        shards_file_path = os.path.join(f"{os.path.splitext(cache_file_path)[0]}.shards", dynamodb_shards_index_file_name)
+        if _is_valid_db_pickled_file(shards_file_path, cache_life):
+            cache_file_path = shards_file_path
+            cached_data = _aws_dynamodb_read_cache(cache_file_path, "shards")
+            cached_items = cached_data
+        elif _is_valid_db_pickled_file(cache_file_path, cache_life):
+            cached_data = _aws_dynamodb_read_cache(cache_file_path, "pickle")
+            cached_items = DynamoDBLookupTable(cached_data, key_attributes)
+        if cached_data is not None:
+            missed_keys = []
+            for key in keys:
+                item = cached_items.get(key)
+                if item is None:
+                    missed_keys.append(key)
+                else:
+                    items.append(item)
+            log.info(f"{table_name} : {len(items)} of {len(keys)} keys found in {cache_file_path}")
+            keys = missed_keys
+
+    max_pool_connections = max(max_workers, aws_max_pool_connections)
+
+    def get_batch(batch: list) -> list:
+        return _aws_dynamodb_get_batch(table_name, profile_name, batch, projection, retries, max_pool_connections)
+
+    batches = [keys[index : index + dynamodb_batch_get_size] for index in range(0, len(keys), dynamodb_batch_get_size)]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        read_items = [item for batch_items in executor.map(get_batch, batches) for item in batch_items]
+    items.extend(read_items)
+
+    cache_format = "shards" if isinstance(cached_data, DynamoDBShardedCache) else "pickle"
+    if cache_format == "shards":
+        cached_data.close()
+
+    if write_through and cached_data is not None and len(read_items) > 0:
+        with FileLock(_aws_dynamodb_cache_lock_path(cache_file_path)):
+            # re-read the cache under the lock since another process may have refreshed (or added to) it since it was read above
+            if _is_valid_db_pickled_file(cache_file_path, cache_life):
+                # the scan cache's life is not extended since it's still only as current as its last scan
+                cache_mtime = os.path.getmtime(cache_file_path)
+                current_data = _aws_dynamodb_read_cache(cache_file_path, cache_format)
+                if cache_format == "shards":
+                    key_attributes = current_data.key_attributes
+                    with current_data:
+                        current_items = list(current_data)
+                else:
+                    current_items = current_data
+                # the items just read replace any cached items with the same key
+                read_keys = {tuple(item[k] for k in key_attributes) for item in read_items}
+                all_items = [item for item in current_items if tuple(item.get(k) for k in key_attributes) not in read_keys] + read_items
+                if cache_format == "shards":
+                    write_dynamodb_shards(os.path.dirname(cache_file_path), all_items, key_attributes, compression=current_data.compression).close()
+                else:
+                    _write_atomic(cache_file_path, lambda f: pickle.dump(all_items, f))
+                os.utime(cache_file_path, (cache_mtime, cache_mtime))
+
+    return items
 
 
 @dataclass
@@ -164,14 +990,92 @@ class AWSS3DownloadStatus:
     cached: bool = None
     sizes_differ: bool = None
     mtimes_differ: bool = None
+    etags_differ: bool = None
 
 
 cache_abs_tol = 3.0  # seconds
 
+# S3 download cache budget (see aws_s3_set_cache_limits)
+aws_s3_cache_max_bytes = None
+aws_s3_cache_max_entries = None
+aws_s3_cache_policy = "lru"
+
+
+def _aws_s3_default_cache_dir() -> Path:
+    return Path(user_cache_dir(__application_name__, __author__, "aws", "s3"))
+
+
+_aws_s3_cache_managers = {}  # (cache dir, max bytes, max entries, policy): CacheManager
 
-def aws_s3_download_cached(s3_bucket: str, s3_key: str, dest_dir: (Path, None), dest_path: (Path, None), cache_dir: (Path, None), retries: int = 10, profile_name: str = None) -> AWSS3DownloadStatus:
+
+def aws_s3_cache_manager(cache_dir: (Path, None) = None) -> CacheManager:
+    """
+    get the cache manager of the S3 download cache, e.g. to report (usage()) or trim (trim()) the cache
+    :param cache_dir: cache dir (None for the default S3 cache dir)
+    :return: CacheManager instance (one per cache dir and cache limits)
     """
-    download from AWS S3 with caching
+    if cache_dir is None:
+        cache_dir = _aws_s3_default_cache_dir()
+    key = (Path(cache_dir).absolute(), aws_s3_cache_max_bytes, aws_s3_cache_max_entries, aws_s3_cache_policy)
+    cache_manager = _aws_s3_cache_managers.get(key)
+    if cache_manager is None:
+        cache_manager = CacheManager(cache_dir, aws_s3_cache_max_bytes, aws_s3_cache_max_entries, aws_s3_cache_policy)
+        _aws_s3_cache_managers[key] = cache_manager
+    return cache_manager
+
+
+def aws_s3_set_cache_limits(max_bytes: (int, None), max_entries: (int, None) = None, policy: str = "lru"):
+    """
+    set the budget of the S3 download cache.  When set, aws_s3_download_cached() records accesses and evicts files to stay within the budget.
+    :param max_bytes: maximum total size of the cache (None for no limit)
+    :param max_entries: maximum number of cached objects (None for no limit)
+    :param policy: "lru" (least recently used) or "lfu" (least frequently used)
+    """
+    global aws_s3_cache_max_bytes, aws_s3_cache_max_entries, aws_s3_cache_policy
+    aws_s3_cache_max_bytes = max_bytes
+    aws_s3_cache_max_entries = max_entries
+    aws_s3_cache_policy = policy
+
+
+def _aws_s3_cache_lock_path(cache_path: Path) -> Path:
+    # the cache manager's lock for the entry, so the entry isn't evicted while it's being downloaded
+    return cache_entry_lock_path(cache_path.parent, cache_path.name)
+
+
+def _aws_s3_cache_metadata_path(cache_path: Path) -> Path:
+    return Path(f"{cache_path}.json")  # sidecar
+
+
+def _aws_s3_read_cache_metadata(cache_path: Path) -> (dict, None):
+    cache_metadata = None
+    cache_metadata_path = _aws_s3_cache_metadata_path(cache_path)
+    if cache_path.exists() and cache_metadata_path.exists():
+        try:
+            with open(cache_metadata_path) as f:
+                cache_metadata = json.load(f)
+        except (OSError, ValueError) as e:
+            log.info(f"{cache_metadata_path} : {e}")  # e.g. evicted
+    return cache_metadata
+
+
+def _aws_s3_write_cache_metadata(cache_path: Path, cache_metadata: dict):
+    _write_atomic(_aws_s3_cache_metadata_path(cache_path), lambda f: json.dump(cache_metadata, f, indent=4), "w")
+
+
+def aws_s3_download_cached(
+    s3_bucket: str,
+    s3_key: str,
+    dest_dir: (Path, None),
+    dest_path: (Path, None),
+    cache_dir: (Path, None),
+    retries: int = 10,
+    profile_name: str = None,
+    s3_size_mtime_hash: (tuple, None) = None,
+    link_mode: str = "copy",
+) -> AWSS3DownloadStatus:
+    """
+    download from AWS S3 with caching.  The cache is validated with the object's ETag (saved in a sidecar file when the object is downloaded) using a conditional
+    request, or, for cache entries without an ETag, with the object's size and mtime.
     :param s3_bucket: S3 bucket of source
     :param s3_key: S3 key of source
     :param dest_dir: destination directory.  If given, the destination full path is the dest_dir and s3_key (in this case s3_key must not have slashes).  If dest_dir is used,
@@ -180,6 +1084,9 @@ def aws_s3_download_cached(s3_bucket: str, s3_key: str, dest_dir: (Path, None),
     :param cache_dir: cache dir
     :param retries: number of times to retry the AWS S3 access
     :param profile_name: AWS profile name
+    :param s3_size_mtime_hash: the object's (size, mtime, hash) if already known (e.g. from aws_s3_get_size_mtime_hash_batch), otherwise None to get it
+    :param link_mode: how the destination is made from the cache: "copy", "hardlink", "reflink" or "symlink" (see link_or_copy).  Linking avoids writing the data
+                      twice, but the destination must then be treated as read-only, and a symlink dangles if the cache entry is evicted.
     :return: AWSS3DownloadStatus instance
     """
     status = AWSS3DownloadStatus()
@@ -200,78 +1107,771 @@ def aws_s3_download_cached(s3_bucket: str, s3_key: str, dest_dir: (Path, None),
             cache_file_name = get_string_sha512(f"{s3_bucket}{s3_key}")
 
             if cache_dir is None:
-                cache_dir = Path(user_cache_dir(__application_name__, __author__, "aws", "s3"))
+                cache_dir = _aws_s3_default_cache_dir()
             cache_path = Path(cache_dir, cache_file_name)
+            cache_manager = None
+            if aws_s3_cache_max_bytes is not None or aws_s3_cache_max_entries is not None:
+                cache_manager = aws_s3_cache_manager(cache_dir)
             log.debug(f"{cache_path}")
 
-            if cache_path.exists():
-                s3_size, s3_mtime, s3_hash = aws_s3_get_size_mtime_hash(s3_bucket, s3_key, profile_name)
-                local_size = os.path.getsize(cache_path)
-                local_mtime = os.path.getmtime(cache_path)
-
-                if local_size != s3_size:
+            # one metadata request both validates the cache and gets the metadata to give a newly cached file
+            cache_metadata = _aws_s3_read_cache_metadata(cache_path)
+            s3_version_id = None
+            if s3_size_mtime_hash is None:
+                if cache_metadata is None:
+                    response = _aws_s3_head_object(s3_bucket, s3_key, profile_name)
+                else:
+                    # conditional request - an unchanged object is just a 304 (Not Modified) response
+                    try:
+                        response = _aws_s3_head_object(s3_bucket, s3_key, profile_name, IfNoneMatch=f'"{cache_metadata["etag"]}"')
+                    except ClientError as e:
+                        if e.response.get("Error", {}).get("Code") != "304":
+                            raise
+                        response = {
+                            "ContentLength": cache_metadata["size"],
+                            "LastModified": datetime.fromtimestamp(cache_metadata["mtime"], timezone.utc),
+                            "ETag": f'"{cache_metadata["etag"]}"',
+                        }
+                s3_size_mtime_hash = _aws_s3_size_mtime_hash(response)
+                if response is not None:
+                    s3_version_id = response.get("VersionId")
+            s3_size, s3_mtime, s3_hash = s3_size_mtime_hash
+
+            if s3_size is None:
+                log.error(f"{s3_bucket}:{s3_key} does not exist")
+                status.cached = False
+            elif cache_path.exists():
+                try:
+                    cache_stat = os.stat(cache_path)
+                    local_size = cache_stat.st_size
+                    local_mtime = cache_stat.st_mtime
+                except FileNotFoundError:
+                    local_size = None  # evicted by another process
+                    local_mtime = None
+
+                if local_size is None:
+                    log.info(f"{s3_bucket}:{s3_key} cache miss: {cache_path} was evicted")
+                    status.cached = False
+                elif local_size != s3_size:
                     log.info(f"{s3_bucket}:{s3_key} cache miss: sizes differ {local_size=} {s3_size=}")
                     status.cached = False
                     status.sizes_differ = True
-                elif not isclose(local_mtime, s3_mtime, abs_tol=cache_abs_tol):
+                elif cache_metadata is not None and cache_metadata["etag"] != s3_hash:
+                    log.info(f"{s3_bucket}:{s3_key} cache miss: etags differ {cache_metadata['etag']=} {s3_hash=}")
+                    status.cached = False
+                    status.etags_differ = True
+                elif cache_metadata is None and not isclose(local_mtime, s3_mtime.timestamp(), abs_tol=cache_abs_tol):
                     log.info(f"{s3_bucket}:{s3_key} cache miss: mtimes differ {local_mtime=} {s3_mtime=}")
                     status.cached = False
                     status.mtimes_differ = True
                 else:
-                    status.cached = True
-                    status.success = True
-                    shutil.copy2(cache_path, dest_path)
+                    try:
+                        link_or_copy(cache_path, dest_path, link_mode)
+                        status.cached = True
+                        status.success = True
+                        if cache_manager is not None:
+                            cache_manager.touch(cache_file_name)
+                    except FileNotFoundError:
+                        log.info(f"{s3_bucket}:{s3_key} cache miss: {cache_path} was evicted")
+                        status.cached = False
             else:
                 status.cached = False
 
-            if not status.cached:
-                log.info(f"S3 download : {s3_bucket=},{s3_key=},{dest_path=}")
-                s3_client = aws_get_client("s3", profile_name)
-                transfer = S3Transfer(s3_client)
-
-                transfer_retry_count = 0
-
-                while not status.success and transfer_retry_count < retries:
+            if not status.cached and s3_size is not None:
+                # single flight - one process downloads into the cache while any others wait for it and then use what it downloaded
+                with FileLock(_aws_s3_cache_lock_path(cache_path)):
+                    cache_metadata = _aws_s3_read_cache_metadata(cache_path)
                     try:
-                        transfer.download_file(s3_bucket, s3_key, dest_path)
-                        shutil.copy2(dest_path, cache_path)
-                        status.success = True
-                    except ClientError as e:
-                        log.warning(f"{s3_bucket}:{s3_key} to {dest_path=} : {transfer_retry_count=} : {e}")
-                        transfer_retry_count += 1
-                        time.sleep(3.0)
+                        downloaded_by_other = cache_metadata is not None and cache_metadata["etag"] == s3_hash and os.path.getsize(cache_path) == s3_size
+                        if downloaded_by_other:
+                            link_or_copy(cache_path, dest_path, link_mode)
+                    except FileNotFoundError:
+                        downloaded_by_other = False  # evicted
+                    if downloaded_by_other:
+                        log.info(f"{s3_bucket}:{s3_key} : {cache_path} was downloaded by another process")
+                        status = AWSS3DownloadStatus(success=True, cached=True)
+                        if cache_manager is not None:
+                            cache_manager.touch(cache_file_name)
+                    else:
+                        log.info(f"S3 download : {s3_bucket=},{s3_key=},{dest_path=}")
+                        s3_client = _aws_get_client("s3", profile_name)
+                        transfer = S3Transfer(s3_client)
+
+                        try:
+                            # download directly into the cache (S3Transfer downloads to a temp file and renames it) and then make the destination from it
+                            mkdirs(cache_dir)
+                            _aws_retry_policy.call(lambda: transfer.download_file(s3_bucket, s3_key, str(cache_path)), retries + 1)
+                            if cache_manager is not None:
+                                # record the access before the mtime is set back to S3's, so the new file isn't indexed as the least recently used
+                                cache_manager.touch(cache_file_name)
+                            # give the cached file S3's mtime so the cache can be validated later
+                            os.utime(cache_path, (s3_mtime.timestamp(), s3_mtime.timestamp()))
+                            _aws_s3_write_cache_metadata(cache_path, {"etag": s3_hash, "version_id": s3_version_id, "size": s3_size, "mtime": s3_mtime.timestamp()})
+                            link_or_copy(cache_path, dest_path, link_mode)
+                            status.success = True
+                            if cache_manager is not None:
+                                cache_manager.trim()
+                        except _aws_retry_policy.retryable_exceptions + (ClientError, FileNotFoundError) as e:  # FileNotFoundError if evicted by another process
+                            log.warning(f"{s3_bucket}:{s3_key} to {dest_path=} : {e}")
 
     return status
 
 
-def aws_s3_read_string(s3_bucket_name: str, s3_key: str, profile_name: str) -> str:
+@dataclass
+class AWSS3BulkDownloadStatus:
+    statuses: list  # AWSS3DownloadStatus instances, in the same order as the objects
+    bytes_downloaded: int = 0
+    bytes_cached: int = 0
+    duration: float = 0.0  # seconds
+
+    def hit_rate(self) -> float:
+        return sum(1 for status in self.statuses if status.cached) / len(self.statuses) if len(self.statuses) > 0 else 0.0
+
+    def success(self) -> bool:
+        return all(status.success for status in self.statuses)
+
+
+def aws_s3_download_cached_bulk(
+    entries: (list, None) = None,
+    s3_bucket: (str, None) = None,
+    s3_prefix: (str, None) = None,
+    dest_dir: (Path, None) = None,
+    cache_dir: (Path, None) = None,
+    max_workers: int = 8,
+    retries: int = 10,
+    profile_name: str = None,
+    link_mode: str = "copy",
+    parallel_list: bool = False,
+) -> AWSS3BulkDownloadStatus:
+    """
+    download many objects from AWS S3 with caching (see aws_s3_download_cached).  Metadata is read in bulk and cache misses are downloaded concurrently.
+    :param entries: list of (s3_bucket, s3_key, dest_path) tuples.  If entries is used, do not pass in s3_bucket, s3_prefix or dest_dir.
+    :param s3_bucket: S3 bucket to download all objects under s3_prefix from
+    :param s3_prefix: S3 prefix to download all objects under
+    :param dest_dir: destination directory for s3_prefix objects (the key, relative to s3_prefix, is the path in dest_dir)
+    :param cache_dir: cache dir
+    :param max_workers: number of threads
+    :param retries: number of times to retry each AWS S3 access
+    :param profile_name: AWS profile name
+    :param link_mode: how destinations are made from the cache (see aws_s3_download_cached)
+    :param parallel_list: True to list s3_prefix's "directories" concurrently (see aws_s3_list_objects), for large trees
+    :return: AWSS3BulkDownloadStatus instance
+    """
+    if (entries is None and (s3_bucket is None or s3_prefix is None or dest_dir is None)) or (entries is not None and (s3_bucket, s3_prefix, dest_dir) != (None, None, None)):
+        log.error(f"pass in either entries or all of s3_bucket, s3_prefix and dest_dir : {entries is None=} {s3_bucket=} {s3_prefix=} {dest_dir=}")
+        return AWSS3BulkDownloadStatus([])
+
+    start = time.time()
+
+    s3_size_mtime_hashes = {}
+    if entries is None:
+        s3_size_mtime_hashes[s3_bucket] = _aws_s3_list_size_mtime_hash(s3_bucket, s3_prefix, profile_name, parallel=parallel_list)
+        entries = [(s3_bucket, s3_key, Path(dest_dir, s3_key[len(s3_prefix) :].lstrip("/"))) for s3_key in s3_size_mtime_hashes[s3_bucket] if not s3_key.endswith("/")]
+    else:
+        for bucket in {entry[0] for entry in entries}:
+            s3_size_mtime_hashes[bucket] = aws_s3_get_size_mtime_hash_batch(bucket, [entry[1] for entry in entries if entry[0] == bucket], profile_name, max_workers)
+
+    def download(entry: tuple) -> AWSS3DownloadStatus:
+        bucket, s3_key, dest_path = entry
+        mkdirs(os.path.dirname(os.path.abspath(dest_path)))
+        return aws_s3_download_cached(bucket, s3_key, None, Path(dest_path), cache_dir, retries, profile_name, s3_size_mtime_hashes[bucket][s3_key], link_mode)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        bulk_status = AWSS3BulkDownloadStatus(list(executor.map(download, entries)))
+
+    for entry, status in zip(entries, bulk_status.statuses):
+        size = s3_size_mtime_hashes[entry[0]][entry[1]][0]
+        if status.success and size is not None:
+            if status.cached:
+                bulk_status.bytes_cached += size
+            else:
+                bulk_status.bytes_downloaded += size
+    bulk_status.duration = time.time() - start
+    log.info(
+        f"downloaded {len(entries)} objects in {bulk_status.duration:.3f} seconds : {bulk_status.bytes_downloaded} bytes downloaded, {bulk_status.bytes_cached} bytes from cache, "
+        f"hit rate {bulk_status.hit_rate():.3f}"
+    )
+    return bulk_status
+
+
+@dataclass
+class AWSS3ReadCacheStats:
+    hits: int = 0
+    misses: int = 0
+    revalidations: int = 0  # hits on expired entries that were found to be unchanged with an ETag conditional request
+    evictions: int = 0
+    entries: int = 0
+    total_bytes: int = 0
+
+
+# in-memory cache of small objects read with aws_s3_read_string() and aws_s3_read_lines() (see aws_s3_set_read_cache)
+aws_s3_read_cache_max_bytes = 0  # 0 for no cache
+aws_s3_read_cache_ttl = 60.0  # seconds
+aws_s3_read_cache_max_object_bytes = 0
+
+_aws_s3_read_cache = OrderedDict()  # (bucket, key): (contents, ETag, time read or revalidated), least recently used first
+_aws_s3_read_cache_lock = threading.Lock()
+_aws_s3_read_cache_stats = AWSS3ReadCacheStats()
+
+
+def aws_s3_set_read_cache(max_bytes: int, ttl: float = 60.0, max_object_bytes: (int, None) = None):
+    """
+    set the budget of the in-memory read cache.  When set, aws_s3_read_string() and aws_s3_read_lines() return cached contents for up to ttl seconds, and
+    then revalidate them with a conditional (ETag) request.  Writes and deletes through sundry update or invalidate the cache, but changes made elsewhere are
+    only seen once an entry's TTL expires.
+    :param max_bytes: maximum total size of the cached objects (0 to disable and clear the cache)
+    :param ttl: seconds an entry is used before it is revalidated
+    :param max_object_bytes: largest object to cache (None for 1/8 of max_bytes)
+    """
+    global aws_s3_read_cache_max_bytes, aws_s3_read_cache_ttl, aws_s3_read_cache_max_object_bytes
+    aws_s3_read_cache_max_bytes = max_bytes
+    aws_s3_read_cache_ttl = ttl
+    aws_s3_read_cache_max_object_bytes = max_bytes // 8 if max_object_bytes is None else min(max_object_bytes, max_bytes)
+    _aws_s3_read_cache_trim()
+
+
+def aws_s3_read_cache_stats() -> AWSS3ReadCacheStats:
+    """
+    get the in-memory read cache's counters and usage
+    :return: AWSS3ReadCacheStats instance (a copy)
+    """
+    with _aws_s3_read_cache_lock:
+        return AWSS3ReadCacheStats(**vars(_aws_s3_read_cache_stats))
+
+
+def aws_s3_clear_read_cache():
+    """
+    remove all the entries from the in-memory read cache and reset its counters
+    """
+    global _aws_s3_read_cache_stats
+    with _aws_s3_read_cache_lock:
+        _aws_s3_read_cache.clear()
+        _aws_s3_read_cache_stats = AWSS3ReadCacheStats()
+
+
+def _aws_s3_read_cache_trim():
+    with _aws_s3_read_cache_lock:
+        while _aws_s3_read_cache_stats.total_bytes > aws_s3_read_cache_max_bytes:
+            _, (contents, _, _) = _aws_s3_read_cache.popitem(last=False)
+            _aws_s3_read_cache_stats.total_bytes -= len(contents)
+            _aws_s3_read_cache_stats.entries -= 1
+            _aws_s3_read_cache_stats.evictions += 1
+
+
+def _aws_s3_read_cache_invalidate(s3_bucket: str, s3_key: str):
+    # entries are per profile, but they all refer to the same object
+    with _aws_s3_read_cache_lock:
+        for cache_key in [k for k in _aws_s3_read_cache if k[1:] == (s3_bucket, s3_key)]:
+            entry = _aws_s3_read_cache.pop(cache_key)
+            _aws_s3_read_cache_stats.total_bytes -= len(entry[0])
+            _aws_s3_read_cache_stats.entries -= 1
+
+
+def _aws_s3_read_cache_put(s3_bucket: str, s3_key: str, profile_name: str, contents: bytes, etag: str):
+    _aws_s3_read_cache_invalidate(s3_bucket, s3_key)
+    if len(contents) <= aws_s3_read_cache_max_object_bytes:
+        with _aws_s3_read_cache_lock:
+            _aws_s3_read_cache[(profile_name, s3_bucket, s3_key)] = (contents, etag, time.monotonic())
+            _aws_s3_read_cache_stats.total_bytes += len(contents)
+            _aws_s3_read_cache_stats.entries += 1
+        _aws_s3_read_cache_trim()
+
+
+def _aws_s3_read_cached(s3_bucket: str, s3_key: str, profile_name: str, read_large: bool) -> (bytes, None):
+    """
+    read an object's contents through the in-memory read cache
+    :param read_large: True to read an object even if it is too large to cache, False to return None for it
+    :return: contents, or None if the object is too large to cache and read_large is False
+    """
+    cache_key = (profile_name, s3_bucket, s3_key)  # access can differ between profiles
+    with _aws_s3_read_cache_lock:
+        entry = _aws_s3_read_cache.get(cache_key)
+        if entry is not None:
+            _aws_s3_read_cache.move_to_end(cache_key)
+            if time.monotonic() - entry[2] < aws_s3_read_cache_ttl:
+                _aws_s3_read_cache_stats.hits += 1
+                return entry[0]
+
+    s3_client = _aws_get_client("s3", profile_name)
+    get_kwargs = {"Bucket": s3_bucket, "Key": s3_key}
+    if entry is not None:
+        get_kwargs["IfNoneMatch"] = entry[1]
+
+    def get_object() -> dict:
+        # get_object with the body read (or closed if it's too large), so a retry covers both the request and the read
+        response = s3_client.get_object(**get_kwargs)
+        if response["ContentLength"] > aws_s3_read_cache_max_object_bytes and not read_large:
+            response["Body"].close()
+            response["Body"] = None
+        else:
+            response["Body"] = response["Body"].read()
+        return response
+
+    try:
+        response = _aws_retry_policy.call(get_object)
+    except ClientError as e:
+        if entry is not None and e.response.get("Error", {}).get("Code") == "304":
+            # not modified - use the cached contents for another TTL
+            with _aws_s3_read_cache_lock:
+                _aws_s3_read_cache_stats.hits += 1
+                _aws_s3_read_cache_stats.revalidations += 1
+                if cache_key in _aws_s3_read_cache:
+                    _aws_s3_read_cache[cache_key] = (entry[0], entry[1], time.monotonic())
+            return entry[0]
+        _aws_s3_read_cache_invalidate(s3_bucket, s3_key)  # e.g. deleted
+        raise
+
+    with _aws_s3_read_cache_lock:
+        _aws_s3_read_cache_stats.misses += 1
+    contents = response["Body"]
+    if response["ContentLength"] > aws_s3_read_cache_max_object_bytes:
+        _aws_s3_read_cache_invalidate(s3_bucket, s3_key)
+    else:
+        _aws_s3_read_cache_put(s3_bucket, s3_key, profile_name, contents, response["ETag"])
+    return contents
+
+
+def aws_s3_read_string(s3_bucket_name: str, s3_key: str, profile_name: str, compression: (str, None) = None) -> str:
     log.debug(f"reading {s3_bucket_name}:{s3_key} as {profile_name}")
-    s3 = aws_get_resource("s3", profile_name)
-    return s3.Object(s3_bucket_name, s3_key).get()["Body"].read().decode()
+    _check_compression(compression)
+    if aws_s3_read_cache_max_bytes > 0:
+        input_str = b"".join(_iter_decompressed([_aws_s3_read_cached(s3_bucket_name, s3_key, profile_name, True)], compression)).decode()
+    elif compression is None:
+        s3 = _aws_get_resource("s3", profile_name)
+        input_str = _aws_retry_policy.call(lambda: s3.Object(s3_bucket_name, s3_key).get()["Body"].read()).decode()
+    else:
+        input_str = b"".join(aws_s3_iter_bytes(s3_bucket_name, s3_key, profile_name, compression)).decode()
+    return input_str
+
+
+s3_compressions = [None, "gzip", "bz2", "lzma"]
+
+
+def _check_compression(compression: (str, None)):
+    if compression not in s3_compressions:
+        raise ValueError(f"{compression=} is not one of {s3_compressions}")
+
+
+def _compressor(compression: str):
+    if compression == "gzip":
+        compressor = zlib.compressobj(wbits=31)  # gzip format
+    elif compression == "bz2":
+        compressor = bz2.BZ2Compressor()
+    else:
+        compressor = lzma.LZMACompressor()
+    return compressor
 
 
-def aws_s3_read_lines(s3_bucket_name: str, s3_key: str, profile_name: str) -> list:
-    return aws_s3_read_string(s3_bucket_name, s3_key, profile_name).splitlines()
+def _decompressor(compression: str):
+    if compression == "gzip":
+        decompressor = zlib.decompressobj(wbits=31)
+    elif compression == "bz2":
+        decompressor = bz2.BZ2Decompressor()
+    else:
+        decompressor = lzma.LZMADecompressor()
+    return decompressor
+
+
+def _iter_decompressed(chunks, compression: (str, None)):
+    # decompress on the fly, including concatenated streams (e.g. from "cat a.gz b.gz")
+    if compression is None:
+        yield from chunks
+    else:
+        decompressor = _decompressor(compression)
+        for chunk in chunks:
+            while len(chunk) > 0:
+                decompressed = decompressor.decompress(chunk)
+                if len(decompressed) > 0:
+                    yield decompressed
+                if decompressor.eof:
+                    chunk = decompressor.unused_data  # start of the next stream
+                    decompressor = _decompressor(compression)
+                else:
+                    chunk = b""
+
+
+s3_read_chunk_size = 1024 * 1024
+
+
+def _aws_s3_iter_chunks(s3_bucket_name: str, s3_key: str, profile_name: str, start: int = 0, chunk_size: int = s3_read_chunk_size):
+    """
+    stream an object's bytes, from a byte offset to the end.  If the connection is lost the stream is resumed from where it left off with a Range request
+    (see AWSRetryPolicy).
+    """
+    s3_client = _aws_get_client("s3", profile_name)
+    offset = start
+    etag = None
+    resume_offset = None
+    while True:
+        get_kwargs = {"Bucket": s3_bucket_name, "Key": s3_key}
+        if offset > 0:
+            get_kwargs["Range"] = f"bytes={offset}-"
+        if etag is not None:
+            get_kwargs["IfMatch"] = etag  # don't resume into a different version of the object
+        try:
+            response = _aws_retry_policy.call(lambda: s3_client.get_object(**get_kwargs))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "InvalidRange":
+                break  # start is at (or past) the end of the object
+            raise
+        etag = response["ETag"]
+        body = response["Body"]
+        try:
+            for chunk in body.iter_chunks(chunk_size):
+                offset += len(chunk)
+                yield chunk
+            break
+        except _aws_retry_policy.retryable_exceptions as e:
+            if offset != resume_offset:
+                # made progress since the last failure, so start over with the retries
+                resume_offset = offset
+                retry_start = time.monotonic()
+                attempt = 0
+            attempt += 1
+            if not _aws_retry_policy.backoff(attempt, retry_start):
+                raise
+            log.info(f"{s3_bucket_name}:{s3_key} : resuming at {offset} : {e}")
+        finally:
+            body.close()
+
+
+def aws_s3_iter_bytes(s3_bucket_name: str, s3_key: str, profile_name: str, compression: (str, None) = None, chunk_size: int = s3_read_chunk_size):
+    """
+    iterate over the contents of an S3 object without reading the whole object into memory, decompressing on the fly
+    :param s3_bucket_name: S3 bucket
+    :param s3_key: S3 key
+    :param profile_name: AWS profile
+    :param compression: None, "gzip", "bz2" or "lzma" (e.g. written with aws_s3_write_stream)
+    :param chunk_size: bytes per read
+    :return: generator of bytes
+    """
+    _check_compression(compression)
+    chunks = _aws_s3_iter_chunks(s3_bucket_name, s3_key, profile_name, chunk_size=chunk_size)
+    try:
+        yield from _iter_decompressed(chunks, compression)
+    finally:
+        chunks.close()  # closes the response body if we stopped early
+
+
+def _iter_decoded_lines(chunks, encoding: str):
+    # incrementally decode and split into lines with the same line boundaries as str.splitlines(), keeping only the current partial line in memory
+    decoder = codecs.getincrementaldecoder(encoding)()
+    partial_line = ""
+    for chunk in chunks:
+        lines = (partial_line + decoder.decode(chunk)).splitlines(keepends=True)
+        # the last line may be incomplete (or end in a "\r" whose "\n" is in the next chunk)
+        partial_line = lines.pop() if len(lines) > 0 else ""
+        for line in lines:
+            yield line.splitlines()[0]
+    yield from (partial_line + decoder.decode(b"", final=True)).splitlines()
+
+
+def aws_s3_iter_lines(
+    s3_bucket_name: str,
+    s3_key: str,
+    profile_name: str,
+    start_line: int = 0,
+    end_line: (int, None) = None,
+    encoding: str = "utf-8",
+    chunk_size: int = s3_read_chunk_size,
+    compression: (str, None) = None,
+):
+    """
+    iterate over the lines of an S3 object without reading the whole object into memory.  The object is streamed and decoded incrementally, and the download stops
+    once end_line is reached.  Small objects are read through the in-memory read cache when it is enabled (see aws_s3_set_read_cache).
+    :param s3_bucket_name: S3 bucket
+    :param s3_key: S3 key
+    :param profile_name: AWS profile
+    :param start_line: first line (0 based)
+    :param end_line: line to stop before (None for all the lines)
+    :param encoding: text encoding
+    :param chunk_size: bytes per read
+    :param compression: None, "gzip", "bz2" or "lzma" (e.g. written with aws_s3_write_lines)
+    :return: generator of lines (without line endings, as with str.splitlines())
+    """
+    log.debug(f"streaming lines of {s3_bucket_name}:{s3_key} as {profile_name}")
+    contents = None
+    if aws_s3_read_cache_max_bytes > 0:
+        contents = _aws_s3_read_cached(s3_bucket_name, s3_key, profile_name, False)
+    if contents is None:
+        chunks = aws_s3_iter_bytes(s3_bucket_name, s3_key, profile_name, compression, chunk_size)
+    else:
+        _check_compression(compression)
+        chunks = _iter_decompressed([contents], compression)
+    try:
+        yield from itertools.islice(_iter_decoded_lines(chunks, encoding), start_line, end_line)
+    finally:
+        chunks.close()  # closes the response body if we stopped early
+
+
+def aws_s3_read_lines(s3_bucket_name: str, s3_key: str, profile_name: str, start_line: int = 0, end_line: (int, None) = None, compression: (str, None) = None) -> list:
+    return list(aws_s3_iter_lines(s3_bucket_name, s3_key, profile_name, start_line, end_line, compression=compression))
 
 
-def aws_s3_write_string(input_str: str, s3_bucket_name: str, s3_key: str, profile_name: str):
+def _aws_s3_get_object_bytes(s3_client, **kwargs) -> dict:
+    # get_object with the body read, so a retry covers both the request and the read
+    response = s3_client.get_object(**kwargs)
+    response["Body"] = response["Body"].read()
+    return response
+
+
+def aws_s3_tail_lines(s3_bucket_name: str, s3_key: str, profile_name: str, line_count: int, encoding: str = "utf-8", chunk_size: int = 64 * 1024) -> list:
+    """
+    read the last lines of an S3 object (e.g. a log) with Range requests, reading backwards from the end of the object only as far as needed.  Lines must end
+    with "\n" or "\r\n", and the encoding must not use the "\n" byte within multibyte characters (e.g. UTF-8 or ASCII, but not UTF-16).
+    :param s3_bucket_name: S3 bucket
+    :param s3_key: S3 key
+    :param profile_name: AWS profile
+    :param line_count: number of lines
+    :param encoding: text encoding
+    :param chunk_size: bytes per Range request
+    :return: list of the last line_count lines (without line endings)
+    """
+    s3_client = _aws_get_client("s3", profile_name)
+    tail = b""
+    start = None  # offset of tail in the object
+    etag = None
+    while line_count > 0 and start != 0:
+        if start is None:
+            get_kwargs = {"Range": f"bytes=-{chunk_size}"}
+        else:
+            get_kwargs = {"Range": f"bytes={max(0, start - chunk_size)}-{start - 1}", "IfMatch": etag}
+        try:
+            response = _aws_retry_policy.call(lambda: _aws_s3_get_object_bytes(s3_client, Bucket=s3_bucket_name, Key=s3_key, **get_kwargs))
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") == "InvalidRange":
+                break  # empty object
+            raise
+        etag = response["ETag"]
+        tail = response["Body"] + tail
+        # ContentRange is "bytes <first>-<last>/<size>"
+        start = int(response["ContentRange"].split(" ")[1].split("-")[0]) if "ContentRange" in response else 0
+        # a trailing newline doesn't start a line, and the first (possibly partial) line is discarded unless it is the start of the object
+        if tail.rstrip(b"\n").count(b"\n") >= line_count:
+            break
+
+    if start is not None and start > 0:
+        tail = tail[tail.index(b"\n") + 1 :]  # discard the partial line
+    lines = tail.decode(encoding).splitlines()
+    return lines[max(0, len(lines) - line_count) :] if line_count > 0 else []
+
+
+def aws_s3_write_string(input_str: str, s3_bucket_name: str, s3_key: str, profile_name: str, compression: (str, None) = None):
     log.debug(f"writing {s3_bucket_name}:{s3_key} as {profile_name}")
-    s3 = aws_get_resource("s3", profile_name)
-    s3.Object(s3_bucket_name, s3_key).put(Body=input_str)
+    if compression is None:
+        s3 = _aws_get_resource("s3", profile_name)
+        response = _aws_retry_policy.call(lambda: s3.Object(s3_bucket_name, s3_key).put(Body=input_str))
+        if aws_s3_read_cache_max_bytes > 0:
+            _aws_s3_read_cache_put(s3_bucket_name, s3_key, profile_name, input_str.encode(), response["ETag"])  # write through
+    else:
+        aws_s3_write_stream([input_str], s3_bucket_name, s3_key, profile_name, compression)
+
+
+def _iter_joined_lines(input_lines):
+    # "\n".join() without making the whole string
+    for line_number, line in enumerate(input_lines):
+        yield line if line_number == 0 else f"\n{line}"
+
+
+def aws_s3_write_lines(input_lines, s3_bucket_name: str, s3_key: str, profile_name: str, compression: (str, None) = None):
+    """
+    write lines to S3, streaming them (see aws_s3_write_stream) so a large iterable of lines (e.g. a generator) is never all in memory
+    :param input_lines: iterable of lines (without line endings)
+    :param s3_bucket_name: S3 bucket
+    :param s3_key: S3 key
+    :param profile_name: AWS profile
+    :param compression: None, "gzip", "bz2" or "lzma"
+    """
+    aws_s3_write_stream(_iter_joined_lines(input_lines), s3_bucket_name, s3_key, profile_name, compression)
 
 
-def aws_s3_write_lines(input_lines: list, s3_bucket_name: str, s3_key: str, profile_name: str):
-    aws_s3_write_string("\n".join(input_lines), s3_bucket_name, s3_key, profile_name)
+s3_multipart_part_size = 8 * 1024 * 1024  # S3 requires at least 5 MiB for all but the last part
+
+
+def aws_s3_write_stream(
+    input_chunks, s3_bucket_name: str, s3_key: str, profile_name: str, compression: (str, None) = None, part_size: int = s3_multipart_part_size, max_in_flight: int = 4
+) -> int:
+    """
+    stream data to an S3 object as a multipart upload, compressing on the fly.  At most (max_in_flight + 1) parts are in memory at a time.  Data smaller than one
+    part is written with a single put.
+    :param input_chunks: iterable of str (UTF-8 encoded) and/or bytes
+    :param s3_bucket_name: S3 bucket
+    :param s3_key: S3 key
+    :param profile_name: AWS profile
+    :param compression: None, "gzip", "bz2" or "lzma" (read with e.g. aws_s3_iter_lines with the same compression)
+    :param part_size: bytes per part
+    :param max_in_flight: maximum number of parts being uploaded at a time
+    :return: number of bytes written to S3 (after compression)
+    """
+    _check_compression(compression)
+    log.debug(f"streaming to {s3_bucket_name}:{s3_key} as {profile_name} : {compression=}")
+    _aws_s3_read_cache_invalidate(s3_bucket_name, s3_key)
+    s3_client = _aws_get_client("s3", profile_name, max_pool_connections=max(max_in_flight, aws_max_pool_connections))
+    compressor = None if compression is None else _compressor(compression)
+
+    def iter_output():
+        for chunk in input_chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode()
+            yield chunk if compressor is None else compressor.compress(chunk)
+        if compressor is not None:
+            yield compressor.flush()
+
+    upload_id = None
+    parts = []
+    futures = {}
+    buffer = bytearray()
+    byte_count = 0
+
+    def upload_part(part_number: int, part: bytes) -> dict:
+        response = _aws_retry_policy.call(lambda: s3_client.upload_part(Bucket=s3_bucket_name, Key=s3_key, UploadId=upload_id, PartNumber=part_number, Body=part))
+        return {"PartNumber": part_number, "ETag": response["ETag"]}
+
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        try:
+            for output in itertools.chain(iter_output(), [None]):
+                if output is not None:
+                    buffer.extend(output)
+                    byte_count += len(output)
+                # send full parts, and whatever is left at the end if this is a multipart upload
+                while len(buffer) >= part_size or (output is None and len(buffer) > 0 and upload_id is not None):
+                    if upload_id is None:
+                        upload_id = _aws_retry_policy.call(lambda: s3_client.create_multipart_upload(Bucket=s3_bucket_name, Key=s3_key))["UploadId"]
+                    if len(futures) >= max_in_flight:
+                        done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                        for future in done:
+                            parts.append(future.result())
+                            del futures[future]
+                    part_number = len(parts) + len(futures) + 1
+                    futures[executor.submit(upload_part, part_number, bytes(buffer[:part_size]))] = part_number
+                    del buffer[:part_size]
+            for future in futures:
+                parts.append(future.result())
+        except BaseException:
+            if upload_id is not None:
+                for future in futures:
+                    future.cancel()
+                wait(futures)
+                _aws_retry_policy.call(lambda: s3_client.abort_multipart_upload(Bucket=s3_bucket_name, Key=s3_key, UploadId=upload_id))
+            raise
+
+    if upload_id is None:
+        _aws_retry_policy.call(lambda: s3_client.put_object(Bucket=s3_bucket_name, Key=s3_key, Body=bytes(buffer)))
+    else:
+        parts.sort(key=lambda part: part["PartNumber"])
+        _aws_retry_policy.call(lambda: s3_client.complete_multipart_upload(Bucket=s3_bucket_name, Key=s3_key, UploadId=upload_id, MultipartUpload={"Parts": parts}))
+    log.info(f"wrote {byte_count} bytes to {s3_bucket_name}:{s3_key} in {max(1, len(parts))} parts")
+    return byte_count
 
 
 def aws_s3_delete(s3_bucket_name: str, s3_key: str, profile_name: str):
     log.debug(f"deleting {s3_bucket_name}:{s3_key} as {profile_name}")
-    s3 = aws_get_resource("s3", profile_name)
-    s3.Object(s3_bucket_name, s3_key).delete()
+    s3 = _aws_get_resource("s3", profile_name)
+    _aws_retry_policy.call(lambda: s3.Object(s3_bucket_name, s3_key).delete())
+    _aws_s3_read_cache_invalidate(s3_bucket_name, s3_key)
+
+
+s3_delete_objects_size = 1000  # DeleteObjects maximum
 
 
-def aws_s3_upload(file_path: (str, Path), s3_bucket: str, s3_key: str, profile_name: str, force=False):
-    # todo: test if file already has been uploaded (using a hash)
+def _aws_s3_delete_objects(s3_bucket: str, s3_keys: list, profile_name: str, max_pool_connections: int) -> dict:
+    """
+    delete up to s3_delete_objects_size objects with one DeleteObjects request, retrying keys that failed with a retryable error (e.g. SlowDown)
+    :return: dict of S3 key: error message for the keys that could not be deleted
+    """
+    s3_client = _aws_get_client("s3", profile_name, max_pool_connections=max_pool_connections)
+    start = time.monotonic()
+    attempt = 0
+    while True:
+        objects = [{"Key": s3_key} for s3_key in s3_keys]
+        try:
+            response = _aws_retry_policy.call(lambda: s3_client.delete_objects(Bucket=s3_bucket, Delete={"Objects": objects, "Quiet": True}))
+        except ClientError as e:
+            return {s3_key: str(e) for s3_key in s3_keys}  # e.g. AccessDenied for the whole request
+        errors = {error["Key"]: error for error in response.get("Errors", [])}
+        s3_keys = [s3_key for s3_key, error in errors.items() if error.get("Code") in _aws_retry_policy.retryable_error_codes]
+        attempt += 1
+        if len(s3_keys) == 0 or not _aws_retry_policy.backoff(attempt, start):
+            break
+    return {s3_key: f'{error.get("Code")} : {error.get("Message")}' for s3_key, error in errors.items()}
+
+
+def aws_s3_delete_batch(s3_bucket: str, s3_keys: list, profile_name: str, max_workers: int = 8) -> dict:
+    """
+    delete many S3 objects with DeleteObjects requests of up to 1000 keys each, several requests at a time.  Keys that do not exist are not errors.
+    :param s3_bucket: S3 bucket
+    :param s3_keys: S3 keys
+    :param profile_name: AWS profile
+    :param max_workers: maximum number of concurrent requests
+    :return: dict of S3 key: error message for the keys that could not be deleted (empty if all were deleted)
+    """
+    s3_keys = list(dict.fromkeys(s3_keys))  # a key can only be in a request once
+    for s3_key in s3_keys:
+        _aws_s3_read_cache_invalidate(s3_bucket, s3_key)
+    batches = [s3_keys[index : index + s3_delete_objects_size] for index in range(0, len(s3_keys), s3_delete_objects_size)]
+    max_pool_connections = max(max_workers, aws_max_pool_connections)
+    errors = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for batch_errors in executor.map(lambda batch: _aws_s3_delete_objects(s3_bucket, batch, profile_name, max_pool_connections), batches):
+            errors.update(batch_errors)
+    log.info(f"{s3_bucket} : deleted {len(s3_keys) - len(errors)} objects ({len(errors)} errors)")
+    return errors
+
+
+def _aws_s3_upload_transfer_config(transfer_config: (TransferConfig, None), file_size: int) -> TransferConfig:
+    # S3 parts must be at least 5 MiB (other than the last) and there can be at most 10,000 of them, so the part size is adjusted for the file
+    upload_transfer_config = copy.copy(TransferConfig() if transfer_config is None else transfer_config)
+    upload_transfer_config.multipart_chunksize = ChunksizeAdjuster().adjust_chunksize(upload_transfer_config.multipart_chunksize, file_size)
+    return upload_transfer_config
+
+
+def aws_s3_get_file_etag(file_path: (str, Path), transfer_config: (TransferConfig, None) = None) -> str:
+    """
+    calculate the ETag that S3 gives a file uploaded with S3Transfer (e.g. with aws_s3_upload).  Files at or above the multipart threshold are uploaded in parts,
+    and their ETag is the MD5 of the parts' MD5s followed by "-" and the number of parts.
+    :param file_path: local file path
+    :param transfer_config: the TransferConfig the file is (or was) uploaded with (None for the default).  Its chunk size is adjusted to S3's part size limits,
+                            as it is for aws_s3_upload and aws_s3_sync_upload.
+    :return: ETag (without quotes)
+    """
+    file_size = os.path.getsize(file_path)
+    transfer_config = _aws_s3_upload_transfer_config(transfer_config, file_size)
+    if file_size < transfer_config.multipart_threshold:
+        etag = get_file_md5(file_path)
+    else:
+        part_size = transfer_config.multipart_chunksize
+        bucket_size = 1024 * 1024
+        part_md5s = []
+        with open(file_path, "rb") as f:
+            part_remaining = 0
+            while True:
+                if part_remaining == 0:
+                    part_hash = hashlib.md5()
+                    part_remaining = part_size
+                val = f.read(min(bucket_size, part_remaining))
+                if len(val) == 0:
+                    break
+                part_hash.update(val)
+                part_remaining -= len(val)
+                if part_remaining == 0:
+                    part_md5s.append(part_hash.digest())
+        if part_remaining != part_size:
+            part_md5s.append(part_hash.digest())  # last (partial) part
+        etag = f"{hashlib.md5(b''.join(part_md5s)).hexdigest().lower()}-{len(part_md5s)}"
+    return etag
+
+
+def aws_s3_upload(file_path: (str, Path), s3_bucket: str, s3_key: str, profile_name: str, force=False, transfer_config: (TransferConfig, None) = None):
+    """
+    upload a file to AWS S3, unless it has already been uploaded
+    :param file_path: local file path
+    :param s3_bucket: the S3 bucket
+    :param s3_key: the S3 object key
+    :param profile_name: AWS profile
+    :param force: True to upload even if S3 already has the same file
+    :param transfer_config: S3Transfer's TransferConfig (multipart threshold, chunk size and concurrency), None for the default
+    :return: True if uploaded
+    """
     log.info(f"S3 upload : file_path={file_path} : bucket={s3_bucket} : key={s3_key}")
 
     uploaded_flag = False
@@ -282,30 +1882,141 @@ def aws_s3_upload(file_path: (str, Path), s3_bucket: str, s3_key: str, profile_n
     if isinstance(file_path, Path):
         file_path = str(file_path)
 
-    file_md5 = get_file_md5(file_path)
-    _, _, s3_md5 = aws_s3_get_size_mtime_hash(s3_bucket, s3_key, profile_name)
+    _, _, s3_etag = aws_s3_get_size_mtime_hash(s3_bucket, s3_key, profile_name)
+    if s3_etag is None or force:
+        file_etag = None  # no need to hash the file
+    else:
+        file_etag = aws_s3_get_file_etag(file_path, transfer_config)
 
-    if file_md5 != s3_md5 or force:
-        log.info(f"file hash of local file is {file_md5} and the S3 etag is {s3_md5} , force={force} - uploading")
-        s3_client = aws_get_client("s3", profile_name)
-        transfer = S3Transfer(s3_client)
+    if s3_etag is None or file_etag != s3_etag or force:
+        log.info(f"file hash of local file is {file_etag} and the S3 etag is {s3_etag} , force={force} - uploading")
+        s3_client = _aws_get_client("s3", profile_name)
+        transfer = S3Transfer(s3_client, _aws_s3_upload_transfer_config(transfer_config, os.path.getsize(file_path)))
 
-        transfer_retry_count = 0
-        while not uploaded_flag and transfer_retry_count < 10:
-            try:
-                transfer.upload_file(file_path, s3_bucket, s3_key)
-                uploaded_flag = True
-            except S3UploadFailedError as e:
-                log.warning(f"{file_path} to {s3_bucket}:{s3_key} : {transfer_retry_count=} : {e}")
-                transfer_retry_count += 1
-                time.sleep(1.0)
+        try:
+            _aws_retry_policy.call(lambda: transfer.upload_file(file_path, s3_bucket, s3_key))
+            _aws_s3_read_cache_invalidate(s3_bucket, s3_key)
+            uploaded_flag = True
+        except _aws_retry_policy.retryable_exceptions as e:
+            log.warning(f"{file_path} to {s3_bucket}:{s3_key} : {e}")
 
     else:
-        log.info(f"file hash of {file_md5} is the same as is already on S3 and force={force} - not uploading")
+        log.info(f"file hash of {file_etag} is the same as is already on S3 and force={force} - not uploading")
 
     return uploaded_flag
 
 
+@dataclass
+class AWSS3SyncStatus:
+    uploaded: list = field(default_factory=list)  # S3 keys
+    unchanged: int = 0
+    deleted: list = field(default_factory=list)  # S3 keys of remote orphans
+    failed: dict = field(default_factory=dict)  # S3 key: error
+    duration: float = 0.0  # seconds
+
+    def success(self) -> bool:
+        return len(self.failed) == 0
+
+
+def aws_s3_sync_upload(
+    local_dir: (str, Path),
+    s3_bucket: str,
+    s3_prefix: str,
+    profile_name: str,
+    manifest_path: (str, Path, None) = None,
+    delete_orphans: bool = False,
+    max_workers: int = 8,
+    transfer_config: (TransferConfig, None) = None,
+    parallel_list: bool = False,
+) -> AWSS3SyncStatus:
+    """
+    sync a local directory tree up to an S3 prefix, uploading only new and changed files.  The remote prefix is listed once and the files' hashes are
+    kept in a local manifest so that unchanged files (same size and mtime) are not re-hashed.
+    :param local_dir: local directory
+    :param s3_bucket: the S3 bucket
+    :param s3_prefix: S3 prefix (a file's key is the prefix and the file's path relative to local_dir)
+    :param profile_name: AWS profile
+    :param manifest_path: manifest file path (None for one in the user's cache dir)
+    :param delete_orphans: True to delete objects under the prefix that are not in the local directory
+    :param max_workers: number of files to upload at once
+    :param transfer_config: S3Transfer's TransferConfig (None for the default)
+    :param parallel_list: True to list the prefix's "directories" concurrently (see aws_s3_list_objects), for large trees
+    :return: AWSS3SyncStatus instance
+    """
+    start = time.time()
+    status = AWSS3SyncStatus()
+    local_dir = Path(local_dir)
+    s3_prefix = s3_prefix.rstrip("/") + "/" if len(s3_prefix) > 0 else ""
+
+    if manifest_path is None:
+        manifest_path = Path(user_cache_dir(__application_name__, __author__, "aws", "s3_sync"), get_string_sha512(f"{local_dir.absolute()}{s3_bucket}{s3_prefix}"))
+    manifest_path = Path(manifest_path)
+    manifest = {}
+    if manifest_path.exists():
+        try:
+            with open(manifest_path) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            log.warning(f"{manifest_path} : {e}")
+
+    remote_size_mtime_hashes = _aws_s3_list_size_mtime_hash(s3_bucket, s3_prefix, profile_name, parallel=parallel_list)
+
+    new_manifest = {}
+    to_upload = []
+    for file_path in sorted(p for p in local_dir.rglob("*") if p.is_file()):
+        relative_path = file_path.relative_to(local_dir).as_posix()
+        file_stat = file_path.stat()
+        manifest_entry = manifest.get(relative_path)
+        if manifest_entry is not None and manifest_entry["size"] == file_stat.st_size and manifest_entry["mtime"] == file_stat.st_mtime:
+            etag = manifest_entry["etag"]
+        else:
+            etag = aws_s3_get_file_etag(file_path, transfer_config)
+        new_manifest[relative_path] = {"size": file_stat.st_size, "mtime": file_stat.st_mtime, "etag": etag}
+        s3_key = f"{s3_prefix}{relative_path}"
+        if remote_size_mtime_hashes.get(s3_key, (None, None, None))[2] == etag:
+            status.unchanged += 1
+        else:
+            to_upload.append((file_path, s3_key))
+
+    s3_client = _aws_get_client("s3", profile_name, max_pool_connections=max(max_workers, aws_max_pool_connections))
+
+    def upload(file_path_s3_key: tuple) -> (str, None):
+        file_path, s3_key = file_path_s3_key
+        transfer = S3Transfer(s3_client, _aws_s3_upload_transfer_config(transfer_config, file_path.stat().st_size))
+        try:
+            _aws_retry_policy.call(lambda: transfer.upload_file(str(file_path), s3_bucket, s3_key))
+            _aws_s3_read_cache_invalidate(s3_bucket, s3_key)
+            error = None
+        except _aws_retry_policy.retryable_exceptions + (ClientError,) as e:
+            log.warning(f"{file_path} to {s3_bucket}:{s3_key} : {e}")
+            error = str(e)
+        return error
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for (file_path, s3_key), error in zip(to_upload, executor.map(upload, to_upload)):
+            if error is None:
+                status.uploaded.append(s3_key)
+            else:
+                status.failed[s3_key] = error
+                del new_manifest[file_path.relative_to(local_dir).as_posix()]
+
+    if delete_orphans:
+        orphans = sorted(set(remote_size_mtime_hashes) - {f"{s3_prefix}{relative_path}" for relative_path in new_manifest} - set(status.failed))
+        errors = aws_s3_delete_batch(s3_bucket, orphans, profile_name, max_workers)
+        status.failed.update(errors)
+        status.deleted = [s3_key for s3_key in orphans if s3_key not in errors]
+
+    mkdirs(str(manifest_path.parent))
+    _write_atomic(manifest_path, lambda f: json.dump(new_manifest, f), "w")
+
+    status.duration = time.time() - start
+    log.info(
+        f"sync {local_dir} to {s3_bucket}:{s3_prefix} : {len(status.uploaded)} uploaded, {status.unchanged} unchanged, {len(status.deleted)} deleted, "
+        f"{len(status.failed)} failed, {status.duration:.3f} seconds"
+    )
+    return status
+
+
 def aws_s3_download(file_path: (str, Path), s3_bucket: str, s3_key: str, profile_name: str) -> bool:
 
     if isinstance(file_path, str):
@@ -315,41 +2026,330 @@ def aws_s3_download(file_path: (str, Path), s3_bucket: str, s3_key: str, profile
         file_path = str(file_path)
 
     log.info(f"S3 download : file_path={file_path} : bucket={s3_bucket} : key={s3_key}")
-    s3_client = aws_get_client("s3", profile_name)
+    s3_client = _aws_get_client("s3", profile_name)
     transfer = S3Transfer(s3_client)
 
-    transfer_retry_count = 0
+    try:
+        _aws_retry_policy.call(lambda: transfer.download_file(s3_bucket, s3_key, file_path))
+        success = True
+    except _aws_retry_policy.retryable_exceptions + (ClientError,) as e:
+        log.warning(f"{s3_bucket}:{s3_key} to {file_path} : {e}")
+        success = False
+    return success
+
+
+s3_ranged_part_size = 8 * 1024 * 1024  # same as the S3Transfer default chunk size
+
+
+def _aws_s3_ranged_read_into(buffer, s3_bucket: str, s3_key: str, profile_name: str, head_object_response: dict, part_size: int, max_workers: int) -> bool:
+    """
+    read an object into a buffer (e.g. an mmap) of the object's size with concurrent Range requests, and verify it against the object's ETag
+    :return: True if the contents match the ETag (or the ETag is not an MD5 and can not be verified)
+    """
+    size = head_object_response["ContentLength"]
+    etag = head_object_response["ETag"]  # with quotes
+    etag_value = etag[1:-1].lower()
+
+    multipart = "-" in etag_value
+    if multipart:
+        # use the object's part size so each range is one part, and the part MD5s give the multipart ETag
+        part_count = int(etag_value.split("-")[1])
+        part_size = _aws_s3_head_object(s3_bucket, s3_key, profile_name, PartNumber=1)["ContentLength"]
+        if not (part_count - 1) * part_size < size <= part_count * part_size:
+            multipart = False  # parts of different sizes - can't be verified with the ranges we use
+            part_size = s3_ranged_part_size
+    ranges = [(start, min(start + part_size, size)) for start in range(0, size, part_size)]
+
+    s3_client = _aws_get_client("s3", profile_name, max_pool_connections=max(max_workers, aws_max_pool_connections))
+
+    def read_range(start: int, end: int) -> bytes:
+        # a retry re-reads the whole range into place
+        response = s3_client.get_object(Bucket=s3_bucket, Key=s3_key, Range=f"bytes={start}-{end - 1}", IfMatch=etag)
+        md5 = hashlib.md5()
+        position = start
+        for chunk in response["Body"].iter_chunks(1024 * 1024):
+            buffer[position : position + len(chunk)] = chunk
+            md5.update(chunk)
+            position += len(chunk)
+        if position != end:
+            raise ResponseStreamingError(error=f"{s3_bucket}:{s3_key} : read {position - start} bytes of range {start}-{end - 1}")
+        return md5.digest()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        part_md5s = list(executor.map(lambda start_end: _aws_retry_policy.call(lambda: read_range(*start_end)), ranges))
+
+    if head_object_response.get("ServerSideEncryption") == "aws:kms" or head_object_response.get("SSECustomerAlgorithm") is not None:
+        verified = True  # the ETag of an object encrypted with SSE-KMS or SSE-C is not an MD5 of its contents
+    elif multipart:
+        verified = f"{hashlib.md5(b''.join(part_md5s)).hexdigest()}-{len(part_md5s)}" == etag_value
+    elif "-" in etag_value:
+        verified = True
+        log.info(f"{s3_bucket}:{s3_key} : can not verify {etag_value=}")
+    else:
+        verified = hashlib.md5(buffer).hexdigest() == etag_value
+    if not verified:
+        log.warning(f"{s3_bucket}:{s3_key} : contents do not match {etag_value=}")
+    return verified
+
+
+def aws_s3_download_ranged(file_path: (str, Path), s3_bucket: str, s3_key: str, profile_name: str, max_workers: int = 8, part_size: int = s3_ranged_part_size) -> bool:
+    """
+    download a (large) S3 object with concurrent Range requests written directly into place in a preallocated, memory mapped file.  The file is verified against
+    the object's ETag.
+    :param file_path: destination file path
+    :param s3_bucket: S3 bucket
+    :param s3_key: S3 key
+    :param profile_name: AWS profile
+    :param max_workers: maximum number of concurrent Range requests
+    :param part_size: bytes per Range request (multipart objects are read one part per request)
+    :return: True if the object was downloaded and verified
+    """
+    log.info(f"S3 ranged download : {file_path=} : bucket={s3_bucket} : key={s3_key}")
+    head_object_response = _aws_s3_head_object(s3_bucket, s3_key, profile_name)
+    if head_object_response is None:
+        log.warning(f"{s3_bucket}:{s3_key} does not exist")
+        return False
+
+    # write to a temp file and then rename it so a partial download is never seen at file_path (the temp file is unique so concurrent downloads of the same
+    # file don't write into each other's temp file)
+    temp_fd, temp_file_path = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(file_path)), prefix=f"{os.path.basename(file_path)}.", suffix=".temp")
+    temp_path = Path(temp_file_path)
+    size = head_object_response["ContentLength"]
     success = False
-    while not success and transfer_retry_count < 10:
-        try:
-            transfer.download_file(s3_bucket, s3_key, file_path)
-            success = True
-        except ClientError as e:
-            log.warning(f"{s3_bucket}:{s3_key} to {file_path} : {transfer_retry_count=} : {e}")
-            transfer_retry_count += 1
-            time.sleep(1.0)
+    try:
+        with os.fdopen(temp_fd, "wb+") as f:
+            if size > 0:
+                if hasattr(os, "posix_fallocate"):
+                    os.posix_fallocate(f.fileno(), 0, size)
+                else:
+                    f.truncate(size)
+                with mmap.mmap(f.fileno(), size) as file_map:
+                    success = _aws_s3_ranged_read_into(file_map, s3_bucket, s3_key, profile_name, head_object_response, part_size, max_workers)
+            else:
+                success = True
+        if success:
+            os.replace(temp_path, file_path)
+    except _aws_retry_policy.retryable_exceptions + (ClientError,) as e:
+        log.warning(f"{s3_bucket}:{s3_key} to {file_path} : {e}")
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
     return success
 
 
-def aws_s3_get_size_mtime_hash(s3_bucket: str, s3_key: str, profile_name: str):
-    s3_resource = aws_get_resource("s3", profile_name)
-    bucket_resource = s3_resource.Bucket(s3_bucket)
-
-    # determine if the object exists before we try to get the info
-    objs = list(bucket_resource.objects.filter(Prefix=s3_key))
-    if len(objs) > 0 and objs[0].key == s3_key:
-        bucket_object = bucket_resource.Object(s3_key)
-        object_size = bucket_object.content_length
-        object_mtime = bucket_object.last_modified
-        object_hash = bucket_object.e_tag[1:-1].lower()
+def aws_s3_read_bytes(s3_bucket: str, s3_key: str, profile_name: str, max_workers: int = 8, part_size: int = s3_ranged_part_size) -> (memoryview, None):
+    """
+    read a (large) S3 object into memory with concurrent Range requests written directly into place in an anonymous memory map, and verify it against the
+    object's ETag.
+    :param s3_bucket: S3 bucket
+    :param s3_key: S3 key
+    :param profile_name: AWS profile
+    :param max_workers: maximum number of concurrent Range requests
+    :param part_size: bytes per Range request (multipart objects are read one part per request)
+    :return: a memoryview of the object's contents (no copy is made), or None if the object does not exist, could not be read or does not match its ETag
+    """
+    head_object_response = _aws_s3_head_object(s3_bucket, s3_key, profile_name)
+    contents = None
+    if head_object_response is None:
+        log.warning(f"{s3_bucket}:{s3_key} does not exist")
+    elif head_object_response["ContentLength"] == 0:
+        contents = memoryview(b"")  # can't memory map 0 bytes
     else:
-        object_size = None
-        object_mtime = None
-        object_hash = None  # does not exist
+        memory_map = mmap.mmap(-1, head_object_response["ContentLength"])
+        try:
+            if _aws_s3_ranged_read_into(memory_map, s3_bucket, s3_key, profile_name, head_object_response, part_size, max_workers):
+                contents = memoryview(memory_map)  # keeps the memory map alive
+        except _aws_retry_policy.retryable_exceptions + (ClientError,) as e:
+            log.warning(f"{s3_bucket}:{s3_key} : {e}")
+        if contents is None:
+            memory_map.close()
+    return contents
+
+
+def _aws_s3_head_object(s3_bucket: str, s3_key: str, profile_name: str, **kwargs) -> (dict, None):
+    """
+    get an object's metadata with a single HEAD request
+    :return: head_object response, or None if the object does not exist
+    """
+    s3_client = _aws_get_client("s3", profile_name)
+    try:
+        response = _aws_retry_policy.call(lambda: s3_client.head_object(Bucket=s3_bucket, Key=s3_key, **kwargs))
+    except ClientError as e:
+        if e.response.get("Error", {}).get("Code") in ["404", "NoSuchKey", "NotFound"]:
+            response = None
+        else:
+            raise
+    return response
+
+
+def _aws_s3_size_mtime_hash(head_object_response: (dict, None)) -> tuple:
+    if head_object_response is None:
+        size_mtime_hash = (None, None, None)  # does not exist
+    else:
+        size_mtime_hash = (head_object_response["ContentLength"], head_object_response["LastModified"], head_object_response["ETag"][1:-1].lower())
+    return size_mtime_hash
+
+
+def aws_s3_get_size_mtime_hash(s3_bucket: str, s3_key: str, profile_name: str):
+    """
+    get an S3 object's size, mtime and hash (ETag)
+    :param s3_bucket: the S3 bucket
+    :param s3_key: the S3 object key
+    :param profile_name: AWS profile
+    :return: size, mtime (datetime) and hash of the object (all None if the object does not exist)
+    """
+    object_size, object_mtime, object_hash = _aws_s3_size_mtime_hash(_aws_s3_head_object(s3_bucket, s3_key, profile_name))
     log.debug(f"size : {object_size} ,  mtime : {object_mtime} , hash : {object_hash}")
     return object_size, object_mtime, object_hash
 
 
+def _aws_s3_iter_list_pages(s3_client, s3_bucket: str, s3_prefix: str, delimiter: (str, None)):
+    # list_objects_v2 pages, each request retried on its own (unlike with a paginator, which can't be resumed after an error)
+    list_kwargs = {"Bucket": s3_bucket, "Prefix": s3_prefix}
+    if delimiter is not None:
+        list_kwargs["Delimiter"] = delimiter
+    while True:
+        response = _aws_retry_policy.call(lambda: s3_client.list_objects_v2(**list_kwargs))
+        yield response
+        if not response.get("IsTruncated"):
+            break
+        list_kwargs["ContinuationToken"] = response["NextContinuationToken"]
+
+
+def _aws_s3_object_records(list_response: dict) -> list:
+    return [(s3_object["Key"], s3_object["Size"], s3_object["LastModified"], s3_object["ETag"][1:-1].lower()) for s3_object in list_response.get("Contents", [])]
+
+
+def _aws_s3_list_objects_parallel(s3_client, s3_bucket: str, s3_prefix: str, max_workers: int):
+    # list each "directory" on its own thread, adding a task for each sub-directory that is found
+    records_queue = queue.Queue(maxsize=4 * max_workers)  # (records, exception, done)
+    stop = threading.Event()
+    lock = threading.Lock()
+    submitted = 1
+
+    def put(entry: tuple):
+        while not stop.is_set():
+            try:
+                records_queue.put(entry, timeout=1.0)
+                break
+            except queue.Full:
+                pass
+
+    def list_directory(directory: str):
+        nonlocal submitted
+        try:
+            for response in _aws_s3_iter_list_pages(s3_client, s3_bucket, directory, "/"):
+                if stop.is_set():
+                    break  # don't request any more pages
+                for common_prefix in response.get("CommonPrefixes", []):
+                    with lock:
+                        submitted += 1
+                    executor.submit(list_directory, common_prefix["Prefix"])
+                put((_aws_s3_object_records(response), None, False))
+        except Exception as e:
+            put(([], e, False))
+        finally:
+            put(([], None, True))
+
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        executor.submit(list_directory, s3_prefix)
+        done = 0
+        while True:
+            with lock:
+                if done == submitted:
+                    break  # a directory's sub-directories are submitted before it is done, so everything has been listed
+            records, exception, directory_done = records_queue.get()
+            if exception is not None:
+                raise exception
+            yield from records
+            if directory_done:
+                done += 1
+    finally:
+        stop.set()  # e.g. the caller stopped early
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def aws_s3_list_objects(s3_bucket: str, s3_prefix: str, profile_name: str, recursive: bool = True, parallel: bool = False, max_workers: int = 8):
+    """
+    list the objects under a prefix, lazily (one list_objects_v2 page at a time) so prefixes with millions of objects are never all in memory
+    :param s3_bucket: S3 bucket
+    :param s3_prefix: S3 key prefix ("" for the entire bucket)
+    :param profile_name: AWS profile
+    :param recursive: True to list all the objects under the prefix, False for only those directly under it (not under a further "/")
+    :param parallel: True to list each "directory" (sub-prefix ending in "/") concurrently, for large trees.  Objects are then not in key order.
+    :param max_workers: maximum number of concurrent requests when parallel is True
+    :return: generator of (key, size, mtime, ETag) tuples
+    """
+    s3_client = _aws_get_client("s3", profile_name, max_pool_connections=max(max_workers, aws_max_pool_connections))
+    if parallel and recursive:
+        yield from _aws_s3_list_objects_parallel(s3_client, s3_bucket, s3_prefix, max_workers)
+    else:
+        for response in _aws_s3_iter_list_pages(s3_client, s3_bucket, s3_prefix, None if recursive else "/"):
+            yield from _aws_s3_object_records(response)
+
+
+def _aws_s3_list_size_mtime_hash(s3_bucket: str, s3_prefix: str, profile_name: str, recursive: bool = True, parallel: bool = False) -> dict:
+    return {s3_key: (size, mtime, etag) for s3_key, size, mtime, etag in aws_s3_list_objects(s3_bucket, s3_prefix, profile_name, recursive, parallel)}
+
+
+def _aws_s3_key_before(s3_key: str) -> str:
+    # a key that sorts just before s3_key (S3 lists keys in UTF-8 byte order, which is the same as code point order), for a listing's StartAfter
+    last_code_point = ord(s3_key[-1]) - 1
+    if last_code_point < 0:
+        return s3_key[:-1]
+    if 0xD800 <= last_code_point <= 0xDFFF:
+        last_code_point = 0xD7FF  # surrogates can't be encoded
+    return s3_key[:-1] + chr(last_code_point)
+
+
+def aws_s3_get_size_mtime_hash_batch(s3_bucket: str, s3_keys: list, profile_name: str, max_workers: int = 8) -> dict:
+    """
+    get the size, mtime and hash (ETag) of many S3 objects, with a bounded listing per "directory" (prefix up to the last "/") of the keys instead of one request
+    per key.  Each list request starts just before the first key that has not been found yet and the listing stops once it is past the last key.  A key that is
+    alone in its directory, and the rest of a directory's keys once a list request finds none of them (i.e. they are sparse), are read with HEAD requests, so
+    there is at most one more request than with a HEAD per key.
+    :param s3_bucket: the S3 bucket
+    :param s3_keys: S3 object keys
+    :param profile_name: AWS profile
+    :param max_workers: maximum number of concurrent requests
+    :return: dict of S3 key to (size, mtime, hash) tuples (all None for objects that do not exist)
+    """
+    s3_client = _aws_get_client("s3", profile_name, max_pool_connections=max(max_workers, aws_max_pool_connections))
+    directories = {}
+    for s3_key in s3_keys:
+        directories.setdefault(s3_key[: s3_key.rfind("/") + 1], set()).add(s3_key)
+
+    def directory_size_mtime_hashes(directory_s3_keys: tuple) -> dict:
+        directory, directory_keys = directory_s3_keys
+        sorted_keys = sorted(directory_keys)
+        directory_results = {s3_key: (None, None, None) for s3_key in sorted_keys}
+        key_index = 0  # keys before this have been found or passed by the listing
+        while len(sorted_keys) - key_index > 1:
+            list_kwargs = {"Bucket": s3_bucket, "Prefix": directory, "Delimiter": "/", "StartAfter": _aws_s3_key_before(sorted_keys[key_index])}
+            response = _aws_retry_policy.call(lambda: s3_client.list_objects_v2(**list_kwargs))
+            for s3_key, size, mtime, etag in _aws_s3_object_records(response):
+                if s3_key in directory_results:
+                    directory_results[s3_key] = (size, mtime, etag)
+            if not response.get("IsTruncated"):
+                return directory_results
+            listed_up_to = max([s3_object["Key"] for s3_object in response.get("Contents", [])] + [common_prefix["Prefix"] for common_prefix in response.get("CommonPrefixes", [])])
+            previous_key_index = key_index
+            while key_index < len(sorted_keys) and sorted_keys[key_index] <= listed_up_to:
+                key_index += 1
+            if key_index == previous_key_index:
+                break  # the keys are sparse
+        for s3_key in sorted_keys[key_index:]:
+            directory_results[s3_key] = aws_s3_get_size_mtime_hash(s3_bucket, s3_key, profile_name)
+        return directory_results
+
+    size_mtime_hashes = {}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        for directory_result in executor.map(directory_size_mtime_hashes, directories.items()):
+            size_mtime_hashes.update(directory_result)
+    return size_mtime_hashes
+
+
 def aws_s3_object_exists(s3_bucket: str, s3_key: str, profile_name: str) -> bool:
     """
     determine if an s3 object exists
@@ -358,9 +2358,21 @@ def aws_s3_object_exists(s3_bucket: str, s3_key: str, profile_name: str) -> bool
     :param profile_name: AWS profile
     :return: True if object exists
     """
-    s3_resource = aws_get_resource("s3", profile_name)
-    bucket_resource = s3_resource.Bucket(s3_bucket)
-    objs = list(bucket_resource.objects.filter(Prefix=s3_key))
-    object_exists = len(objs) > 0 and objs[0].key == s3_key
+    object_exists = _aws_s3_head_object(s3_bucket, s3_key, profile_name) is not None
     log.debug(f"{s3_bucket}:{s3_key} : object_exists={object_exists}")
     return object_exists
+
+
+def aws_s3_objects_exist(s3_bucket: str, s3_keys: list, profile_name: str, max_workers: int = 8) -> dict:
+    """
+    determine if many S3 objects exist, with a bounded listing per "directory" of the keys instead of one request per key (see aws_s3_get_size_mtime_hash_batch)
+    :param s3_bucket: the S3 bucket
+    :param s3_keys: S3 object keys
+    :param profile_name: AWS profile
+    :param max_workers: maximum number of concurrent requests
+    :return: dict of S3 key: True if the object exists
+    """
+    size_mtime_hashes = aws_s3_get_size_mtime_hash_batch(s3_bucket, s3_keys, profile_name, max_workers)
+    objects_exist = {s3_key: size_mtime_hash[0] is not None for s3_key, size_mtime_hash in size_mtime_hashes.items()}
+    log.debug(f"{s3_bucket} : {sum(objects_exist.values())} of {len(objects_exist)} objects exist")
+    return objects_exist
@@ -0,0 +1,179 @@
+import os
+import time
+import sqlite3
+import logging
+from pathlib import Path
+from dataclasses import dataclass
+from contextlib import contextmanager
+
+from sundry import __title__, FileLock
+
+log = logging.getLogger(__title__)
+
+cache_manager_index_file_name = "cache_index.sqlite"
+cache_manager_policies = ["lru", "lfu"]
+cache_manager_locks_dir_name = "locks"
+
+
+def cache_entry_lock_path(cache_dir: (str, Path), name: str) -> Path:
+    """
+    get the path of a cache entry's lock file.  A FileLock held on it (e.g. while the entry is being written) keeps the cache manager from evicting the entry.
+    :param cache_dir: cache directory
+    :param name: file name in the cache directory
+    :return: lock file path (in a subdirectory, so the lock file itself is never evicted)
+    """
+    return Path(cache_dir, cache_manager_locks_dir_name, f"{name}.lock")
+
+
+@dataclass
+class CacheUsage:
+    total_bytes: int = 0
+    entries: int = 0
+
+
+class CacheManager:
+    """
+    Keeps a directory of cached files within a byte and/or entry budget by evicting the least recently used (LRU) or least frequently used (LFU) files.
+
+    The size, last access time and access count of each file are kept in a small SQLite index in the cache directory, which several processes can
+    safely share.  Files added to the directory without the cache manager are picked up (with their mtime as their last access) by usage(), by an instance's
+    first trim(), and by trim() when the indexed files are over budget.
+    Cache file names must not contain a "." since files with a suffix are treated as sidecars of the cache file with the same stem.
+    A file that is evicted while another process has it open is only removed if the OS allows it, so readers should treat a missing file as a cache miss.
+    A file whose entry lock (see cache_entry_lock_path) is held is not evicted.
+    """
+
+    def __init__(self, cache_dir: (str, Path), max_bytes: (int, None) = None, max_entries: (int, None) = None, policy: str = "lru"):
+        """
+        :param cache_dir: cache directory
+        :param max_bytes: maximum total size of the cached files (None for no limit)
+        :param max_entries: maximum number of cached files (None for no limit)
+        :param policy: "lru" (least recently used) or "lfu" (least frequently used)
+        """
+        if policy not in cache_manager_policies:
+            raise ValueError(f"{policy=} is not one of {cache_manager_policies}")
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.policy = policy
+        self._synced = False  # the index has been synced with the directory (e.g. a cache that was filled before a budget was set)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with self._connect() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS entries (name TEXT PRIMARY KEY, size INTEGER, last_access REAL, access_count INTEGER)")
+
+    @contextmanager
+    def _connect(self):
+        # a generous timeout since other processes may be updating the index
+        connection = sqlite3.connect(Path(self.cache_dir, cache_manager_index_file_name), timeout=60.0)
+        try:
+            with connection:
+                yield connection  # commits on exit
+        finally:
+            connection.close()
+
+    def touch(self, name: str):
+        """
+        record an access of a cached file (call after a cache hit or after adding a file to the cache)
+        :param name: file name in the cache directory
+        """
+        file_path = Path(self.cache_dir, name)
+        if file_path.exists():
+            with self._connect() as connection:
+                connection.execute(
+                    "INSERT INTO entries VALUES (?, ?, ?, 1) ON CONFLICT(name) DO UPDATE SET size=excluded.size, last_access=excluded.last_access, access_count=access_count+1",
+                    (name, file_path.stat().st_size, time.time()),
+                )
+
+    def remove(self, name: str) -> bool:
+        """
+        remove a file (and any of its sidecar files, e.g. "<name>.json") from the cache
+        :param name: file name in the cache directory
+        :return: True if removed
+        """
+        removed = True
+        try:
+            with FileLock(cache_entry_lock_path(self.cache_dir, name), timeout=0.0):
+                for file_path in [Path(self.cache_dir, name)] + list(self.cache_dir.glob(f"{name}.*")):
+                    try:
+                        file_path.unlink()
+                    except FileNotFoundError:
+                        pass
+                    except PermissionError as e:
+                        log.info(f"can not remove {file_path} : {e}")  # e.g. open by another process on Windows
+                        removed = False
+        except TimeoutError:
+            log.info(f"not removing {name} since it is locked (e.g. being written)")
+            removed = False
+        if removed:
+            with self._connect() as connection:
+                connection.execute("DELETE FROM entries WHERE name=?", (name,))
+        return removed
+
+    def _sync(self, connection):
+        # add files that are not in the index and remove index entries for files that no longer exist
+        indexed_names = {row[0] for row in connection.execute("SELECT name FROM entries")}
+        file_names = set()
+        for entry in os.scandir(self.cache_dir):
+            # sidecar files (those with a suffix) are accounted for with their cache file
+            if entry.is_file() and "." not in entry.name:
+                file_names.add(entry.name)
+                if entry.name not in indexed_names:
+                    stat = entry.stat()
+                    connection.execute("INSERT OR IGNORE INTO entries VALUES (?, ?, ?, 0)", (entry.name, stat.st_size, stat.st_mtime))
+        connection.executemany("DELETE FROM entries WHERE name=?", [(name,) for name in indexed_names - file_names])
+
+    @staticmethod
+    def _indexed_usage(connection) -> CacheUsage:
+        total_bytes, entries = connection.execute("SELECT COALESCE(SUM(size), 0), COUNT(*) FROM entries").fetchone()
+        return CacheUsage(total_bytes, entries)
+
+    def usage(self) -> CacheUsage:
+        """
+        get the cache's current usage
+        :return: CacheUsage instance
+        """
+        with self._connect() as connection:
+            self._sync(connection)
+            usage = self._indexed_usage(connection)
+        self._synced = True
+        return usage
+
+    def trim(self, max_bytes: (int, None) = None, max_entries: (int, None) = None) -> CacheUsage:
+        """
+        evict files until the cache is within budget
+        :param max_bytes: maximum total size (None for this cache manager's max_bytes)
+        :param max_entries: maximum number of files (None for this cache manager's max_entries)
+        :return: CacheUsage of what was evicted
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_entries is None:
+            max_entries = self.max_entries
+
+        def over_budget(usage: CacheUsage) -> bool:
+            return (max_bytes is not None and usage.total_bytes > max_bytes) or (max_entries is not None and usage.entries > max_entries)
+
+        evicted = CacheUsage()
+        candidates = []
+        # after the first trim the budget is checked with the index alone, so the directory is only scanned (and the candidates fetched) when files need to
+        # be evicted
+        with self._connect() as connection:
+            usage = self._indexed_usage(connection)
+            if over_budget(usage) or not self._synced:
+                self._sync(connection)
+                self._synced = True
+                usage = self._indexed_usage(connection)
+                if over_budget(usage):
+                    order = "last_access" if self.policy == "lru" else "access_count, last_access"
+                    candidates = connection.execute(f"SELECT name, size FROM entries ORDER BY {order}").fetchall()
+        for name, size in candidates:
+            if not over_budget(usage):
+                break
+            if self.remove(name):
+                usage.total_bytes -= size
+                usage.entries -= 1
+                evicted.total_bytes += size
+                evicted.entries += 1
+        if evicted.entries > 0:
+            log.info(f"{self.cache_dir} : evicted {evicted.entries} files ({evicted.total_bytes} bytes)")
+        return evicted
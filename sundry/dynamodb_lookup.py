@@ -0,0 +1,109 @@
+import logging
+
+from sundry import __title__
+
+log = logging.getLogger(__title__)
+
+
+class DynamoDBLookupTable:
+    """
+    in-memory lookup of DynamoDB items (e.g. from a table scan) by primary key, with optional secondary indexes on other attributes.
+
+    To keep the memory footprint low, items are not kept as dicts.  Each item is stored as a tuple of its values along with a reference to a shared
+    tuple of its attribute names (items usually have only a few distinct sets of attribute names).
+    """
+
+    def __init__(self, items, key_attributes: list, index_attributes: (list, None) = None):
+        """
+        :param items: iterable of items
+        :param key_attributes: the table's primary key attribute name(s) (see aws_dynamodb_get_key_attributes)
+        :param index_attributes: attribute names to create secondary indexes for (see find())
+        """
+        self.key_attributes = list(key_attributes)
+        self.index_attributes = [] if index_attributes is None else list(index_attributes)
+
+        self._attribute_names = {}  # interned attribute name tuples
+        self._rows = []
+        self._key_index = {}
+        self._indexes = {attribute_name: {} for attribute_name in self.index_attributes}
+
+        for item in items:
+            attribute_names = tuple(item.keys())
+            attribute_names = self._attribute_names.setdefault(attribute_names, attribute_names)
+            row = (attribute_names, tuple(item.values()))
+            key = tuple(item.get(k) for k in self.key_attributes)
+            row_number = self._key_index.get(key)
+            if row_number is None:
+                row_number = len(self._rows)
+                self._rows.append(row)
+                self._key_index[key] = row_number
+            else:
+                # the later item replaces the earlier one, including in the secondary indexes
+                log.warning(f"duplicate key {key}")
+                self._update_indexes(self._to_item(row_number), row_number, add=False)
+                self._rows[row_number] = row
+            self._update_indexes(item, row_number, add=True)
+
+    def __len__(self):
+        return len(self._key_index)
+
+    def __iter__(self):
+        for row_number in self._key_index.values():
+            yield self._to_item(row_number)
+
+    def __contains__(self, key):
+        return self._to_key(key) in self._key_index
+
+    def get(self, key, default=None) -> (dict, None):
+        """
+        get an item by its primary key
+        :param key: dict of the key attribute(s), a tuple of key values in key_attributes order, or the key value for a table with only a partition key
+        :param default: returned if the item is not in the table
+        :return: the item
+        """
+        row_number = self._key_index.get(self._to_key(key))
+        if row_number is None:
+            item = default
+        else:
+            item = self._to_item(row_number)
+        return item
+
+    def find(self, attribute_name: str, value) -> list:
+        """
+        find items by the value of an indexed attribute
+        :param attribute_name: attribute name (must be one of the index_attributes)
+        :param value: attribute value
+        :return: list of matching items
+        """
+        try:
+            row_numbers = self._indexes[attribute_name].get(value, [])
+        except TypeError:
+            row_numbers = []  # unhashable values are not indexed
+        return [self._to_item(row_number) for row_number in row_numbers]
+
+    def _update_indexes(self, item: dict, row_number: int, add: bool):
+        for attribute_name, index in self._indexes.items():
+            if attribute_name in item:
+                try:
+                    if add:
+                        index.setdefault(item[attribute_name], []).append(row_number)
+                    else:
+                        row_numbers = index[item[attribute_name]]
+                        row_numbers.remove(row_number)
+                        if len(row_numbers) == 0:
+                            del index[item[attribute_name]]
+                except TypeError:
+                    pass  # unhashable values (lists, maps and sets) can't be indexed
+
+    def _to_key(self, key) -> tuple:
+        if isinstance(key, dict):
+            key = tuple(key.get(k) for k in self.key_attributes)
+        elif isinstance(key, list):
+            key = tuple(key)
+        elif not isinstance(key, tuple):
+            key = (key,)
+        return key
+
+    def _to_item(self, row_number: int) -> dict:
+        attribute_names, values = self._rows[row_number]
+        return dict(zip(attribute_names, values))
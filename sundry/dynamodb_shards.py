@@ -0,0 +1,288 @@
+import os
+import json
+import mmap
+import zlib
+import lzma
+import uuid
+import base64
+import shutil
+import logging
+import tempfile
+from pathlib import Path
+from math import ceil
+
+from boto3.dynamodb.types import TypeSerializer, TypeDeserializer
+
+from sundry import __title__, FileLock
+
+# A sharded, lazily loaded on-disk store of DynamoDB items.  Unlike pickle it is safe to load from an untrusted source.
+#
+# <cache_path>/
+#     index.json                      format, the current data directory, key attribute names, compression, shard and item counts
+#     index.lock                      taken briefly when a reader registers and when a new version is swapped in
+#     data_<id>/                      one directory per version of the cache (each write makes a new version)
+#         shard_00000.data            items in DynamoDB JSON (e.g. {"N": "1.5"}), each item optionally compressed
+#         shard_00000.index.json      primary key -> [offset, length] of the item in the shard's data file
+#         readers/<id>.lock           held by each open DynamoDBShardedCache, so the version is not removed while it is being read
+#
+# Items are assigned to shards by a hash of their primary key, so a lookup only reads one shard index and one item.  Data files are memory mapped.
+# Shards are loaded lazily, so an open cache keeps reading its own version even after a newer version is written.
+
+log = logging.getLogger(__title__)
+
+dynamodb_shards_version = 2
+dynamodb_shards_index_file_name = "index.json"
+dynamodb_shards_lock_file_name = "index.lock"
+dynamodb_shards_data_prefix = "data_"
+dynamodb_shards_readers_dir_name = "readers"
+dynamodb_shards_compressions = [None, "zlib", "lzma"]
+
+_type_serializer = TypeSerializer()
+_type_deserializer = TypeDeserializer()
+
+
+def _to_json_able(attribute_value):
+    # DynamoDB JSON is all JSON types except binary
+    if isinstance(attribute_value, dict):
+        json_able = {}
+        for k, v in attribute_value.items():
+            if k == "B":
+                json_able[k] = base64.b64encode(bytes(v)).decode()
+            elif k == "BS":
+                json_able[k] = [base64.b64encode(bytes(b)).decode() for b in v]
+            else:
+                json_able[k] = _to_json_able(v)
+    elif isinstance(attribute_value, list):
+        json_able = [_to_json_able(v) for v in attribute_value]
+    else:
+        json_able = attribute_value
+    return json_able
+
+
+def _from_json_able(json_able):
+    if isinstance(json_able, dict):
+        attribute_value = {}
+        for k, v in json_able.items():
+            if k == "B":
+                attribute_value[k] = base64.b64decode(v)
+            elif k == "BS":
+                attribute_value[k] = [base64.b64decode(b) for b in v]
+            else:
+                attribute_value[k] = _from_json_able(v)
+    elif isinstance(json_able, list):
+        attribute_value = [_from_json_able(v) for v in json_able]
+    else:
+        attribute_value = json_able
+    return attribute_value
+
+
+def _encode_item(item: dict, compression: (str, None)) -> bytes:
+    item_bytes = json.dumps({k: _to_json_able(_type_serializer.serialize(v)) for k, v in item.items()}, separators=(",", ":")).encode()
+    if compression == "zlib":
+        item_bytes = zlib.compress(item_bytes)
+    elif compression == "lzma":
+        item_bytes = lzma.compress(item_bytes)
+    return item_bytes
+
+
+def _decode_item(item_bytes: bytes, compression: (str, None)) -> dict:
+    if compression == "zlib":
+        item_bytes = zlib.decompress(item_bytes)
+    elif compression == "lzma":
+        item_bytes = lzma.decompress(item_bytes)
+    return {k: _type_deserializer.deserialize(_from_json_able(v)) for k, v in json.loads(item_bytes).items()}
+
+
+def _key_string(key_values: (list, tuple)) -> str:
+    return json.dumps([_to_json_able(_type_serializer.serialize(v)) for v in key_values], separators=(",", ":"))
+
+
+def _shard_name(shard_number: int) -> str:
+    return f"shard_{shard_number:05d}"
+
+
+class DynamoDBShardedCache:
+    """
+    read-only access to DynamoDB items written with write_dynamodb_shards().  Only the index file is read when opened - shards are loaded when first accessed.
+    """
+
+    def __init__(self, cache_path: (str, Path)):
+        self.cache_path = Path(cache_path)
+        # register as a reader of the current version so it isn't removed while this instance is open
+        with FileLock(Path(self.cache_path, dynamodb_shards_lock_file_name)):
+            with open(Path(self.cache_path, dynamodb_shards_index_file_name)) as f:
+                index = json.load(f)
+            if index["version"] != dynamodb_shards_version:
+                raise ValueError(f"{self.cache_path} : unsupported version {index['version']}")
+            self.data_path = Path(self.cache_path, index["data"])
+            self._reader_lock = FileLock(Path(self.data_path, dynamodb_shards_readers_dir_name, f"{uuid.uuid4().hex}.lock"))
+            self._reader_lock.acquire()
+        self.key_attributes = index["key_attributes"]
+        self.compression = index["compression"]
+        self.shard_count = index["shard_count"]
+        self.item_count = index["item_count"]
+        self._shard_indexes = {}
+        self._shard_files = {}
+        self._shard_maps = {}
+
+    def __len__(self):
+        return self.item_count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        for shard_number in range(self.shard_count):
+            shard_index = self._get_shard_index(shard_number)
+            shard_map = self._get_shard_map(shard_number)
+            for offset, length in shard_index.values():
+                yield _decode_item(shard_map[offset : offset + length], self.compression)
+
+    def __contains__(self, key):
+        key_string = self._key_string(key)
+        return key_string in self._get_shard_index(self._shard_number(key_string))
+
+    def close(self):
+        for shard_map in self._shard_maps.values():
+            if isinstance(shard_map, mmap.mmap):
+                shard_map.close()
+        for shard_file in self._shard_files.values():
+            shard_file.close()
+        self._shard_maps = {}
+        self._shard_files = {}
+        if self._reader_lock is not None:
+            self._reader_lock.release()
+            try:
+                self._reader_lock.lock_path.unlink()
+            except OSError:
+                pass  # e.g. already removed
+            self._reader_lock = None
+
+    def get(self, key, default=None) -> (dict, None):
+        """
+        get an item by its primary key
+        :param key: dict of the key attribute(s) (e.g. an item), or a tuple of key values in key_attributes order
+        :param default: returned if the item is not in the cache
+        :return: the item
+        """
+        key_string = self._key_string(key)
+        shard_number = self._shard_number(key_string)
+        location = self._get_shard_index(shard_number).get(key_string)
+        if location is None:
+            item = default
+        else:
+            offset, length = location
+            item = _decode_item(self._get_shard_map(shard_number)[offset : offset + length], self.compression)
+        return item
+
+    def _key_string(self, key) -> str:
+        if isinstance(key, dict):
+            key = [key[k] for k in self.key_attributes]
+        elif not isinstance(key, (list, tuple)):
+            key = [key]
+        return _key_string(key)
+
+    def _shard_number(self, key_string: str) -> int:
+        return zlib.crc32(key_string.encode()) % self.shard_count
+
+    def _get_shard_index(self, shard_number: int) -> dict:
+        shard_index = self._shard_indexes.get(shard_number)
+        if shard_index is None:
+            with open(Path(self.data_path, f"{_shard_name(shard_number)}.index.json")) as f:
+                shard_index = json.load(f)
+            self._shard_indexes[shard_number] = shard_index
+        return shard_index
+
+    def _get_shard_map(self, shard_number: int):
+        shard_map = self._shard_maps.get(shard_number)
+        if shard_map is None:
+            shard_file = open(Path(self.data_path, f"{_shard_name(shard_number)}.data"), "rb")
+            if os.fstat(shard_file.fileno()).st_size == 0:
+                shard_map = b""  # can't memory map an empty file
+                shard_file.close()
+            else:
+                shard_map = mmap.mmap(shard_file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._shard_files[shard_number] = shard_file
+            self._shard_maps[shard_number] = shard_map
+        return shard_map
+
+
+def _is_version_in_use(data_path: Path) -> bool:
+    # a version is in use if any of its reader locks are held (a lock that can be taken was left by a reader that exited without closing)
+    in_use = False
+    for reader_lock_path in Path(data_path, dynamodb_shards_readers_dir_name).glob("*.lock"):
+        try:
+            with FileLock(reader_lock_path, timeout=0.0):
+                pass
+            reader_lock_path.unlink()
+        except TimeoutError:
+            in_use = True
+        except OSError:
+            pass  # removed by its reader
+    return in_use
+
+
+def write_dynamodb_shards(cache_path: (str, Path), items, key_attributes: list, items_per_shard: int = 10000, compression: (str, None) = None) -> DynamoDBShardedCache:
+    """
+    write DynamoDB items (e.g. from a table scan) to a sharded cache.  An existing cache at cache_path is replaced with a new version, and older versions are
+    removed once no DynamoDBShardedCache has them open.
+    :param cache_path: cache directory
+    :param items: list of items
+    :param key_attributes: the table's primary key attribute name(s) (see aws_dynamodb_get_key_attributes)
+    :param items_per_shard: approximate number of items per shard
+    :param compression: None, "zlib" or "lzma"
+    :return: a DynamoDBShardedCache instance of the written cache
+    """
+
+    if compression not in dynamodb_shards_compressions:
+        raise ValueError(f"{compression=} is not one of {dynamodb_shards_compressions}")
+
+    cache_path = Path(cache_path)
+    items = list(items)
+    shard_count = max(1, ceil(len(items) / items_per_shard))
+
+    # write a new version that no reader knows about until the index points to it
+    data_name = f"{dynamodb_shards_data_prefix}{uuid.uuid4().hex}"
+    data_path = Path(cache_path, data_name)
+    data_path.mkdir(parents=True)
+
+    shard_indexes = [{} for _ in range(shard_count)]
+    shard_files = [open(Path(data_path, f"{_shard_name(shard_number)}.data"), "wb") for shard_number in range(shard_count)]
+    try:
+        for item in items:
+            key_string = _key_string([item[k] for k in key_attributes])
+            shard_number = zlib.crc32(key_string.encode()) % shard_count
+            item_bytes = _encode_item(item, compression)
+            shard_indexes[shard_number][key_string] = [shard_files[shard_number].tell(), len(item_bytes)]
+            shard_files[shard_number].write(item_bytes)
+    finally:
+        for shard_file in shard_files:
+            shard_file.close()
+
+    for shard_number, shard_index in enumerate(shard_indexes):
+        with open(Path(data_path, f"{_shard_name(shard_number)}.index.json"), "w") as f:
+            json.dump(shard_index, f)
+
+    index = {
+        "version": dynamodb_shards_version,
+        "data": data_name,
+        "key_attributes": key_attributes,
+        "compression": compression,
+        "shard_count": shard_count,
+        "item_count": len(items),
+    }
+    with FileLock(Path(cache_path, dynamodb_shards_lock_file_name)):
+        # swap in the new version (atomically, so readers see either the old or the new index) and remove old versions that are not being read
+        temp_fd, temp_path = tempfile.mkstemp(dir=cache_path, suffix=".temp")
+        with os.fdopen(temp_fd, "w") as f:
+            json.dump(index, f, indent=4)
+        os.replace(temp_path, Path(cache_path, dynamodb_shards_index_file_name))
+        for old_data_path in cache_path.glob(f"{dynamodb_shards_data_prefix}*"):
+            if old_data_path.name != data_name and not _is_version_in_use(old_data_path):
+                shutil.rmtree(old_data_path, ignore_errors=True)
+    log.info(f"wrote {len(items)} items to {shard_count} shards in {data_path}")
+
+    return DynamoDBShardedCache(cache_path)
@@ -0,0 +1,89 @@
+import os
+import time
+import logging
+from pathlib import Path
+
+from sundry import __title__
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+    import msvcrt  # Windows
+
+log = logging.getLogger(__title__)
+
+
+class FileLock:
+    """
+    Exclusive lock on a lock file, shared by processes (and threads) on the same machine.  Used for "single flight" filling of a cache: the first process to take
+    the lock fills the cache while the others wait, and then re-check the cache before doing the work themselves.
+
+    The lock is released by the OS if the process holding it dies.  The lock file itself is left in place (removing it would race with other processes taking
+    the lock).
+    """
+
+    def __init__(self, lock_path: (str, Path), timeout: (float, None) = None, poll_interval: float = 0.1):
+        """
+        :param lock_path: lock file path (created if it doesn't exist)
+        :param timeout: maximum seconds to wait for the lock (None to wait indefinitely)
+        :param poll_interval: seconds between attempts to take the lock when a timeout is given (or on Windows)
+        """
+        self.lock_path = Path(lock_path)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self._fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def _try_lock(self, blocking: bool) -> bool:
+        try:
+            if fcntl is None:
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                msvcrt.locking(self._fd, msvcrt.LK_NBLCK, 1)
+            else:
+                fcntl.flock(self._fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            locked = True
+        except OSError:
+            locked = False  # held by another process or thread
+        return locked
+
+    def acquire(self):
+        """
+        take the lock, waiting for it if another process (or thread) holds it
+        """
+        if self._fd is not None:
+            raise RuntimeError(f"{self.lock_path} is already locked by this FileLock")
+        self.lock_path.parent.mkdir(parents=True, exist_ok=True)
+        self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT)
+        start = time.monotonic()
+        blocking = self.timeout is None and fcntl is not None
+        while not self._try_lock(blocking):
+            if self.timeout is not None and time.monotonic() - start >= self.timeout:
+                os.close(self._fd)
+                self._fd = None
+                raise TimeoutError(f"could not lock {self.lock_path} within {self.timeout} seconds")
+            time.sleep(self.poll_interval)
+        wait_time = time.monotonic() - start
+        if wait_time > 1.0:
+            log.info(f"waited {wait_time:.3f} seconds for {self.lock_path}")
+
+    def release(self):
+        """
+        release the lock
+        """
+        if self._fd is not None:
+            try:
+                if fcntl is None:
+                    os.lseek(self._fd, 0, os.SEEK_SET)
+                    msvcrt.locking(self._fd, msvcrt.LK_UNLCK, 1)
+                else:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+            finally:
+                os.close(self._fd)
+                self._fd = None
@@ -3,6 +3,8 @@ import stat
 import shutil
 import time
 import logging
+import sys
+from pathlib import Path
 
 from sundry import __title__
 
@@ -56,3 +58,56 @@ def mkdirs(d: str, remove_first=False):
         count -= 1
     if not os.path.exists(d):
         log.error(f'could not mkdirs "{d}" ({os.path.abspath(d)})')
+
+
+link_modes = ["copy", "hardlink", "reflink", "symlink"]
+_ficlone = 0x40049409  # Linux FICLONE ioctl (copy-on-write clone, e.g. on btrfs and XFS)
+
+
+def _reflink(source: Path, destination: Path):
+    if not sys.platform.startswith("linux"):
+        raise OSError(f"reflink not supported on {sys.platform}")
+    import fcntl
+
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        fcntl.ioctl(destination_file.fileno(), _ficlone, source_file.fileno())
+
+
+def link_or_copy(source: (str, Path), destination: (str, Path), link_mode: str = "copy") -> str:
+    """
+    make a file available at destination as a hard link, reflink (copy-on-write clone) or symbolic link to source, falling back to a copy if the link
+    can't be made (e.g. source and destination are on different file systems).  Any existing destination is replaced.
+    Note that with "hardlink" and "symlink" writing to the destination also writes to the source.
+    :param source: source file path
+    :param destination: destination file path
+    :param link_mode: "copy", "hardlink", "reflink" or "symlink"
+    :return: the link mode that was actually used
+    """
+    if link_mode not in link_modes:
+        raise ValueError(f"{link_mode=} is not one of {link_modes}")
+    source = Path(source)
+    destination = Path(destination)
+
+    if destination.exists() or destination.is_symlink():
+        destination.unlink()
+
+    used_link_mode = "copy"
+    try:
+        if link_mode == "hardlink":
+            os.link(source, destination)
+            used_link_mode = link_mode
+        elif link_mode == "reflink":
+            _reflink(source, destination)
+            shutil.copystat(source, destination)
+            used_link_mode = link_mode
+        elif link_mode == "symlink":
+            os.symlink(source.absolute(), destination)
+            used_link_mode = link_mode
+    except OSError as e:
+        log.debug(f"could not {link_mode} {source} to {destination} - copying instead : {e}")
+        if destination.exists() or destination.is_symlink():
+            destination.unlink()
+
+    if used_link_mode == "copy":
+        shutil.copy2(source, destination)
+    return used_link_mode
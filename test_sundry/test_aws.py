@@ -1,19 +1,41 @@
 import os
+from pathlib import Path
+import io
+import gzip
+import bz2
+import lzma
 import sys
 import decimal
 from collections import OrderedDict, defaultdict
+from contextlib import contextmanager
 from pprint import pprint
 import math
 import datetime
 from datetime import timedelta
 import pickle
+import hashlib
+import time
+import threading
+import multiprocessing
 
 from PIL import Image
 
 import boto3
-from botocore.exceptions import ProfileNotFound
+from botocore.exceptions import ProfileNotFound, ClientError, ResponseStreamingError
+from botocore.stub import Stubber, ANY
+from botocore.response import StreamingBody
+from s3transfer import TransferConfig
 
 from sundry import dict_to_dynamodb, aws_dynamodb_scan_table, aws_dynamodb_scan_table_cached, dict_is_close, aws_get_dynamodb_table_names
+from sundry import aws_get_client, aws_get_resource, aws_clear_clients, aws_s3_get_size_mtime_hash, aws_s3_object_exists, aws_s3_get_file_etag, mkdirs
+from sundry import AWSRetryPolicy, aws_get_retry_policy, aws_set_retry_policy, aws_s3_iter_lines, aws_s3_delete_batch, aws_s3_list_objects, aws_s3_write_stream
+from sundry import aws_s3_tail_lines
+from sundry import aws_s3_read_string, aws_s3_set_read_cache, aws_s3_read_cache_stats, aws_s3_clear_read_cache, aws_s3_get_size_mtime_hash_batch, aws_s3_objects_exist
+from sundry import CacheManager, CacheUsage, FileLock, rmdir, aws_s3_cache_manager, aws_s3_download_cached, get_string_sha512, aws_s3_sync_upload
+from sundry import aws_s3_download_cached_bulk, aws_s3_download_ranged, aws_s3_read_bytes
+import sundry.aws
+from sundry.aws import _aws_s3_cache_lock_path, _aws_s3_cache_metadata_path, _aws_s3_read_cache_metadata, _aws_s3_write_cache_metadata, _aws_s3_ranged_read_into
+from sundry.aws import _aws_s3_list_objects_parallel
 
 id_str = "id"
 dict_id = "test"
@@ -117,5 +139,601 @@ def test_aws():
     assert('sundry' in dynamodb_tables)
 
 
+def test_aws_client_pool():
+    # clients and resources are created once and reused (no AWS access is required to create them)
+    s3_client = aws_get_client("s3", None, aws_region)
+    assert s3_client is aws_get_client("s3", None, aws_region)
+    assert s3_client is not aws_get_client("s3", None, aws_region, max_pool_connections=50)
+    assert s3_client is not aws_get_client("dynamodb", None, aws_region)
+    s3_resource = aws_get_resource("s3", None, aws_region)
+    assert s3_resource is aws_get_resource("s3", None, aws_region)
+    # the helpers' own clients only make one attempt per call since they retry with the shared retry policy, but the public clients keep botocore's retries
+    assert "total_max_attempts" not in s3_client.meta.config.retries
+    assert sundry.aws._aws_get_client("s3", None, aws_region).meta.config.retries["total_max_attempts"] == 1
+    aws_clear_clients()
+    assert s3_client is not aws_get_client("s3", None, aws_region)
+
+
+def get_client_in_child():
+    aws_get_client("s3", None, aws_region)
+
+
+def test_aws_client_pool_fork():
+    # a child process forked while another thread holds the pool's lock can still get clients
+    if hasattr(os, "fork"):
+        lock_held = threading.Event()
+        release_lock = threading.Event()
+
+        def hold_lock():
+            with sundry.aws._aws_lock:
+                lock_held.set()
+                release_lock.wait()
+
+        thread = threading.Thread(target=hold_lock)
+        thread.start()
+        lock_held.wait()
+        process = multiprocessing.get_context("fork").Process(target=get_client_in_child)
+        try:
+            process.start()
+            process.join(timeout=60)
+            assert process.exitcode == 0
+        finally:
+            release_lock.set()
+            thread.join()
+            if process.is_alive():
+                process.kill()
+
+
+@contextmanager
+def stub_s3():
+    # one stubbed client for every helper, regardless of thread or pool size (no AWS access is required)
+    s3_client = sundry.aws._aws_get_client("s3", None)
+    original_get_client = sundry.aws._aws_get_client
+    sundry.aws._aws_get_client = lambda *args, **kwargs: s3_client
+    try:
+        with Stubber(s3_client) as stubber:
+            yield stubber
+            stubber.assert_no_pending_responses()
+    finally:
+        sundry.aws._aws_get_client = original_get_client
+
+
+def test_aws_s3_metadata():
+    # a single HEAD request per call (no AWS access is required since the client is stubbed)
+    last_modified = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    with Stubber(sundry.aws._aws_get_client("s3", None)) as stubber:
+        stubber.add_response("head_object", {"ContentLength": 3, "LastModified": last_modified, "ETag": '"ABC123"'}, {"Bucket": "b", "Key": "k"})
+        stubber.add_client_error("head_object", "404", http_status_code=404, expected_params={"Bucket": "b", "Key": "k2"})
+        stubber.add_response("head_object", {"ContentLength": 3, "LastModified": last_modified, "ETag": '"abc123"'}, {"Bucket": "b", "Key": "k"})
+        assert aws_s3_get_size_mtime_hash("b", "k", None) == (3, last_modified, "abc123")
+        assert aws_s3_get_size_mtime_hash("b", "k2", None) == (None, None, None)
+        assert aws_s3_object_exists("b", "k", None)
+        stubber.assert_no_pending_responses()
+
+
+def test_aws_retry_policy():
+    # throttling is retried, other errors are not (no AWS access is required since the client is stubbed)
+    last_modified = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    original_retry_policy = aws_get_retry_policy()
+    retry_policy = AWSRetryPolicy(max_attempts=3, base_delay=0.001)
+    aws_set_retry_policy(retry_policy)
+    try:
+        with Stubber(sundry.aws._aws_get_client("s3", None)) as stubber:
+            stubber.add_client_error("head_object", "SlowDown", http_status_code=503, expected_params={"Bucket": "b", "Key": "k"})
+            stubber.add_response("head_object", {"ContentLength": 3, "LastModified": last_modified, "ETag": '"abc123"'}, {"Bucket": "b", "Key": "k"})
+            for _ in range(3):
+                stubber.add_client_error("head_object", "InternalError", http_status_code=500, expected_params={"Bucket": "b", "Key": "k"})
+            stubber.add_client_error("head_object", "AccessDenied", http_status_code=403, expected_params={"Bucket": "b", "Key": "k"})
+            assert aws_s3_get_size_mtime_hash("b", "k", None) == (3, last_modified, "abc123")
+            assert retry_policy.retries_attempted == 1
+            for error_code in ["InternalError", "AccessDenied"]:
+                try:
+                    aws_s3_get_size_mtime_hash("b", "k", None)
+                    assert False
+                except ClientError as e:
+                    assert e.response["Error"]["Code"] == error_code
+            stubber.assert_no_pending_responses()
+        assert retry_policy.retries_attempted == 3
+        assert retry_policy.gave_up == 1
+    finally:
+        aws_set_retry_policy(original_retry_policy)
+
+
+def test_aws_s3_iter_lines():
+    # lines are split across reads and multibyte characters are split across reads (no AWS access is required since the client is stubbed)
+    text = "line 1\r\nlíne 2\n\nline 4"
+    body = text.encode()
+    with Stubber(sundry.aws._aws_get_client("s3", None)) as stubber:
+        stubber.add_response("get_object", {"Body": StreamingBody(io.BytesIO(body), len(body)), "ETag": '"abc123"'}, {"Bucket": "b", "Key": "k"})
+        assert list(aws_s3_iter_lines("b", "k", None, chunk_size=3)) == text.splitlines()
+        stubber.add_response("get_object", {"Body": StreamingBody(io.BytesIO(body), len(body)), "ETag": '"abc123"'}, {"Bucket": "b", "Key": "k"})
+        assert list(aws_s3_iter_lines("b", "k", None, start_line=1, end_line=2, chunk_size=3)) == ["líne 2"]
+
+        # decompressed on the fly, including concatenated streams
+        for compression, compress in [("gzip", gzip.compress), ("bz2", bz2.compress), ("lzma", lzma.compress)]:
+            body = compress(body) + compress(b"\nline 5")
+            stubber.add_response("get_object", {"Body": StreamingBody(io.BytesIO(body), len(body)), "ETag": '"abc123"'}, {"Bucket": "b", "Key": "k"})
+            assert list(aws_s3_iter_lines("b", "k", None, chunk_size=3, compression=compression)) == text.splitlines() + ["line 5"]
+            body = text.encode()
+        stubber.assert_no_pending_responses()
+
+
+def test_aws_s3_delete_batch():
+    # 1000 keys per request, with per-key errors (no AWS access is required since the client is stubbed)
+    s3_keys = [f"k{i}" for i in range(1500)]
+    with Stubber(sundry.aws._aws_get_client("s3", None)) as stubber:
+        stubber.add_response("delete_objects", {}, {"Bucket": "b", "Delete": {"Objects": [{"Key": s3_key} for s3_key in s3_keys[:1000]], "Quiet": True}})
+        stubber.add_response(
+            "delete_objects",
+            {"Errors": [{"Key": "k1234", "Code": "AccessDenied", "Message": "Access Denied"}]},
+            {"Bucket": "b", "Delete": {"Objects": [{"Key": s3_key} for s3_key in s3_keys[1000:]], "Quiet": True}},
+        )
+        assert aws_s3_delete_batch("b", s3_keys, None, max_workers=1) == {"k1234": "AccessDenied : Access Denied"}
+        stubber.assert_no_pending_responses()
+
+
+def test_aws_s3_list_objects():
+    # pages are requested as the listing is consumed (no AWS access is required since the client is stubbed)
+    last_modified = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    with Stubber(sundry.aws._aws_get_client("s3", None)) as stubber:
+        stubber.add_response(
+            "list_objects_v2",
+            {"Contents": [{"Key": "p/a", "Size": 1, "LastModified": last_modified, "ETag": '"ABC"'}], "IsTruncated": True, "NextContinuationToken": "t"},
+            {"Bucket": "b", "Prefix": "p/"},
+        )
+        stubber.add_response(
+            "list_objects_v2",
+            {"Contents": [{"Key": "p/b", "Size": 2, "LastModified": last_modified, "ETag": '"def"'}], "IsTruncated": False},
+            {"Bucket": "b", "Prefix": "p/", "ContinuationToken": "t"},
+        )
+        s3_objects = aws_s3_list_objects("b", "p/", None)
+        assert next(s3_objects) == ("p/a", 1, last_modified, "abc")
+        assert list(s3_objects) == [("p/b", 2, last_modified, "def")]
+        stubber.assert_no_pending_responses()
+
+
+def test_aws_s3_get_size_mtime_hash_batch():
+    # one listing of a directory with several of the keys, and a HEAD request for a key that is alone in its directory
+    last_modified = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    with stub_s3() as stubber:
+        stubber.add_response(
+            "list_objects_v2",
+            {"Contents": [{"Key": "p/a", "Size": 1, "LastModified": last_modified, "ETag": '"abc"'}, {"Key": "p/c", "Size": 3, "LastModified": last_modified, "ETag": '"c"'}]},
+            {"Bucket": "b", "Prefix": "p/", "Delimiter": "/", "StartAfter": "p/`"},
+        )
+        stubber.add_response("head_object", {"ContentLength": 2, "LastModified": last_modified, "ETag": '"def"'}, {"Bucket": "b", "Key": "q/d"})
+        size_mtime_hashes = aws_s3_get_size_mtime_hash_batch("b", ["p/a", "p/b", "q/d"], None, max_workers=1)
+    assert size_mtime_hashes == {"p/a": (1, last_modified, "abc"), "p/b": (None, None, None), "q/d": (2, last_modified, "def")}
+
+
+def test_aws_s3_get_size_mtime_hash_batch_bounded():
+    # each list request starts just before the first key not yet found, and the listing stops after the last key
+    last_modified = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+    def contents(*s3_keys) -> list:
+        return [{"Key": s3_key, "Size": 1, "LastModified": last_modified, "ETag": '"e"'} for s3_key in s3_keys]
+
+    with stub_s3() as stubber:
+        stubber.add_response(
+            "list_objects_v2",
+            {"Contents": contents("p/a", "p/b", "p/c"), "CommonPrefixes": [{"Prefix": "p/d/"}], "IsTruncated": True, "NextContinuationToken": "t"},
+            {"Bucket": "b", "Prefix": "p/", "Delimiter": "/", "StartAfter": "p/`"},
+        )
+        stubber.add_response("list_objects_v2", {"Contents": contents("p/x", "p/z"), "IsTruncated": True, "NextContinuationToken": "t"}, {"Bucket": "b", "Prefix": "p/", "Delimiter": "/", "StartAfter": "p/w"})
+        size_mtime_hashes = aws_s3_get_size_mtime_hash_batch("b", ["p/a", "p/b", "p/x", "p/y"], None, max_workers=1)
+    assert size_mtime_hashes == {"p/a": (1, last_modified, "e"), "p/b": (1, last_modified, "e"), "p/x": (1, last_modified, "e"), "p/y": (None, None, None)}
+
+
+def test_aws_s3_objects_exist_sparse():
+    # once a list request passes none of the remaining keys they are sparse in the directory, and the rest are read with HEAD requests
+    last_modified = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+    def contents(*s3_keys) -> list:
+        return [{"Key": s3_key, "Size": 1, "LastModified": last_modified, "ETag": '"e"'} for s3_key in s3_keys]
+
+    with stub_s3() as stubber:
+        stubber.add_response("list_objects_v2", {"Contents": contents("p/a", "p/b"), "IsTruncated": True, "NextContinuationToken": "t"}, {"Bucket": "b", "Prefix": "p/", "Delimiter": "/", "StartAfter": "p/`"})
+        stubber.add_response("list_objects_v2", {"Contents": contents("p/l0", "p/l1"), "IsTruncated": True, "NextContinuationToken": "t"}, {"Bucket": "b", "Prefix": "p/", "Delimiter": "/", "StartAfter": "p/l"})
+        stubber.add_response("head_object", {"ContentLength": 1, "LastModified": last_modified, "ETag": '"e"'}, {"Bucket": "b", "Key": "p/m"})
+        stubber.add_client_error("head_object", "404", http_status_code=404, expected_params={"Bucket": "b", "Key": "p/z"})
+        objects_exist = aws_s3_objects_exist("b", ["p/z", "p/m", "p/a"], None, max_workers=1)
+    assert objects_exist == {"p/a": True, "p/m": True, "p/z": False}
+
+
+def test_aws_s3_tail_lines():
+    # Range requests backwards from the end of the object, only as far as needed (no AWS access is required since the client is stubbed)
+    data = b"one\r\ntwo\r\nthree\r\nfour\r\n"
+
+    def add_tail_responses(stubber, ranges: list):
+        for start, end in ranges:
+            if end == len(data):
+                expected_params = {"Bucket": "b", "Key": "k", "Range": f"bytes=-{end - start}"}  # suffix range
+            else:
+                expected_params = {"Bucket": "b", "Key": "k", "Range": f"bytes={start}-{end - 1}", "IfMatch": '"e"'}
+            response = {"Body": StreamingBody(io.BytesIO(data[start:end]), end - start), "ETag": '"e"', "ContentRange": f"bytes {start}-{end - 1}/{len(data)}"}
+            stubber.add_response("get_object", response, expected_params)
+
+    # the partial first line of the tail is discarded
+    with stub_s3() as stubber:
+        add_tail_responses(stubber, [(15, 23), (7, 15)])
+        assert aws_s3_tail_lines("b", "k", None, 2, chunk_size=8) == ["three", "four"]
+
+    # more lines than the object has - read to the start of the object
+    with stub_s3() as stubber:
+        add_tail_responses(stubber, [(15, 23), (7, 15), (0, 7)])
+        assert aws_s3_tail_lines("b", "k", None, 10, chunk_size=8) == ["one", "two", "three", "four"]
+
+    # empty object
+    with stub_s3() as stubber:
+        stubber.add_client_error("get_object", "InvalidRange", http_status_code=416, expected_params={"Bucket": "b", "Key": "k", "Range": "bytes=-8"})
+        assert aws_s3_tail_lines("b", "k", None, 2, chunk_size=8) == []
+
+
+class ListingS3Client:
+    # list_objects_v2 of a fixed set of keys (with Delimiter "/"), in pages of 2 entries
+    def __init__(self, s3_keys: list, fail_prefix: (str, None) = None):
+        self.s3_keys = s3_keys
+        self.fail_prefix = fail_prefix
+        self.listed_prefixes = []
+        self.lock = threading.Lock()
+
+    def list_objects_v2(self, Bucket, Prefix, Delimiter, ContinuationToken="0"):
+        with self.lock:
+            self.listed_prefixes.append(Prefix)
+        if Prefix == self.fail_prefix:
+            raise ClientError({"Error": {"Code": "AccessDenied"}}, "ListObjectsV2")
+        entries = sorted({Prefix + s3_key[len(Prefix) :].split("/")[0] + ("/" if "/" in s3_key[len(Prefix) :] else "") for s3_key in self.s3_keys if s3_key.startswith(Prefix)})
+        start = int(ContinuationToken)
+        page = entries[start : start + 2]
+        response = {
+            "Contents": [{"Key": entry, "Size": 1, "LastModified": datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc), "ETag": '"e"'} for entry in page if not entry.endswith("/")],
+            "CommonPrefixes": [{"Prefix": entry} for entry in page if entry.endswith("/")],
+            "IsTruncated": start + 2 < len(entries),
+        }
+        if response["IsTruncated"]:
+            response["NextContinuationToken"] = str(start + 2)
+        return response
+
+
+def test_aws_s3_list_objects_parallel():
+    # each directory is listed on its own thread, including nested directories found on any page
+    s3_keys = ["p/a", "p/b", "p/c", "p/x/d", "p/x/y/e", "p/x/y/z/f", "p/z/g", "p/z/h"]
+    s3_client = ListingS3Client(s3_keys)
+    assert sorted(record[0] for record in _aws_s3_list_objects_parallel(s3_client, "b", "p/", 4)) == s3_keys
+    assert sorted(set(s3_client.listed_prefixes)) == ["p/", "p/x/", "p/x/y/", "p/x/y/z/", "p/z/"]
+
+    # an exception in any directory's listing is raised to the caller
+    try:
+        list(_aws_s3_list_objects_parallel(ListingS3Client(s3_keys, fail_prefix="p/x/y/"), "b", "p/", 4))
+        assert False
+    except ClientError:
+        pass
+
+    # closing the generator early stops the listing
+    s3_client = ListingS3Client([f"p/{index:03d}" for index in range(100)])
+    records = _aws_s3_list_objects_parallel(s3_client, "b", "p/", 1)
+    next(records)
+    records.close()
+    time.sleep(0.5)
+    assert len(s3_client.listed_prefixes) < 10  # of 50 pages
+
+
+def test_aws_s3_read_cache():
+    # one GET, then hits until the TTL expires and then a conditional GET (no AWS access is required since the client is stubbed)
+    aws_s3_clear_read_cache()
+    aws_s3_set_read_cache(1000, ttl=0.0)
+    try:
+        with Stubber(sundry.aws._aws_get_client("s3", None)) as stubber:
+            stubber.add_response("get_object", {"Body": StreamingBody(io.BytesIO(b"a=1"), 3), "ContentLength": 3, "ETag": '"abc"'}, {"Bucket": "b", "Key": "k"})
+            stubber.add_client_error("get_object", "304", http_status_code=304, expected_params={"Bucket": "b", "Key": "k", "IfNoneMatch": '"abc"'})
+            assert aws_s3_read_string("b", "k", None) == "a=1"
+            assert aws_s3_read_string("b", "k", None) == "a=1"  # TTL expired, revalidated
+            stubber.assert_no_pending_responses()
+        aws_s3_set_read_cache(1000, ttl=60.0)
+        assert aws_s3_read_string("b", "k", None) == "a=1"  # no request
+        stats = aws_s3_read_cache_stats()
+        assert (stats.hits, stats.misses, stats.revalidations, stats.entries, stats.total_bytes) == (2, 1, 1, 1, 3)
+    finally:
+        aws_s3_set_read_cache(0)
+        aws_s3_clear_read_cache()
+
+
+class FailingBody(io.BytesIO):
+    # body that fails part way through the read
+    def read(self, size=-1):
+        super().read(1)
+        raise ResponseStreamingError(error="connection broken")
+
+
+def test_aws_s3_read_cache_retry():
+    # a failed body read is retried with a new GET (not by reading the partly consumed body again), and the entry is per profile
+    original_retry_policy = aws_get_retry_policy()
+    aws_set_retry_policy(AWSRetryPolicy(base_delay=0.0))
+    aws_s3_clear_read_cache()
+    aws_s3_set_read_cache(1000, ttl=60.0)
+    try:
+        with Stubber(sundry.aws._aws_get_client("s3", None)) as stubber:
+            stubber.add_response("get_object", {"Body": FailingBody(b"a=1"), "ContentLength": 3, "ETag": '"abc"'}, {"Bucket": "b", "Key": "k"})
+            stubber.add_response("get_object", {"Body": StreamingBody(io.BytesIO(b"a=1"), 3), "ContentLength": 3, "ETag": '"abc"'}, {"Bucket": "b", "Key": "k"})
+            assert aws_s3_read_string("b", "k", None) == "a=1"
+            stubber.assert_no_pending_responses()
+        assert list(sundry.aws._aws_s3_read_cache) == [(None, "b", "k")]
+    finally:
+        aws_set_retry_policy(original_retry_policy)
+        aws_s3_set_read_cache(0)
+        aws_s3_clear_read_cache()
+
+
+def test_aws_s3_cache_lock_eviction():
+    # an entry that is being downloaded (its lock is held) is not evicted, and evicting an entry does not remove its lock
+    cache_dir = os.path.join("temp", "test_aws_s3_cache_lock_eviction")
+    rmdir(cache_dir)
+    mkdirs(cache_dir)
+    cache_path = Path(cache_dir, "abc123")
+    with open(cache_path, "wb") as f:
+        f.write(bytes(100))
+    with open(f"{cache_path}.json", "w") as f:
+        f.write("{}")  # sidecar
+    lock_path = _aws_s3_cache_lock_path(cache_path)
+    cache_manager = CacheManager(cache_dir)
+    cache_manager.touch(cache_path.name)
+    with FileLock(lock_path):
+        assert cache_manager.trim(max_entries=0) == CacheUsage()
+        assert cache_path.exists()
+        try:
+            with FileLock(lock_path, timeout=0.2):
+                assert False  # still held
+        except TimeoutError:
+            pass
+    assert cache_manager.trim(max_entries=0) == CacheUsage(100, 1)
+    assert not cache_path.exists()
+    assert lock_path.exists()
+
+    # one cache manager per cache dir (and limits)
+    assert aws_s3_cache_manager(Path(cache_dir)) is aws_s3_cache_manager(Path(cache_dir))
+
+
+def test_aws_s3_download_cached_single_flight():
+    # while another process downloads into the cache this one waits for it and then uses what it downloaded (no GET is stubbed)
+    cache_dir = os.path.join("temp", "test_aws_s3_download_cached_single_flight")
+    rmdir(cache_dir)
+    mkdirs(cache_dir)
+    cache_path = Path(cache_dir, get_string_sha512("bk"))
+    dest_path = Path(cache_dir, "dest", "k")
+    mkdirs(dest_path.parent)
+    last_modified = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    results = []
+    with stub_s3():
+        with FileLock(_aws_s3_cache_lock_path(cache_path)):
+            thread = threading.Thread(target=lambda: results.append(aws_s3_download_cached("b", "k", None, dest_path, cache_dir, s3_size_mtime_hash=(3, last_modified, "abc"))))
+            thread.start()
+            time.sleep(0.5)  # waiting for the lock
+            with open(cache_path, "wb") as f:
+                f.write(b"xyz")
+            _aws_s3_write_cache_metadata(cache_path, {"etag": "abc", "version_id": None, "size": 3, "mtime": last_modified.timestamp()})
+        thread.join()
+    assert results[0].success and results[0].cached
+    assert dest_path.read_bytes() == b"xyz"
+
+
+def test_aws_s3_download_cached_conditional_head():
+    # the cache is validated with a conditional HEAD request using the sidecar's ETag, or with the size and mtime if there is no sidecar
+    cache_dir = os.path.join("temp", "test_aws_s3_download_cached_conditional_head")
+    rmdir(cache_dir)
+    mkdirs(cache_dir)
+    cache_path = Path(cache_dir, get_string_sha512("bk"))
+    dest_path = Path(cache_dir, "dest", "k")
+    mkdirs(dest_path.parent)
+    last_modified = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+    cache_path.write_bytes(b"xyz")
+    _aws_s3_write_cache_metadata(cache_path, {"etag": "abc", "version_id": None, "size": 3, "mtime": last_modified.timestamp()})
+
+    def add_download_responses(stubber, contents: bytes, etag: str):
+        stubber.add_response("head_object", {"ContentLength": len(contents), "LastModified": last_modified, "ETag": etag}, {"Bucket": "b", "Key": "k"})
+        stubber.add_response("get_object", {"Body": StreamingBody(io.BytesIO(contents), len(contents)), "ContentLength": len(contents), "ETag": etag}, {"Bucket": "b", "Key": "k"})
+
+    # not modified (304) - a cache hit
+    with stub_s3() as stubber:
+        stubber.add_client_error("head_object", "304", http_status_code=304, expected_params={"Bucket": "b", "Key": "k", "IfNoneMatch": '"abc"'})
+        status = aws_s3_download_cached("b", "k", None, dest_path, cache_dir)
+    assert status.success and status.cached
+    assert dest_path.read_bytes() == b"xyz"
+
+    # modified (200 with a new ETag) - downloaded again
+    with stub_s3() as stubber:
+        stubber.add_response("head_object", {"ContentLength": 3, "LastModified": last_modified, "ETag": '"def"'}, {"Bucket": "b", "Key": "k", "IfNoneMatch": '"abc"'})
+        add_download_responses(stubber, b"uvw", '"def"')
+        status = aws_s3_download_cached("b", "k", None, dest_path, cache_dir)
+    assert status.success and not status.cached and status.etags_differ
+    assert dest_path.read_bytes() == b"uvw"
+    assert _aws_s3_read_cache_metadata(cache_path)["etag"] == "def"
+
+    # no sidecar - validated with the size and mtime
+    os.remove(_aws_s3_cache_metadata_path(cache_path))
+    with stub_s3() as stubber:
+        stubber.add_response("head_object", {"ContentLength": 3, "LastModified": last_modified, "ETag": '"def"'}, {"Bucket": "b", "Key": "k"})
+        status = aws_s3_download_cached("b", "k", None, dest_path, cache_dir)
+    assert status.success and status.cached
+    newer = last_modified + timedelta(hours=1)
+    with stub_s3() as stubber:
+        stubber.add_response("head_object", {"ContentLength": 3, "LastModified": newer, "ETag": '"def"'}, {"Bucket": "b", "Key": "k"})
+        add_download_responses(stubber, b"uvw", '"def"')
+        status = aws_s3_download_cached("b", "k", None, dest_path, cache_dir)
+    assert status.success and not status.cached and status.mtimes_differ
+    assert os.path.getmtime(cache_path) == newer.timestamp()
+
+
+def test_aws_s3_download_cached_bulk_args():
+    # missing (or conflicting) arguments are an error without any S3 requests
+    with stub_s3():
+        assert aws_s3_download_cached_bulk(s3_bucket="b", s3_prefix="p").statuses == []
+        assert aws_s3_download_cached_bulk([("b", "k", "k")], s3_bucket="b").statuses == []
+
+
+def test_aws_s3_sync_upload():
+    # no AWS access is required since the client is stubbed
+    sync_dir = os.path.join("temp", "test_aws_s3_sync_upload")
+    rmdir(sync_dir)
+    local_dir = Path(sync_dir, "local")
+    mkdirs(Path(local_dir, "sub"))
+    Path(local_dir, "a.txt").write_text("a")
+    Path(local_dir, "sub", "b.txt").write_text("b")
+    manifest_path = Path(sync_dir, "manifest.json")
+    last_modified = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+    def s3_object(s3_key: str, contents: str) -> dict:
+        return {"Key": s3_key, "Size": len(contents), "LastModified": last_modified, "ETag": f'"{hashlib.md5(contents.encode()).hexdigest()}"'}
+
+    # a.txt is unchanged, sub/b.txt is new and the orphan is deleted
+    with stub_s3() as stubber:
+        stubber.add_response("list_objects_v2", {"Contents": [s3_object("p/a.txt", "a"), s3_object("p/orphan", "x")]}, {"Bucket": "b", "Prefix": "p/"})
+        stubber.add_response("put_object", {"ETag": '"b"'}, {"Bucket": "b", "Key": "p/sub/b.txt", "Body": ANY})
+        stubber.add_response("delete_objects", {}, {"Bucket": "b", "Delete": {"Objects": [{"Key": "p/orphan"}], "Quiet": True}})
+        status = aws_s3_sync_upload(local_dir, "b", "p", None, manifest_path, delete_orphans=True, max_workers=1)
+    assert status.uploaded == ["p/sub/b.txt"]
+    assert status.unchanged == 1
+    assert status.deleted == ["p/orphan"]
+    assert status.success()
+
+    # a file with the same size and mtime as in the manifest is not re-hashed, so this change to a.txt isn't seen
+    a_stat = Path(local_dir, "a.txt").stat()
+    Path(local_dir, "a.txt").write_text("z")
+    os.utime(Path(local_dir, "a.txt"), (a_stat.st_atime, a_stat.st_mtime))
+    with stub_s3() as stubber:
+        stubber.add_response("list_objects_v2", {"Contents": [s3_object("p/a.txt", "a"), s3_object("p/sub/b.txt", "b")]}, {"Bucket": "b", "Prefix": "p/"})
+        status = aws_s3_sync_upload(local_dir, "b", "p", None, manifest_path, max_workers=1)
+    assert status.uploaded == []
+    assert status.unchanged == 2
+
+
+def add_range_responses(stubber, data: bytes, etag: str, ranges: list):
+    for start, end in ranges:
+        stubber.add_response(
+            "get_object",
+            {"Body": StreamingBody(io.BytesIO(data[start:end]), end - start), "ContentLength": end - start},
+            {"Bucket": "b", "Key": "k", "Range": f"bytes={start}-{end - 1}", "IfMatch": etag},
+        )
+
+
+def test_aws_s3_ranged_read_into():
+    # no AWS access is required since the client is stubbed
+    data = b"0123456789"
+
+    # single part - the ETag is the MD5 of the contents
+    for etag, verified in [(f'"{hashlib.md5(data).hexdigest()}"', True), (f'"{hashlib.md5(b"x").hexdigest()}"', False)]:
+        buffer = bytearray(len(data))
+        with stub_s3() as stubber:
+            add_range_responses(stubber, data, etag, [(0, 4), (4, 8), (8, 10)])
+            assert _aws_s3_ranged_read_into(buffer, "b", "k", None, {"ContentLength": len(data), "ETag": etag}, 4, 1) == verified
+        assert buffer == data
+
+    # multipart - each range is one part, and the ETag is the MD5 of the parts' MD5s
+    etag = f'"{hashlib.md5(hashlib.md5(data[:6]).digest() + hashlib.md5(data[6:]).digest()).hexdigest()}-2"'
+    buffer = bytearray(len(data))
+    with stub_s3() as stubber:
+        stubber.add_response("head_object", {"ContentLength": 6, "ETag": '"p1"'}, {"Bucket": "b", "Key": "k", "PartNumber": 1})
+        add_range_responses(stubber, data, etag, [(0, 6), (6, 10)])
+        assert _aws_s3_ranged_read_into(buffer, "b", "k", None, {"ContentLength": len(data), "ETag": etag}, 4, 1)
+    assert buffer == data
+
+
+def test_aws_s3_ranged_errors():
+    # a failed range leaves no file or temp file, and returns False or None instead of raising
+    data = b"0123456789"
+    etag = f'"{hashlib.md5(data).hexdigest()}"'
+    download_dir = Path("temp", "test_aws_s3_ranged_errors")
+    rmdir(download_dir)
+    mkdirs(download_dir)
+    file_path = Path(download_dir, "k")
+
+    def add_failing_range_responses(stubber):
+        stubber.add_response("head_object", {"ContentLength": len(data), "ETag": etag}, {"Bucket": "b", "Key": "k"})
+        add_range_responses(stubber, data, etag, [(0, 5)])
+        stubber.add_client_error("get_object", "PreconditionFailed", http_status_code=412)
+
+    with stub_s3() as stubber:
+        add_failing_range_responses(stubber)
+        assert not aws_s3_download_ranged(file_path, "b", "k", None, max_workers=1, part_size=5)
+    assert os.listdir(download_dir) == []
+
+    with stub_s3() as stubber:
+        add_failing_range_responses(stubber)
+        assert aws_s3_read_bytes("b", "k", None, max_workers=1, part_size=5) is None
+
+    # success - the temp file is replaced at the destination
+    with stub_s3() as stubber:
+        stubber.add_response("head_object", {"ContentLength": len(data), "ETag": etag}, {"Bucket": "b", "Key": "k"})
+        add_range_responses(stubber, data, etag, [(0, 5), (5, 10)])
+        assert aws_s3_download_ranged(file_path, "b", "k", None, max_workers=1, part_size=5)
+    assert file_path.read_bytes() == data
+    assert os.listdir(download_dir) == ["k"]
+
+
+class OutOfOrderPartsS3Client:
+    # upload_part for part 1 finishes after part 2, so the parts complete out of order
+    def __init__(self):
+        self.part_2_uploaded = threading.Event()
+        self.bodies = {}
+        self.completed_parts = None
+
+    def create_multipart_upload(self, **kwargs):
+        return {"UploadId": "u"}
+
+    def upload_part(self, PartNumber, Body, **kwargs):
+        if PartNumber == 1:
+            self.part_2_uploaded.wait(10.0)
+        self.bodies[PartNumber] = Body
+        if PartNumber == 2:
+            self.part_2_uploaded.set()
+        return {"ETag": f'"e{PartNumber}"'}
+
+    def complete_multipart_upload(self, MultipartUpload, **kwargs):
+        self.completed_parts = MultipartUpload["Parts"]
+
+
+def test_aws_s3_write_stream():
+    # the parts are completed in part number order regardless of the order they finish in
+    s3_client = OutOfOrderPartsS3Client()
+    original_get_client = sundry.aws._aws_get_client
+    sundry.aws._aws_get_client = lambda *args, **kwargs: s3_client
+    try:
+        assert aws_s3_write_stream(["abcd", b"efghij"], "b", "k", None, part_size=4, max_in_flight=3) == 10
+    finally:
+        sundry.aws._aws_get_client = original_get_client
+    assert s3_client.bodies == {1: b"abcd", 2: b"efgh", 3: b"ij"}
+    assert s3_client.completed_parts == [{"PartNumber": 1, "ETag": '"e1"'}, {"PartNumber": 2, "ETag": '"e2"'}, {"PartNumber": 3, "ETag": '"e3"'}]
+
+    # a failed part aborts the multipart upload
+    with stub_s3() as stubber:
+        stubber.add_response("create_multipart_upload", {"UploadId": "u"}, {"Bucket": "b", "Key": "k"})
+        stubber.add_response("upload_part", {"ETag": '"e1"'}, {"Bucket": "b", "Key": "k", "UploadId": "u", "PartNumber": 1, "Body": b"abcd"})
+        stubber.add_client_error("upload_part", "AccessDenied", expected_params={"Bucket": "b", "Key": "k", "UploadId": "u", "PartNumber": 2, "Body": b"efgh"})
+        stubber.add_response("abort_multipart_upload", {}, {"Bucket": "b", "Key": "k", "UploadId": "u"})
+        try:
+            aws_s3_write_stream([b"abcd", b"efgh"], "b", "k", None, part_size=4, max_in_flight=1)
+            assert False
+        except ClientError:
+            pass
+
+
+def test_aws_s3_get_file_etag():
+    # single part is just the MD5
+    assert aws_s3_get_file_etag(os.path.join("test_sundry", "a.txt")) == "0cc175b9c0f1b6a831c399e269772661"
+
+    # multipart is the MD5 of the parts' MD5s and the number of parts
+    test_dir = os.path.join("temp", "test_aws_s3_get_file_etag")
+    mkdirs(test_dir)
+    file_path = os.path.join(test_dir, "multipart.bin")
+    data = bytes(range(256)) * (6 * 1024 * 4)  # 6 MiB
+    with open(file_path, "wb") as f:
+        f.write(data)
+    part_size = 5 * 1024 * 1024
+    part_md5s = b"".join(hashlib.md5(data[i : i + part_size]).digest() for i in range(0, len(data), part_size))
+    multipart_etag = f"{hashlib.md5(part_md5s).hexdigest()}-2"
+    assert aws_s3_get_file_etag(file_path, TransferConfig(multipart_threshold=part_size, multipart_chunksize=part_size)) == multipart_etag
+
+    # S3Transfer uploads parts of at least 5 MiB, even with a smaller chunk size
+    assert aws_s3_get_file_etag(file_path, TransferConfig(multipart_threshold=1024 * 1024, multipart_chunksize=1024 * 1024)) == multipart_etag
+
 if __name__ == "__main__":
     test_aws()
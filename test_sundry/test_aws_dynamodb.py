@@ -0,0 +1,312 @@
+import os
+import time
+import pickle
+import threading
+import datetime
+from contextlib import contextmanager
+
+import boto3
+from botocore.stub import Stubber, ANY
+from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Attr
+from ismain import is_main
+
+import sundry.aws
+from sundry import aws_dynamodb_scan_table, aws_dynamodb_scan_table_cached, aws_dynamodb_put_items, aws_dynamodb_get_items, aws_get_retry_policy, aws_set_retry_policy, AWSRetryPolicy, rmdir
+from sundry import FileLock, mkdirs, aws_dynamodb_scan_pages
+from sundry.aws import _aws_dynamodb_cache_file_path, _aws_dynamodb_cache_lock_path
+
+# no AWS access is required for these tests since the client is stubbed
+
+aws_region = "us-west-2"
+
+
+@contextmanager
+def stub_dynamodb():
+    # one stubbed client (and a resource that uses it) for every helper, regardless of thread or pool size
+    session = boto3.Session(region_name=aws_region, aws_access_key_id="test", aws_secret_access_key="test")
+    dynamodb_resource = session.resource("dynamodb")
+    original_get_client, original_get_resource = sundry.aws._aws_get_client, sundry.aws._aws_get_resource
+    sundry.aws._aws_get_client = lambda *args, **kwargs: dynamodb_resource.meta.client
+    sundry.aws._aws_get_resource = lambda *args, **kwargs: dynamodb_resource
+    try:
+        with Stubber(dynamodb_resource.meta.client) as stubber:
+            yield stubber
+            stubber.assert_no_pending_responses()
+    finally:
+        sundry.aws._aws_get_client, sundry.aws._aws_get_resource = original_get_client, original_get_resource
+
+
+def add_describe_table(stubber, table_name: str):
+    stubber.add_response("describe_table", {"Table": {"KeySchema": [{"AttributeName": "id", "KeyType": "HASH"}]}}, {"TableName": table_name})
+
+
+def test_aws_dynamodb_scan_table_cached_shards_projection():
+    cache_dir = os.path.join("temp", "test_aws_dynamodb_scan_table_cached_shards_projection")
+    rmdir(cache_dir)
+    with stub_dynamodb() as stubber:
+        add_describe_table(stubber, "t")
+        # the key attribute is added to the projection since the shards need it
+        stubber.add_response(
+            "scan", {"Items": [{"id": {"S": "1"}, "name": {"S": "a"}}]}, {"TableName": "t", "ProjectionExpression": "#p0, #p1", "ExpressionAttributeNames": {"#p0": "name", "#p1": "id"}}
+        )
+        with aws_dynamodb_scan_table_cached("t", None, cache_dir=cache_dir, projection=["name"], cache_format="shards") as sharded_cache:
+            assert list(sharded_cache) == [{"id": "1", "name": "a"}]
+
+
+def put_requests(items: list, serialized: bool = False) -> dict:
+    # requests are checked as the resource is called (plain values), but responses are in the client's DynamoDB JSON
+    return {"t": [{"PutRequest": {"Item": {k: {"S": v} for k, v in item.items()} if serialized else item}} for item in items]}
+
+
+def test_aws_dynamodb_put_items():
+    items = [{"id": str(i), "value": "a"} for i in range(30)]
+    original_retry_policy = aws_get_retry_policy()
+    aws_set_retry_policy(AWSRetryPolicy(base_delay=0.0))
+    try:
+        with stub_dynamodb() as stubber:
+            add_describe_table(stubber, "t")
+            # batches of 25, with the unprocessed items of the first batch re-sent
+            stubber.add_response("batch_write_item", {"UnprocessedItems": put_requests(items[20:25], True)}, {"RequestItems": put_requests(items[:25])})
+            stubber.add_response("batch_write_item", {"UnprocessedItems": {}}, {"RequestItems": put_requests(items[20:25])})
+            stubber.add_response("batch_write_item", {"UnprocessedItems": {}}, {"RequestItems": put_requests(items[25:])})
+            stats = aws_dynamodb_put_items("t", items, None, max_workers=1)
+        assert stats.items_written == 30
+        assert stats.batches_written == 2
+        assert stats.retries == 1
+        assert stats.items_not_written == 0
+    finally:
+        aws_set_retry_policy(original_retry_policy)
+
+
+def test_aws_dynamodb_put_items_duplicates():
+    # the last item with a given key is written, in the position of the first
+    items = [{"id": "1", "value": "a"}, {"id": "2", "value": "a"}, {"id": "1", "value": "b"}]
+    with stub_dynamodb() as stubber:
+        add_describe_table(stubber, "t")
+        stubber.add_response("batch_write_item", {"UnprocessedItems": {}}, {"RequestItems": put_requests([items[2], items[1]])})
+        stats = aws_dynamodb_put_items("t", items, None, max_workers=1)
+    assert stats.items_written == 2
+    assert stats.duplicate_items == 1
+
+
+def test_aws_dynamodb_put_items_failed_batch():
+    # a failed batch is counted instead of raised, and the other batches are still written
+    items = [{"id": str(i)} for i in range(30)]
+    with stub_dynamodb() as stubber:
+        add_describe_table(stubber, "t")
+        stubber.add_client_error("batch_write_item", "ValidationException", expected_params={"RequestItems": put_requests(items[:25])})
+        stubber.add_response("batch_write_item", {"UnprocessedItems": {}}, {"RequestItems": put_requests(items[25:])})
+        stats = aws_dynamodb_put_items("t", items, None, max_workers=1)
+    assert stats.batches_failed == 1
+    assert stats.batches_written == 1
+    assert stats.items_not_written == 25
+    assert stats.items_written == 5
+
+
+def test_aws_dynamodb_get_items():
+    keys = [{"id": str(i)} for i in range(150)]
+    original_retry_policy = aws_get_retry_policy()
+    aws_set_retry_policy(AWSRetryPolicy(base_delay=0.0))
+    try:
+        with stub_dynamodb() as stubber:
+            # batches of 100, with the unprocessed keys of the first batch re-sent
+            stubber.add_response(
+                "batch_get_item",
+                {"Responses": {"t": [{"id": {"S": key["id"]}} for key in keys[:90]]}, "UnprocessedKeys": {"t": {"Keys": [{"id": {"S": key["id"]}} for key in keys[90:100]]}}},
+                {"RequestItems": {"t": {"Keys": keys[:100]}}},
+            )
+            stubber.add_response("batch_get_item", {"Responses": {"t": [{"id": {"S": key["id"]}} for key in keys[90:100]]}}, {"RequestItems": {"t": {"Keys": keys[90:100]}}})
+            stubber.add_response("batch_get_item", {"Responses": {"t": [{"id": {"S": key["id"]}} for key in keys[100:]]}}, {"RequestItems": {"t": {"Keys": keys[100:]}}})
+            items = aws_dynamodb_get_items("t", keys + keys[:1], None, max_workers=1)  # a duplicate key is only read once
+        assert sorted(items, key=lambda item: int(item["id"])) == keys
+    finally:
+        aws_set_retry_policy(original_retry_policy)
+
+
+def test_aws_dynamodb_get_items_cached():
+    # only cache misses are read, and with write through they're added to the scan cache (for both cache formats)
+    for cache_format in ["pickle", "shards"]:
+        cache_dir = os.path.join("temp", "test_aws_dynamodb_get_items_cached", cache_format)
+        rmdir(cache_dir)
+        with stub_dynamodb() as stubber:
+            if cache_format == "shards":
+                add_describe_table(stubber, "t")
+            stubber.add_response("scan", {"Items": [{"id": {"S": "1"}, "name": {"S": "a"}}]}, {"TableName": "t"})
+            table_data = aws_dynamodb_scan_table_cached("t", None, cache_dir=cache_dir, cache_format=cache_format)
+            if cache_format == "shards":
+                table_data.close()
+            stubber.add_response("batch_get_item", {"Responses": {"t": [{"id": {"S": "2"}, "name": {"S": "b"}}]}}, {"RequestItems": {"t": {"Keys": [{"id": "2"}]}}})
+            items = aws_dynamodb_get_items("t", [{"id": "1"}, {"id": "2"}], None, cache_dir=cache_dir, write_through=True)
+            assert sorted(items, key=lambda item: item["id"]) == [{"id": "1", "name": "a"}, {"id": "2", "name": "b"}]
+
+            # both items are now read from the cache
+            if cache_format == "shards":
+                add_describe_table(stubber, "t")
+            table_data = aws_dynamodb_scan_table_cached("t", None, cache_dir=cache_dir, cache_format=cache_format)
+            assert sorted(table_data, key=lambda item: item["id"]) == [{"id": "1", "name": "a"}, {"id": "2", "name": "b"}]
+            if cache_format == "shards":
+                table_data.close()
+            assert aws_dynamodb_get_items("t", [{"id": "1"}, {"id": "2"}], None, cache_dir=cache_dir) == items
+
+
+def test_aws_dynamodb_scan_table_cached_single_flight():
+    # while another process fills the cache this one waits for it and then reads what it wrote, instead of also scanning (no scan is stubbed)
+    cache_dir = os.path.join("temp", "test_aws_dynamodb_scan_table_cached_single_flight")
+    rmdir(cache_dir)
+    mkdirs(cache_dir)
+    cache_file_path = _aws_dynamodb_cache_file_path(cache_dir, "t", None, None)
+    results = []
+    with stub_dynamodb():
+        with FileLock(_aws_dynamodb_cache_lock_path(cache_file_path)):
+            thread = threading.Thread(target=lambda: results.append(aws_dynamodb_scan_table_cached("t", None, cache_dir=cache_dir)))
+            thread.start()
+            time.sleep(0.5)  # waiting for the lock
+            with open(cache_file_path, "wb") as f:
+                pickle.dump([{"id": "1"}], f)
+        thread.join()
+    assert results == [[{"id": "1"}]]
+
+
+def test_aws_dynamodb_scan_pages_checkpoint():
+    # the checkpoint is saved after each page is processed, an interrupted scan resumes from it, and it is removed when the scan completes
+    checkpoint_dir = os.path.join("temp", "test_aws_dynamodb_scan_pages_checkpoint")
+    rmdir(checkpoint_dir)
+    mkdirs(checkpoint_dir)
+    checkpoint_path = os.path.join(checkpoint_dir, "checkpoint.pickle")
+    with stub_dynamodb() as stubber:
+        stubber.add_response("scan", {"Items": [{"id": {"S": "1"}}], "LastEvaluatedKey": {"id": {"S": "1"}}}, {"TableName": "t"})
+        stubber.add_client_error("scan", "AccessDeniedException", expected_params={"TableName": "t", "ExclusiveStartKey": {"id": "1"}})
+        pages = []
+        try:
+            for page in aws_dynamodb_scan_pages("t", None, checkpoint_path=checkpoint_path):
+                pages.append(page)
+            assert False
+        except ClientError:
+            pass
+        assert [page.items for page in pages] == [[{"id": "1"}]]
+        with open(checkpoint_path, "rb") as f:
+            assert pickle.load(f) == {"id": "1"}
+
+        stubber.add_response("scan", {"Items": [{"id": {"S": "2"}}]}, {"TableName": "t", "ExclusiveStartKey": {"id": "1"}})
+        pages = list(aws_dynamodb_scan_pages("t", None, checkpoint_path=checkpoint_path))
+    assert [(page.items, page.last_evaluated_key) for page in pages] == [([{"id": "2"}], None)]
+    assert not os.path.exists(checkpoint_path)
+
+
+class OutOfOrderSegmentsTable:
+    # segment 0 finishes last, and segment 1 has two pages
+    def __init__(self):
+        self.segment_2_scanned = threading.Event()
+
+    def scan(self, Segment, TotalSegments, ExclusiveStartKey=None, **kwargs):
+        if Segment == 0:
+            self.segment_2_scanned.wait(10.0)
+        elif Segment == 1 and ExclusiveStartKey is None:
+            return {"Items": [{"id": "1a"}], "LastEvaluatedKey": {"id": "1a"}}
+        elif Segment == 2:
+            self.segment_2_scanned.set()
+        return {"Items": [{"id": f"{Segment}{'b' if ExclusiveStartKey is not None else 'a'}"}]}
+
+
+class OutOfOrderSegmentsResource:
+    def __init__(self):
+        self.table = OutOfOrderSegmentsTable()
+
+    def Table(self, table_name: str):
+        return self.table
+
+
+def test_aws_dynamodb_scan_table_parallel_order():
+    # a parallel scan's items are in segment order regardless of the order the segments finish in
+    original_get_resource = sundry.aws._aws_get_resource
+    dynamodb_resource = OutOfOrderSegmentsResource()
+    sundry.aws._aws_get_resource = lambda *args, **kwargs: dynamodb_resource
+    try:
+        assert aws_dynamodb_scan_table("t", None, total_segments=3) == [{"id": "0a"}, {"id": "1a"}, {"id": "1b"}, {"id": "2a"}]
+    finally:
+        sundry.aws._aws_get_resource = original_get_resource
+
+
+def test_aws_dynamodb_scan_table_cached_validate():
+    # the table is only scanned if its metadata has changed since the cache was written, and unchanged metadata renews the cache's life
+    cache_dir = os.path.join("temp", "test_aws_dynamodb_scan_table_cached_validate")
+    rmdir(cache_dir)
+    cache_file_path = _aws_dynamodb_cache_file_path(cache_dir, "t", None, None)
+
+    def add_describe_table_metadata(stubber, item_count: int):
+        table_description = {"ItemCount": item_count, "TableSizeBytes": 10 * item_count, "CreationDateTime": datetime.datetime(2020, 1, 2, tzinfo=datetime.timezone.utc)}
+        stubber.add_response("describe_table", {"Table": table_description}, {"TableName": "t"})
+
+    with stub_dynamodb() as stubber:
+        add_describe_table_metadata(stubber, 1)
+        stubber.add_response("scan", {"Items": [{"id": {"S": "1"}}]}, {"TableName": "t"})
+        assert aws_dynamodb_scan_table_cached("t", None, cache_dir, cache_life=60.0, validate_cache=True) == [{"id": "1"}]
+
+        # unchanged - an expired cache is renewed instead of scanning
+        os.utime(cache_file_path, (0, 0))
+        add_describe_table_metadata(stubber, 1)
+        assert aws_dynamodb_scan_table_cached("t", None, cache_dir, cache_life=60.0, validate_cache=True) == [{"id": "1"}]
+        assert os.path.getmtime(cache_file_path) > 0
+
+        # changed - scanned even though the cache has not expired
+        add_describe_table_metadata(stubber, 2)
+        stubber.add_response("scan", {"Items": [{"id": {"S": "1"}}, {"id": {"S": "2"}}]}, {"TableName": "t"})
+        assert aws_dynamodb_scan_table_cached("t", None, cache_dir, cache_life=60.0, validate_cache=True) == [{"id": "1"}, {"id": "2"}]
+
+
+def write_scan_cache(cache_dir: str, filter_expression, items: list) -> str:
+    # an expired pickle cache
+    rmdir(cache_dir)
+    mkdirs(cache_dir)
+    cache_file_path = _aws_dynamodb_cache_file_path(cache_dir, "t", None, filter_expression)
+    with open(cache_file_path, "wb") as f:
+        pickle.dump(items, f)
+    os.utime(cache_file_path, (0, 0))
+    return cache_file_path
+
+
+def test_aws_dynamodb_scan_table_cached_delta():
+    # only items changed since the cache's high-water mark are read, and merged into the cached items by key
+    cache_dir = os.path.join("temp", "test_aws_dynamodb_scan_table_cached_delta")
+    filter_expression = Attr("s").eq("a")
+    write_scan_cache(cache_dir, filter_expression, [{"id": "1", "s": "a", "u": 1}, {"id": "2", "s": "a", "u": 2}, {"id": "4", "s": "a", "u": 1}])
+    with stub_dynamodb() as stubber:
+        add_describe_table(stubber, "t")
+        # the keys of all the changed items (1 changed, 2 no longer matches the filter and 3 is new) ...
+        stubber.add_response(
+            "scan",
+            {"Items": [{"id": {"S": "1"}}, {"id": {"S": "2"}}, {"id": {"S": "3"}}]},
+            {"TableName": "t", "ProjectionExpression": "#p0", "ExpressionAttributeNames": {"#p0": "id"}, "FilterExpression": ANY},
+        )
+        # ... and the changed items that match the filter
+        changed_items = [{"id": "1", "s": "a", "u": 3}, {"id": "3", "s": "a", "u": 3}]
+        stubber.add_response("scan", {"Items": [{"id": {"S": item["id"]}, "s": {"S": "a"}, "u": {"N": "3"}} for item in changed_items]}, {"TableName": "t", "FilterExpression": ANY})
+        table_data = aws_dynamodb_scan_table_cached("t", None, cache_dir, cache_life=1.0, filter_expression=filter_expression, updated_at_attribute="u")
+    assert table_data == [{"id": "1", "s": "a", "u": 3}, {"id": "4", "s": "a", "u": 1}, {"id": "3", "s": "a", "u": 3}]
+
+
+def test_aws_dynamodb_scan_table_cached_delta_full_scan():
+    # without a high-water mark in the cache the whole table is scanned
+    cache_dir = os.path.join("temp", "test_aws_dynamodb_scan_table_cached_delta_full_scan")
+    write_scan_cache(cache_dir, None, [{"id": "1"}])
+    with stub_dynamodb() as stubber:
+        add_describe_table(stubber, "t")
+        stubber.add_response("scan", {"Items": [{"id": {"S": "1"}, "u": {"N": "1"}}, {"id": {"S": "2"}, "u": {"N": "1"}}]}, {"TableName": "t"})
+        table_data = aws_dynamodb_scan_table_cached("t", None, cache_dir, cache_life=1.0, updated_at_attribute="u")
+    assert table_data == [{"id": "1", "u": 1}, {"id": "2", "u": 1}]
+
+
+if is_main():
+    test_aws_dynamodb_scan_table_cached_shards_projection()
+    test_aws_dynamodb_put_items()
+    test_aws_dynamodb_put_items_duplicates()
+    test_aws_dynamodb_put_items_failed_batch()
+    test_aws_dynamodb_get_items()
+    test_aws_dynamodb_get_items_cached()
+    test_aws_dynamodb_scan_table_cached_single_flight()
+    test_aws_dynamodb_scan_pages_checkpoint()
+    test_aws_dynamodb_scan_table_parallel_order()
+    test_aws_dynamodb_scan_table_cached_validate()
+    test_aws_dynamodb_scan_table_cached_delta()
+    test_aws_dynamodb_scan_table_cached_delta_full_scan()
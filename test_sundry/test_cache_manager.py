@@ -0,0 +1,46 @@
+import os
+import time
+
+from ismain import is_main
+
+from sundry import CacheManager, CacheUsage, rmdir
+
+
+def test_cache_manager():
+    cache_dir = os.path.join("temp", "test_cache_manager")
+    rmdir(cache_dir)
+
+    cache_manager = CacheManager(cache_dir, max_bytes=250, policy="lru")
+    for index in range(5):
+        name = f"f{index}"
+        with open(os.path.join(cache_dir, name), "wb") as f:
+            f.write(bytes(100))
+        with open(os.path.join(cache_dir, f"{name}.json"), "w") as f:
+            f.write("{}")  # sidecar
+        cache_manager.touch(name)
+        time.sleep(0.01)
+    cache_manager.touch("f0")  # f0 is now the most recently used
+
+    assert cache_manager.usage() == CacheUsage(500, 5)
+    assert cache_manager.trim() == CacheUsage(300, 3)
+    assert cache_manager.usage() == CacheUsage(200, 2)
+    assert sorted(os.listdir(cache_dir)) == ["cache_index.sqlite", "f0", "f0.json", "f4", "f4.json", "locks"]
+
+    # least frequently used
+    lfu_cache_manager = CacheManager(cache_dir, max_entries=1, policy="lfu")
+    assert lfu_cache_manager.trim() == CacheUsage(100, 1)
+    assert os.path.exists(os.path.join(cache_dir, "f0"))
+
+    # a cache that was filled before the budget was set (or without the cache manager) is trimmed by a new cache manager's first trim
+    rmdir(cache_dir)
+    os.makedirs(cache_dir)
+    for index in range(5):
+        with open(os.path.join(cache_dir, f"g{index}"), "wb") as f:
+            f.write(bytes(1000))
+    assert CacheManager(cache_dir, max_bytes=1500).trim() == CacheUsage(4000, 4)
+
+    rmdir(cache_dir)
+
+
+if is_main():
+    test_cache_manager()
@@ -0,0 +1,43 @@
+from decimal import Decimal
+
+from ismain import is_main
+
+from sundry import DynamoDBLookupTable
+
+
+def test_dynamodb_lookup():
+    items = [{"id": str(i), "color": ["red", "green", "blue"][i % 3], "size": Decimal(i)} for i in range(100)]
+    items.append({"id": "no_color", "size": Decimal(-1), "tags": ["a", "b"]})
+    lookup_table = DynamoDBLookupTable(items, ["id"], ["color", "tags"])
+
+    assert len(lookup_table) == len(items)
+    assert lookup_table.get("42") == items[42]
+    assert lookup_table.get({"id": "no_color"}) == items[-1]
+    assert lookup_table.get(("7",)) == items[7]
+    assert lookup_table.get("100") is None
+    assert "99" in lookup_table
+    assert list(lookup_table) == items
+
+    green = lookup_table.find("color", "green")
+    assert len(green) == 33
+    assert all(item["color"] == "green" for item in green)
+    assert lookup_table.find("color", "purple") == []
+    assert lookup_table.find("tags", ["a", "b"]) == []  # unhashable values are not indexed
+
+
+
+def test_dynamodb_lookup_duplicate_key():
+    # a later item with the same key replaces the earlier one, including in the secondary indexes
+    items = [{"id": "a", "color": "red"}, {"id": "b", "color": "red"}, {"id": "a", "color": "blue"}]
+    lookup_table = DynamoDBLookupTable(items, ["id"], ["color"])
+
+    assert len(lookup_table) == 2
+    assert lookup_table.get("a") == {"id": "a", "color": "blue"}
+    assert list(lookup_table) == [{"id": "a", "color": "blue"}, {"id": "b", "color": "red"}]
+    assert lookup_table.find("color", "red") == [{"id": "b", "color": "red"}]
+    assert lookup_table.find("color", "blue") == [{"id": "a", "color": "blue"}]
+
+
+if is_main():
+    test_dynamodb_lookup()
+    test_dynamodb_lookup_duplicate_key()
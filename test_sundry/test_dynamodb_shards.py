@@ -0,0 +1,57 @@
+import os
+from decimal import Decimal
+
+from pathlib import Path
+
+from ismain import is_main
+
+from sundry import DynamoDBShardedCache, write_dynamodb_shards, rmdir
+
+
+def test_dynamodb_shards():
+    items = [{"id": str(i), "sort": Decimal(i % 3), "value": Decimal(i) / Decimal(7), "data": bytes([i % 256]), "tags": {"a", "b"}, "nested": {"x": [True, None]}} for i in range(1000)]
+    for compression in [None, "zlib", "lzma"]:
+        cache_path = os.path.join("temp", "test_dynamodb_shards", str(compression))
+        rmdir(cache_path)
+
+        with write_dynamodb_shards(cache_path, items, ["id", "sort"], items_per_shard=100, compression=compression) as written_cache:
+            assert written_cache.shard_count == 10
+
+        with DynamoDBShardedCache(cache_path) as sharded_cache:
+            assert len(sharded_cache) == len(items)
+            assert sharded_cache.get(items[42]) == items[42]
+            assert sharded_cache.get(("999", Decimal(0))) == items[999]
+            assert ("999", Decimal(1)) not in sharded_cache
+            assert sharded_cache.get(("1000", Decimal(1))) is None
+            assert sorted(sharded_cache, key=lambda item: int(item["id"])) == items
+
+
+def test_dynamodb_shards_rewrite():
+    cache_path = os.path.join("temp", "test_dynamodb_shards_rewrite")
+    rmdir(cache_path)
+    old_items = [{"id": str(i), "value": "old"} for i in range(100)]
+    new_items = [{"id": str(i), "value": "new"} for i in range(50)]
+
+    write_dynamodb_shards(cache_path, old_items, ["id"], items_per_shard=10).close()
+    with DynamoDBShardedCache(cache_path) as old_cache:
+        assert old_cache.get({"id": "1"}) == old_items[1]  # load one shard before the rewrite
+
+        # rewrite with a different shard count while the old version is open
+        write_dynamodb_shards(cache_path, new_items, ["id"], items_per_shard=10).close()
+        assert len(list(Path(cache_path).glob("data_*"))) == 2  # old version is still being read
+
+        # the open cache keeps reading its own version, including shards it has not loaded yet
+        assert old_cache.shard_count == 10
+        assert sorted(old_cache, key=lambda item: int(item["id"])) == old_items
+        with DynamoDBShardedCache(cache_path) as new_cache:
+            assert new_cache.shard_count == 5
+            assert sorted(new_cache, key=lambda item: int(item["id"])) == new_items
+
+    # once no reader has the old version open it is removed by the next write
+    write_dynamodb_shards(cache_path, new_items, ["id"], items_per_shard=10).close()
+    assert len(list(Path(cache_path).glob("data_*"))) == 1
+
+
+if is_main():
+    test_dynamodb_shards()
+    test_dynamodb_shards_rewrite()
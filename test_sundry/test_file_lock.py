@@ -0,0 +1,45 @@
+import os
+from multiprocessing import Pool
+
+from ismain import is_main
+
+from sundry import FileLock, rmdir, mkdirs
+
+test_dir = os.path.join("temp", "test_file_lock")
+lock_path = os.path.join(test_dir, "counter.lock")
+counter_path = os.path.join(test_dir, "counter.txt")
+
+
+def increment(_):
+    # read-modify-write that loses updates unless the lock works across processes
+    for _ in range(20):
+        with FileLock(lock_path):
+            with open(counter_path) as f:
+                count = int(f.read())
+            with open(counter_path, "w") as f:
+                f.write(str(count + 1))
+
+
+def test_file_lock():
+    rmdir(test_dir)
+    mkdirs(test_dir)
+    with open(counter_path, "w") as f:
+        f.write("0")
+
+    with Pool(4) as pool:
+        pool.map(increment, range(4))
+    with open(counter_path) as f:
+        assert int(f.read()) == 80
+
+    with FileLock(lock_path):
+        try:
+            with FileLock(lock_path, timeout=0.2):
+                assert False
+        except TimeoutError:
+            pass
+    with FileLock(lock_path, timeout=0.2):
+        pass  # released
+
+
+if is_main():
+    test_file_lock()
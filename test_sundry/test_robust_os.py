@@ -2,7 +2,7 @@ import os
 
 from ismain import is_main
 
-from sundry import mkdirs, rmdir
+from sundry import mkdirs, rmdir, link_or_copy
 
 
 def test_robust_os():
@@ -13,5 +13,22 @@ def test_robust_os():
     assert not os.path.exists(test_dir)
 
 
+def test_link_or_copy():
+    test_dir = os.path.join("temp", "test_link_or_copy")
+    mkdirs(test_dir, remove_first=True)
+    source = os.path.join(test_dir, "source.txt")
+    with open(source, "w") as f:
+        f.write("a")
+    for link_mode in ["copy", "hardlink", "reflink", "symlink"]:
+        destination = os.path.join(test_dir, f"{link_mode}.txt")
+        used_link_mode = link_or_copy(source, destination, link_mode)
+        assert used_link_mode in [link_mode, "copy"]  # e.g. reflink is not supported on all file systems
+        link_or_copy(source, destination, link_mode)  # replaces the existing destination
+        with open(destination) as f:
+            assert f.read() == "a"
+    rmdir(test_dir)
+
+
 if is_main():
     test_robust_os()
+    test_link_or_copy()